@@ -1,10 +1,23 @@
 from .cachemanager import *
+from .cache_entry_store import *
+from .cache_stats import *
+from .sqlite_cachemanager import *
 from .tinc_object import *
 from .datapool import *
 from .disk_buffer import *
 from .parameter import *
 from .processor import *
 from .parameter_space import *
+from .sweep_checkpoint import *
+from .sweep_plan import *
+from .sweep_queue import *
+from .sweep_progress import *
+from .memory_cache import *
+from .cache_serializers import *
+from .cache_compression import *
+from .cache_writer import *
+from .approximate_cache import *
+from .file_fingerprint import *
 from .tinc_client import *
 from .tinc_server import *
 from .process_args import *
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+Approximate cache lookups, from the cached samples nearest to a requested sample.
+"""
+
+try:
+    from scipy.spatial import cKDTree
+except:
+    cKDTree = None
+
+import threading
+from typing import NamedTuple
+
+import numpy as np
+
+from .cachemanager import _file_dependency_path, _source_key, cache_file_name, source_info_key
+
+class NearestSample(NamedTuple):
+    # Argument values of the continuous parameters of the cached sample
+    values: dict
+    # Distance to the requested sample in normalized parameter coordinates
+    distance: float
+    result: object
+
+class ProcessResult(NamedTuple):
+    '''Result of ParameterSpace.run_process() with an approximate lookup
+
+    exact is True if the result was found in the cache for the requested
+    values or computed, and False if it comes from nearby cached samples.
+    distance is the normalized distance to the nearest sample used, 0.0 if
+    exact. neighbours are the samples used, empty if exact. Without
+    interpolation, only the nearest sample is used.
+    '''
+    result: object
+    exact: bool
+    distance: float = 0.0
+    neighbours: list = []
+
+class ApproximateLookup(object):
+    '''Options of approximate cache lookups for ParameterSpace.run_process()
+
+    When the result for the requested parameter values is not in the cache,
+    the k cached samples nearest to them are found. Only continuous
+    parameters (arguments with float values) can differ between the
+    requested and the cached samples, all other arguments and dependencies
+    must be equal. Distances are measured with each parameter scaled to
+    [0, 1] by its minimum and maximum. Samples further than tolerance are
+    ignored, and if none is left the function is computed.
+
+    :param k: Number of nearest cached samples to find
+    :param tolerance: Maximum distance to a cached sample in normalized parameter coordinates
+    :param interpolate: (optional) Function called as interpolate(values, neighbours) with the requested values as a dict and a list of :class:`NearestSample`, nearest first, that returns the result. If None, the result of the nearest sample is returned. See inverse_distance_weighting()
+    '''
+    def __init__(self, k = 4, tolerance = 0.05, interpolate = None):
+        self.k = k
+        self.tolerance = tolerance
+        self.interpolate = interpolate
+
+def inverse_distance_weighting(values, neighbours, power = 2):
+    '''Interpolation function for ApproximateLookup
+
+    Weights the results by the inverse of their distance to the requested
+    values raised to power. Results must support multiplication by a float
+    and addition, e.g. numbers or numpy arrays.
+    '''
+    if neighbours[0].distance == 0.0:
+        return neighbours[0].result
+    weights = [1.0 / n.distance ** power for n in neighbours]
+    total = sum(weights)
+    out = neighbours[0].result * (weights[0] / total)
+    for weight, n in zip(weights[1:], neighbours[1:]):
+        out = out + n.result * (weight / total)
+    return out
+
+class SampleIndex(object):
+    '''Spatial index of cached samples over their continuous parameters
+
+    Uses a scipy cKDTree when scipy is available, and a brute force search
+    with numpy otherwise.
+
+    Samples can be added and removed after the index is built. Added samples
+    are searched by brute force and removed samples are skipped until enough
+    of them accumulate, then the tree is rebuilt, so the cost of rebuilding
+    is shared by a batch of changes.
+
+    :param coordinates: Array of shape (sample count, dimensions) of normalized coordinates
+    :param samples: List with the item returned for each sample, e.g. its cache files
+    :param keys: (optional) List with a hashable key for each sample, used by remove()
+    '''
+    def __init__(self, coordinates, samples, keys = None):
+        self._lock = threading.Lock()
+        self._build(np.asarray(coordinates, dtype = np.float64), list(samples),
+                    [None] * len(samples) if keys is None else list(keys))
+
+    def __len__(self):
+        return len(self.samples) - len(self._removed)
+
+    def add(self, coordinates, sample, key = None):
+        '''Add a sample at coordinates'''
+        with self._lock:
+            self._positions.setdefault(key, []).append(len(self.samples))
+            self.samples.append(sample)
+            self._keys.append(key)
+            self._added.append(coordinates)
+            self._rebuild_if_needed()
+
+    def remove(self, key):
+        '''Remove the samples added with key. Returns the number of samples removed'''
+        if key is None:
+            return 0
+        with self._lock:
+            positions = self._positions.pop(key, [])
+            self._removed.update(positions)
+            self._rebuild_if_needed()
+        return len(positions)
+
+    def query(self, point, k, max_distance = np.inf):
+        '''Returns a list of (distance, sample) for the k samples nearest to point within max_distance, nearest first'''
+        point = np.asarray(point, dtype = np.float64)
+        with self._lock:
+            tree_size = len(self.coordinates)
+            # Removed samples can be among the nearest ones
+            found = _nearest(self.coordinates, self._tree, point, k + len(self._removed), max_distance)
+            if len(self._added) > 0:
+                found += [(d, tree_size + i) for d, i in
+                          _nearest(np.asarray(self._added, dtype = np.float64), None, point, k, max_distance)]
+            found = sorted((d, i) for d, i in found if not i in self._removed)[:k]
+            return [(d, self.samples[i]) for d, i in found]
+
+    def _build(self, coordinates, samples, keys):
+        self.coordinates = coordinates
+        if len(samples) == 0:
+            self.coordinates = self.coordinates.reshape(0, 0)
+        self.samples = samples
+        self._keys = keys
+        # Positions of the samples by key
+        self._positions = {}
+        for i, key in enumerate(keys):
+            self._positions.setdefault(key, []).append(i)
+        # Coordinates of the samples added since the tree was built, which
+        # follow the samples in the tree, and positions of the removed samples
+        self._added = []
+        self._removed = set()
+        self._tree = None
+        if cKDTree is not None and len(samples) > 0:
+            self._tree = cKDTree(self.coordinates)
+
+    def _rebuild_if_needed(self):
+        # Must be called with the lock held
+        if len(self._added) + len(self._removed) <= max(64, len(self.coordinates) // 4):
+            return
+        keep = [i for i in range(len(self.samples)) if not i in self._removed]
+        coordinates = list(self.coordinates) + self._added
+        self._build(np.asarray([coordinates[i] for i in keep], dtype = np.float64),
+                    [self.samples[i] for i in keep], [self._keys[i] for i in keep])
+
+def _nearest(coordinates, tree, point, k, max_distance):
+    # List of (distance, position) of the k rows of coordinates nearest to
+    # point within max_distance, nearest first. tree is a cKDTree of the
+    # coordinates, or None to search by brute force
+    k = min(k, len(coordinates))
+    if k == 0:
+        return []
+    if tree is not None:
+        distances, indeces = tree.query(point, k = k, distance_upper_bound = max_distance)
+        distances = np.atleast_1d(distances)
+        indeces = np.atleast_1d(indeces)
+    else:
+        all_distances = np.sqrt(((coordinates - point) ** 2).sum(axis = 1))
+        indeces = np.argpartition(all_distances, k - 1)[:k]
+        indeces = indeces[np.argsort(all_distances[indeces], kind = 'stable')]
+        distances = all_distances[indeces]
+    return [(float(d), int(i)) for d, i in zip(distances, indeces) if d <= max_distance]
+
+def _continuous_ids(calling_args):
+    # Ids of the arguments that can be matched approximately
+    return sorted(id for id, value in calling_args.items()
+                  if isinstance(value, (float, np.floating)))
+
+def _group_key(source_info, continuous_ids):
+    # source_info_key() without the continuous arguments. Cached samples are
+    # only candidates if their group key matches the requested one
+    return (_source_key(source_info.type, source_info.tinc_id, source_info.command_line_arguments,
+                        [(a.id, a.value.nctype, a.value.value) for a in source_info.arguments
+                         if a.id not in continuous_ids],
+                        [(a.id, a.value.nctype, a.value.value) for a in source_info.dependencies],
+                        [_file_dependency_path(f.file.protocol_id, f.file.root_path, f.file.relative_path, f.file.filename)
+                         for f in source_info.file_dependencies if f.file.filename != '']),
+            tuple(continuous_ids))
+
+def _index_entry(entry, continuous_ids, normalization):
+    # (coordinates, sample, key) of a cache entry for SampleIndex, or None if
+    # its continuous arguments are missing or not numbers
+    source_info = entry.source_info
+    values = {a.id: a.value.value for a in source_info.arguments if a.id in continuous_ids}
+    if len(values) != len(continuous_ids) \
+        or not all(isinstance(v, (int, float)) for v in values.values()):
+            return None
+    coordinates = [(values[id] - offset) / scale for id, (offset, scale) in zip(continuous_ids, normalization)]
+    return coordinates, (values, [cache_file_name(f) for f in entry.files]), source_info_key(source_info)
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+Compression of result files in the cache.
+"""
+
+import bz2
+import io
+import lzma
+import zlib
+
+class ZlibCodec(object):
+    name = "zlib"
+    extension = ".zz"
+
+    def compressor(self, level):
+        return zlib.compressobj(-1 if level is None else level)
+
+    def open(self, filename):
+        return _ZlibReader(filename)
+
+class Bz2Codec(object):
+    name = "bz2"
+    extension = ".bz2"
+
+    def compressor(self, level):
+        return bz2.BZ2Compressor(9 if level is None else level)
+
+    def open(self, filename):
+        return bz2.open(filename, 'rb')
+
+class LzmaCodec(object):
+    name = "lzma"
+    extension = ".xz"
+
+    def compressor(self, level):
+        return lzma.LZMACompressor(preset = level)
+
+    def open(self, filename):
+        return lzma.open(filename, 'rb')
+
+compression_codecs = {codec.name: codec for codec in [ZlibCodec(), Bz2Codec(), LzmaCodec()]}
+
+class CacheCompression(object):
+    '''Compresses result files written to the cache.
+
+    Results are compressed as they are serialized, so the uncompressed file
+    is never held in memory. Results that serialize to less than min_size
+    bytes are stored uncompressed. Compressed files get the extension of the
+    codec appended, e.g. '.pkl.zz', and are decompressed as they are read.
+
+    Memory mapped formats like .npy lose the benefit of memory mapping when
+    compressed, as the whole array is read on load.
+
+    :param codec: 'zlib', 'bz2' or 'lzma'
+    :param level: Compression level, or preset for lzma. None for the codec default
+    :param min_size: Results smaller than this number of bytes are not compressed
+    '''
+    def __init__(self, codec = 'zlib', level = None, min_size = 64 * 1024):
+        if codec not in compression_codecs:
+            raise ValueError(f"Unknown compression codec '{codec}'. Available: {list(compression_codecs.keys())}")
+        self.codec = compression_codecs[codec]
+        self.level = level
+        self.min_size = min_size
+
+    def can_compress(self, serializer):
+        return hasattr(serializer, 'load_stream')
+
+    def store(self, serializer, out, f):
+        '''Serialize out to the open file f
+
+        :returns: The name of the codec used, or '' if the result was stored uncompressed
+        '''
+        writer = _ThresholdWriter(f, self.codec.compressor(self.level), self.min_size)
+        serializer.store(out, writer)
+        if writer.close():
+            return self.codec.name
+        return ''
+
+def codec_for_file(filename):
+    '''Returns the codec a cache file was compressed with, or None'''
+    for codec in compression_codecs.values():
+        if filename.endswith(codec.extension):
+            return codec
+    return None
+
+def load_compressed(serializer, codec, filename):
+    with codec.open(filename) as f:
+        return serializer.load_stream(f)
+
+class _ThresholdWriter(object):
+    # Buffers the data written until it reaches min_size. From then on, data
+    # is compressed as it is written
+    def __init__(self, f, compressor, min_size):
+        self._f = f
+        self._compressor = compressor
+        self._min_size = min_size
+        self._buffer = io.BytesIO()
+
+    def write(self, data):
+        if self._buffer is None:
+            self._f.write(self._compressor.compress(data))
+        else:
+            self._buffer.write(data)
+            if self._buffer.tell() >= self._min_size:
+                self._f.write(self._compressor.compress(self._buffer.getvalue()))
+                self._buffer = None
+        return len(data)
+
+    def close(self):
+        # Returns True if the data was compressed
+        if self._buffer is None:
+            self._f.write(self._compressor.flush())
+            return True
+        self._f.write(self._buffer.getvalue())
+        return False
+
+class _ZlibReader(object):
+    # File like object that decompresses a zlib stream as it is read
+    def __init__(self, filename, chunk_size = 1024 * 1024):
+        self._f = open(filename, 'rb')
+        self._decompressor = zlib.decompressobj()
+        self._buffer = b''
+        self._eof = False
+        self.chunk_size = chunk_size
+
+    def read(self, size = -1):
+        out = bytearray(self._buffer)
+        self._buffer = b''
+        while (size < 0 or len(out) < size) and not self._eof:
+            out += self._decompress(0 if size < 0 else size - len(out))
+        if size >= 0 and len(out) > size:
+            self._buffer = bytes(out[size:])
+            del out[size:]
+        return bytes(out)
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def readline(self):
+        out = bytearray()
+        while True:
+            end = self._buffer.find(b'\n')
+            if end >= 0:
+                out += self._buffer[:end + 1]
+                self._buffer = self._buffer[end + 1:]
+                return bytes(out)
+            out += self._buffer
+            self._buffer = b''
+            if self._eof:
+                return bytes(out)
+            self._buffer = self._decompress(self.chunk_size)
+
+    def _decompress(self, max_length):
+        if self._decompressor.unconsumed_tail:
+            data = self._decompressor.unconsumed_tail
+        else:
+            data = self._f.read(self.chunk_size)
+            if not data:
+                self._eof = True
+                return self._decompressor.flush()
+        out = self._decompressor.decompress(data, max_length)
+        if self._decompressor.eof:
+            self._eof = True
+        return out
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,540 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar in-memory storage of cache entries.
+"""
+
+import numpy as np
+
+from .cachemanager import CacheEntry, FileDependency, SourceArgument, SourceInfo, UserInfo, VariantValue
+from .distributed_path import DistributedPath
+from .variant import VariantType
+
+class CacheEntryStore(object):
+    '''Stores cache entries in typed numpy columns instead of nested objects.
+
+    Strings are interned, so timestamps, ids and file names repeated across
+    entries are only stored once. Argument values are stored in integer or
+    floating point columns according to their type. Lists of arguments and
+    files are stored flat, with the start and count for each entry.
+
+    Entries are accessed by id through :class:`CacheEntryView` objects, which
+    have the same attributes as :class:`tinc.cachemanager.CacheEntry` and
+    decode them when they are accessed. Ids are assigned in increasing order
+    from first_id as entries are added. Removed entries are only marked as
+    removed, so views of them remain valid. To release them, the entries
+    left are copied to a new store.
+
+    Only the hit count, last access time and stale flag of an entry can be
+    changed once it is added, through update().
+
+    :param first_id: Id of the first entry added
+    '''
+    def __init__(self, first_id = 0):
+        self.first_id = first_id
+        self._strings = _InternTable()
+        # User info and the source info fields other than lists are interned as tuples
+        self._objects = _InternTable()
+        # Values that don't fit in a column, e.g. lists
+        self._values = []
+        self._entries = _Table(_ENTRY_FIELDS)
+        self._arguments = _Table(_ARGUMENT_FIELDS)
+        self._dependencies = _Table(_ARGUMENT_FIELDS)
+        self._files = _Table(_FILE_FIELDS)
+        self._file_dependencies = _Table(_FILE_FIELDS)
+        self._alive_count = 0
+        # Number of entries that have a file, by interned (relative path, file name)
+        self._file_counts = {}
+
+    def add(self, entry):
+        '''Add a CacheEntry (or a view of one). Returns the id of the entry'''
+        source_info = entry.source_info
+        return self._add_row(entry.timestamp_start, entry.timestamp_end, entry.last_access, entry.compression,
+                             entry.cache_hits, entry.stale, entry.user_info,
+                             (source_info.type, source_info.tinc_id, source_info.command_line_arguments,
+                              source_info.working_path_rel, source_info.working_path_root),
+                             [(a.id, a.value.nctype, a.value.value) for a in source_info.arguments],
+                             [(a.id, a.value.nctype, a.value.value) for a in source_info.dependencies],
+                             [_file_fields(f) for f in entry.files],
+                             [_file_fields(f) for f in source_info.file_dependencies])
+
+    def add_json(self, entry):
+        '''Add an entry in the json metadata format. Returns the id of the entry
+
+        Faster than converting the entry to a CacheEntry and calling add().
+        '''
+        source_info = entry["sourceInfo"]
+        user_info = entry["userInfo"]
+        return self._add_row(entry["timestamp"]["start"], entry["timestamp"]["end"],
+                             entry.get("lastAccess", ""), entry.get("compression", ""),
+                             entry["cacheHits"], entry["stale"],
+                             UserInfo(user_name = user_info["userName"],
+                                      user_hash = user_info["userHash"],
+                                      ip = user_info["ip"],
+                                      port = user_info["port"],
+                                      server = user_info["server"]),
+                             (source_info["type"], source_info["tincId"], source_info["commandLineArguments"],
+                              source_info["workingPath"]["relativePath"], source_info["workingPath"]["rootPath"]),
+                             [(a["id"], a["nctype"], a["value"]) for a in source_info["arguments"]],
+                             [(a["id"], a["nctype"], a["value"]) for a in source_info["dependencies"]],
+                             [_json_file_fields(f) for f in entry["files"]],
+                             [_json_file_fields(f) for f in source_info["fileDependencies"]])
+
+    def update(self, entry_id, cache_hits = None, last_access = None, stale = None):
+        row = self._row(entry_id)
+        if cache_hits is not None:
+            self._entries.set(row, _CACHE_HITS, cache_hits)
+        if last_access is not None:
+            self._entries.set(row, _LAST_ACCESS, self._strings.add(last_access))
+        if stale is not None:
+            self._entries.set(row, _STALE, stale)
+
+    def pop(self, entry_id):
+        '''Remove an entry. Returns its view'''
+        row = self._row(entry_id)
+        self._entries.set(row, _ALIVE, False)
+        self._alive_count -= 1
+        start = self._entries.get(row, _FILES_START)
+        files = set()
+        for i in range(start, start + self._entries.get(row, _FILES_COUNT)):
+            file_row = self._files.row(i)
+            files.add((file_row[_FILE_RELATIVE_PATH], file_row[_FILE_NAME]))
+        for f in files:
+            count = self._file_counts[f] - 1
+            if count == 0:
+                del self._file_counts[f]
+            else:
+                self._file_counts[f] = count
+        return CacheEntryView(self, row)
+
+    def removed_count(self):
+        '''Number of removed entries, which are still stored'''
+        return len(self._entries) - self._alive_count
+
+    def column(self, name):
+        '''Returns a numpy array with the values of an entry column, for all entries including removed ones
+
+        Columns are named after the CacheEntry attributes, plus 'alive'.
+        String columns hold indices that can be decoded with string().
+        '''
+        self.flush()
+        return self._entries.column(name)
+
+    def string(self, index):
+        return self._strings.values[index]
+
+    def file_references(self, relative_path, filename):
+        '''Returns the number of entries, not counting removed ones, that have a file among their files'''
+        return self._file_counts.get((self._strings.index(relative_path), self._strings.index(filename)), 0)
+
+    def to_json(self):
+        '''Returns the entries, not counting removed ones, in the json metadata format
+
+        Produces the same output as converting each entry with
+        tinc.cachemanager._entry_to_json(), but reads the columns in bulk, and
+        converts objects and files shared by several entries only once.
+        '''
+        self.flush()
+        strings = self._strings.values
+        columns = {name: self._entries.column(name).tolist() for name in self._entries._names}
+        arguments = self._json_arguments(self._arguments)
+        dependencies = self._json_arguments(self._dependencies)
+        files = self._json_files(self._files)
+        file_dependencies = self._json_files(self._file_dependencies)
+        objects = {}
+        def json_object(index, convert):
+            j = objects.get(index)
+            if j is None:
+                j = convert(self._objects.values[index])
+                objects[index] = j
+            return j
+        j_entries = []
+        for row in np.nonzero(self._entries.column("alive"))[0].tolist():
+            j_entry = {"timestamp": {"start": strings[columns["timestamp_start"][row]],
+                                     "end": strings[columns["timestamp_end"][row]]}}
+            start = columns["files_start"][row]
+            j_entry["files"] = files[start:start + columns["files_count"][row]]
+            j_entry["cacheHits"] = columns["cache_hits"][row]
+            j_entry["stale"] = columns["stale"][row]
+            last_access = strings[columns["last_access"][row]]
+            if last_access != '':
+                j_entry["lastAccess"] = last_access
+            compression = strings[columns["compression"][row]]
+            if compression != '':
+                j_entry["compression"] = compression
+            j_entry["userInfo"] = json_object(columns["user_info"][row], _json_user_info)
+            source = json_object(columns["source"][row], _json_source)
+            start = columns["arguments_start"][row]
+            arguments_json = arguments[start:start + columns["arguments_count"][row]]
+            start = columns["dependencies_start"][row]
+            dependencies_json = dependencies[start:start + columns["dependencies_count"][row]]
+            start = columns["file_dependencies_start"][row]
+            j_entry["sourceInfo"] = dict(source,
+                                         arguments = arguments_json,
+                                         dependencies = dependencies_json,
+                                         fileDependencies = file_dependencies[start:start + columns["file_dependencies_count"][row]])
+            j_entries.append(j_entry)
+        return j_entries
+
+    def _json_arguments(self, table):
+        strings = self._strings.values
+        values = []
+        for id, nctype, kind, int_value, float_value in zip(*[table.column(name).tolist() for name in table._names]):
+            if kind == _VALUE_FLOAT:
+                value = float_value
+            elif kind == _VALUE_INT:
+                value = int_value
+            elif kind == _VALUE_STRING:
+                value = strings[int_value]
+            else:
+                value = self._values[int_value]
+            values.append({"id": strings[id], "nctype": nctype, "value": value})
+        return values
+
+    def _json_files(self, table):
+        strings = self._strings.values
+        return [{"file": {"filename": strings[filename],
+                          "relativePath": strings[relative_path],
+                          "rootPath": strings[root_path],
+                          "protocolId": strings[protocol_id]},
+                 "modified": strings[modified],
+                 "size": size,
+                 "hash": strings[hash]}
+                for filename, relative_path, root_path, protocol_id, modified, hash, size
+                in zip(*[table.column(name).tolist() for name in table._names])]
+
+    def flush(self):
+        '''Move the entries added since the last flush to the numpy columns
+
+        Done automatically every few thousand entries.
+        '''
+        for table in self._tables():
+            table.flush()
+
+    def shrink(self):
+        '''Flush and release the memory reserved for entries to be added'''
+        for table in self._tables():
+            table.flush()
+            table.shrink()
+
+    def nbytes(self):
+        '''Memory used by the columns, not counting interned strings and objects'''
+        self.flush()
+        return sum(table.nbytes() for table in self._tables())
+
+    def __getitem__(self, entry_id):
+        return CacheEntryView(self, self._row(entry_id))
+
+    def __contains__(self, entry_id):
+        row = entry_id - self.first_id
+        return 0 <= row < len(self._entries) and self._entries.get(row, _ALIVE)
+
+    def __len__(self):
+        return self._alive_count
+
+    def keys(self):
+        get = self._entries.get
+        return [self.first_id + row for row in range(len(self._entries)) if get(row, _ALIVE)]
+
+    def values(self):
+        return [CacheEntryView(self, entry_id - self.first_id) for entry_id in self.keys()]
+
+    def items(self):
+        return [(entry_id, CacheEntryView(self, entry_id - self.first_id)) for entry_id in self.keys()]
+
+    def _add_row(self, timestamp_start, timestamp_end, last_access, compression, cache_hits, stale,
+                 user_info, source, arguments, dependencies, files, file_dependencies):
+        strings = self._strings.add
+        row = [strings(timestamp_start), strings(timestamp_end), strings(last_access), strings(compression),
+               cache_hits, stale, True, self._objects.add(user_info), self._objects.add(source)]
+        for table, values in [(self._arguments, arguments), (self._dependencies, dependencies)]:
+            row += [len(table), len(values)]
+            for id, nctype, value in values:
+                table.append(self._argument_row(id, nctype, value))
+        for table, values in [(self._files, files), (self._file_dependencies, file_dependencies)]:
+            row += [len(table), len(values)]
+            for fields in values:
+                table.append(tuple(strings(v) for v in fields[:-1]) + (fields[-1],))
+        for f in set((strings(fields[1]), strings(fields[0])) for fields in files):
+            self._file_counts[f] = self._file_counts.get(f, 0) + 1
+        self._entries.append(tuple(row))
+        self._alive_count += 1
+        if self._entries.pending() >= _Table.BLOCK_SIZE:
+            self.flush()
+        return self.first_id + len(self._entries) - 1
+
+    def _argument_row(self, id, nctype, value):
+        # Integers and floats, including numpy scalars, are stored in their
+        # own columns, strings as interned indices and other values in a list
+        if isinstance(value, (float, np.floating)):
+            return (self._strings.add(id), int(nctype), _VALUE_FLOAT, 0, float(value))
+        if isinstance(value, (int, np.integer)) and not isinstance(value, bool) \
+            and -2**63 <= value < 2**63:
+                return (self._strings.add(id), int(nctype), _VALUE_INT, int(value), 0.0)
+        if type(value) == str:
+            return (self._strings.add(id), int(nctype), _VALUE_STRING, self._strings.add(value), 0.0)
+        self._values.append(value)
+        return (self._strings.add(id), int(nctype), _VALUE_OTHER, len(self._values) - 1, 0.0)
+
+    def _argument(self, table, i):
+        id, nctype, kind, int_value, float_value = table.row(i)
+        if kind == _VALUE_FLOAT:
+            value = float_value
+        elif kind == _VALUE_INT:
+            value = int_value
+        elif kind == _VALUE_STRING:
+            value = self._strings.values[int_value]
+        else:
+            value = self._values[int_value]
+        return SourceArgument(id = self._strings.values[id],
+                              value = VariantValue(nctype = VariantType(nctype), value = value))
+
+    def _file(self, table, i):
+        row = table.row(i)
+        filename, relative_path, root_path, protocol_id, modified, hash = [self._strings.values[s] for s in row[:-1]]
+        return FileDependency(file = DistributedPath(filename = filename,
+                                                     relative_path = relative_path,
+                                                     root_path = root_path,
+                                                     protocol_id = protocol_id),
+                              modified = modified,
+                              size = row[-1],
+                              hash = hash)
+
+    def _tables(self):
+        return [self._entries, self._arguments, self._dependencies, self._files, self._file_dependencies]
+
+    def _row(self, entry_id):
+        if not entry_id in self:
+            raise KeyError(entry_id)
+        return entry_id - self.first_id
+
+class CacheEntryView(object):
+    '''Read only view of an entry in a :class:`CacheEntryStore`
+
+    Has the attributes of :class:`tinc.cachemanager.CacheEntry`, decoded
+    from the store when accessed, and compares equal to the CacheEntry it
+    was created from. Use to_entry() to get a CacheEntry.
+    '''
+    __slots__ = ('_store', '_row')
+
+    def __init__(self, store, row):
+        self._store = store
+        self._row = row
+
+    @property
+    def timestamp_start(self):
+        return self._string(_TIMESTAMP_START)
+
+    @property
+    def timestamp_end(self):
+        return self._string(_TIMESTAMP_END)
+
+    @property
+    def last_access(self):
+        return self._string(_LAST_ACCESS)
+
+    @property
+    def compression(self):
+        return self._string(_COMPRESSION)
+
+    @property
+    def cache_hits(self):
+        return self._store._entries.get(self._row, _CACHE_HITS)
+
+    @property
+    def stale(self):
+        return self._store._entries.get(self._row, _STALE)
+
+    @property
+    def user_info(self):
+        return self._store._objects.values[self._store._entries.get(self._row, _USER_INFO)]
+
+    @property
+    def files(self):
+        return self._list(_FILES_START, self._store._files, self._store._file)
+
+    @property
+    def source_info(self):
+        store = self._store
+        type, tinc_id, command_line_arguments, working_path_rel, working_path_root = \
+            store._objects.values[store._entries.get(self._row, _SOURCE)]
+        return SourceInfo(type = type,
+                          tinc_id = tinc_id,
+                          command_line_arguments = command_line_arguments,
+                          working_path_rel = working_path_rel,
+                          working_path_root = working_path_root,
+                          arguments = self._list(_ARGUMENTS_START, store._arguments, store._argument),
+                          dependencies = self._list(_DEPENDENCIES_START, store._dependencies, store._argument),
+                          file_dependencies = self._list(_FILE_DEPENDENCIES_START, store._file_dependencies, store._file))
+
+    @property
+    def file_dependencies(self):
+        '''source_info.file_dependencies, without decoding the rest of the source info'''
+        return self._list(_FILE_DEPENDENCIES_START, self._store._file_dependencies, self._store._file)
+
+    def to_entry(self):
+        return CacheEntry(timestamp_start = self.timestamp_start,
+                          timestamp_end = self.timestamp_end,
+                          files = self.files,
+                          user_info = self.user_info,
+                          source_info = self.source_info,
+                          cache_hits = self.cache_hits,
+                          stale = self.stale,
+                          last_access = self.last_access,
+                          compression = self.compression)
+
+    def _replace(self, **kwargs):
+        return self.to_entry()._replace(**kwargs)
+
+    def __eq__(self, other):
+        if isinstance(other, CacheEntryView):
+            other = other.to_entry()
+        return self.to_entry() == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self.to_entry())
+
+    def _string(self, field):
+        return self._store._strings.values[self._store._entries.get(self._row, field)]
+
+    def _list(self, start_field, table, decode):
+        start = self._store._entries.get(self._row, start_field)
+        count = self._store._entries.get(self._row, start_field + 1)
+        return [decode(table, i) for i in range(start, start + count)]
+
+# Fields of the tables. Lists of arguments and files are a start and a count
+# in their own table
+_ENTRY_FIELDS = [("timestamp_start", np.int32), ("timestamp_end", np.int32),
+                 ("last_access", np.int32), ("compression", np.int32),
+                 ("cache_hits", np.int64), ("stale", np.bool_), ("alive", np.bool_),
+                 ("user_info", np.int32), ("source", np.int32),
+                 ("arguments_start", np.int64), ("arguments_count", np.int32),
+                 ("dependencies_start", np.int64), ("dependencies_count", np.int32),
+                 ("files_start", np.int64), ("files_count", np.int32),
+                 ("file_dependencies_start", np.int64), ("file_dependencies_count", np.int32)]
+(_TIMESTAMP_START, _TIMESTAMP_END, _LAST_ACCESS, _COMPRESSION, _CACHE_HITS, _STALE, _ALIVE,
+ _USER_INFO, _SOURCE, _ARGUMENTS_START, _ARGUMENTS_COUNT, _DEPENDENCIES_START, _DEPENDENCIES_COUNT,
+ _FILES_START, _FILES_COUNT, _FILE_DEPENDENCIES_START, _FILE_DEPENDENCIES_COUNT) = range(len(_ENTRY_FIELDS))
+
+_ARGUMENT_FIELDS = [("id", np.int32), ("nctype", np.int16), ("kind", np.int8),
+                    ("int_value", np.int64), ("float_value", np.float64)]
+
+# String fields are interned
+_FILE_FIELDS = [("filename", np.int32), ("relative_path", np.int32), ("root_path", np.int32),
+                ("protocol_id", np.int32), ("modified", np.int32), ("hash", np.int32), ("size", np.int64)]
+
+_FILE_NAME = 0
+_FILE_RELATIVE_PATH = 1
+
+# Kinds of argument values
+_VALUE_INT = 0
+_VALUE_FLOAT = 1
+_VALUE_STRING = 2
+_VALUE_OTHER = 3
+
+def _file_fields(fdep):
+    # Values of a FileDependency, in the order of _FILE_FIELDS
+    return (fdep.file.filename, fdep.file.relative_path, fdep.file.root_path, fdep.file.protocol_id,
+            fdep.modified, fdep.hash, fdep.size)
+
+def _json_user_info(user_info):
+    return {"userName": user_info.user_name,
+            "userHash": user_info.user_hash,
+            "ip": user_info.ip,
+            "port": user_info.port,
+            "server": user_info.server}
+
+def _json_source(source):
+    # Fields of the source info interned in the objects table, without the lists
+    type, tinc_id, command_line_arguments, working_path_rel, working_path_root = source
+    return {"type": type,
+            "tincId": tinc_id,
+            "commandLineArguments": command_line_arguments,
+            "workingPath": {"relativePath": working_path_rel,
+                            "rootPath": working_path_root}}
+
+def _json_file_fields(fdep):
+    return (fdep["file"]["filename"], fdep["file"]["relativePath"], fdep["file"]["rootPath"],
+            fdep["file"]["protocolId"], fdep["modified"], fdep["hash"], fdep["size"])
+
+class _InternTable(object):
+    # Stores each distinct value once. add() returns the index of the value
+    def __init__(self):
+        self.values = []
+        self._indices = {}
+
+    def add(self, value):
+        index = self._indices.get(value)
+        if index is None:
+            index = len(self.values)
+            self._indices[value] = index
+            self.values.append(value)
+        return index
+
+    def index(self, value):
+        # Index of a value, or None if it was never added
+        return self._indices.get(value)
+
+class _Table(object):
+    # Typed columns in numpy arrays that grow by doubling. Rows appended are
+    # kept as tuples and copied to the columns in blocks, as setting numpy
+    # elements one at a time is slow
+    BLOCK_SIZE = 4096
+
+    def __init__(self, fields):
+        self._names = [name for name, dtype in fields]
+        self._columns = [np.zeros(0, dtype = dtype) for name, dtype in fields]
+        self._size = 0
+        self._tail = []
+
+    def __len__(self):
+        return self._size + len(self._tail)
+
+    def pending(self):
+        return len(self._tail)
+
+    def append(self, row):
+        self._tail.append(row)
+
+    def get(self, i, field):
+        if i < self._size:
+            return self._columns[field].item(i)
+        return self._tail[i - self._size][field]
+
+    def row(self, i):
+        if i < self._size:
+            return tuple(column.item(i) for column in self._columns)
+        return self._tail[i - self._size]
+
+    def set(self, i, field, value):
+        if i < self._size:
+            self._columns[field][i] = value
+        else:
+            row = self._tail[i - self._size]
+            self._tail[i - self._size] = row[:field] + (value,) + row[field + 1:]
+
+    def column(self, name):
+        return self._columns[self._names.index(name)][:self._size]
+
+    def shrink(self):
+        self._columns = [column[:self._size].copy() for column in self._columns]
+
+    def nbytes(self):
+        return sum(column.nbytes for column in self._columns)
+
+    def flush(self):
+        if len(self._tail) == 0:
+            return
+        size = self._size + len(self._tail)
+        capacity = len(self._columns[0])
+        if size > capacity:
+            capacity = max(size, 2 * capacity)
+            for i, column in enumerate(self._columns):
+                grown = np.zeros(capacity, dtype = column.dtype)
+                grown[:self._size] = column[:self._size]
+                self._columns[i] = grown
+        for column, values in zip(self._columns, zip(*self._tail)):
+            column[self._size:size] = values
+        self._size = size
+        self._tail = []
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Serializers that write and read results in the cache.
+"""
+
+import json
+import pickle
+import struct
+
+import numpy as np
+
+class PickleSerializer(object):
+    '''Stores any picklable result with pickle. Used when no other serializer applies.'''
+    extension = ".pkl"
+
+    def can_store(self, out):
+        return True
+
+    def store(self, out, f):
+        pickle.dump(out, f)
+
+    def load(self, filename):
+        with open(filename, 'rb') as f:
+            return pickle.load(f)
+
+    def load_stream(self, f):
+        return pickle.load(f)
+
+class NumpySerializer(object):
+    '''Stores numpy arrays as .npy files, loaded as read only memory maps.
+
+    Only plain np.ndarray results are stored, not subclasses. Loading does not read the array, pages are read from disk when they are
+    accessed.
+    '''
+    extension = ".npy"
+
+    def can_store(self, out):
+        # Subclasses such as masked arrays or matrices are pickled to keep their type
+        return type(out) == np.ndarray and not out.dtype.hasobject
+
+    def store(self, out, f):
+        np.save(f, out, allow_pickle = False)
+
+    def load(self, filename):
+        return np.load(filename, mmap_mode = 'r', allow_pickle = False)
+
+    def load_stream(self, f):
+        return np.lib.format.read_array(f, allow_pickle = False)
+
+class NumpyDictSerializer(object):
+    '''Stores dicts of numpy arrays, loaded as dicts of read only memory maps.
+
+    The file has a json header describing each array, followed by the array
+    data aligned to 64 bytes:
+    b'TINCNPD1', header size (uint32 little endian), header, data.
+    '''
+    extension = ".npd"
+    _MAGIC = b'TINCNPD1'
+    _ALIGNMENT = 64
+
+    def can_store(self, out):
+        return type(out) == dict and len(out) > 0 \
+            and all(type(key) == str and type(value) == np.ndarray and not value.dtype.hasobject
+                    for key, value in out.items())
+
+    def store(self, out, f):
+        arrays = {}
+        offset = 0
+        for key, value in out.items():
+            offset = (offset + self._ALIGNMENT - 1) // self._ALIGNMENT * self._ALIGNMENT
+            arrays[key] = {"descr": np.lib.format.dtype_to_descr(value.dtype),
+                           "shape": list(value.shape),
+                           "offset": offset}
+            offset += value.nbytes
+        header = json.dumps(arrays).encode()
+        # Data starts aligned
+        data_start = len(self._MAGIC) + 4 + len(header)
+        padding = -data_start % self._ALIGNMENT
+        header += b' ' * padding
+        f.write(self._MAGIC)
+        f.write(struct.pack('<I', len(header)))
+        f.write(header)
+        position = 0
+        for key, value in out.items():
+            f.write(b'\0' * (arrays[key]["offset"] - position))
+            f.write(np.ascontiguousarray(value).tobytes())
+            position = arrays[key]["offset"] + value.nbytes
+
+    def load(self, filename):
+        with open(filename, 'rb') as f:
+            if f.read(len(self._MAGIC)) != self._MAGIC:
+                raise ValueError(f"{filename} is not an array dict file")
+            header_size = struct.unpack('<I', f.read(4))[0]
+            arrays = json.loads(f.read(header_size).decode())
+        data_start = len(self._MAGIC) + 4 + header_size
+        out = {}
+        for key, desc in arrays.items():
+            dtype = np.lib.format.descr_to_dtype(desc["descr"])
+            shape = tuple(desc["shape"])
+            if dtype.itemsize == 0 or 0 in shape:
+                # Empty arrays can't be memory mapped
+                out[key] = np.empty(shape, dtype = dtype)
+            else:
+                array = np.memmap(filename, dtype = dtype, mode = 'r',
+                                  offset = data_start + desc["offset"], shape = shape if len(shape) > 0 else (1,))
+                out[key] = array if len(shape) > 0 else array.reshape(())
+        return out
+
+    def load_stream(self, f):
+        if f.read(len(self._MAGIC)) != self._MAGIC:
+            raise ValueError("Not an array dict file")
+        header_size = struct.unpack('<I', f.read(4))[0]
+        arrays = json.loads(f.read(header_size).decode())
+        out = {}
+        position = 0
+        for key, desc in sorted(arrays.items(), key = lambda item: item[1]["offset"]):
+            f.read(desc["offset"] - position)
+            array = np.empty(tuple(desc["shape"]), dtype = np.lib.format.descr_to_dtype(desc["descr"]))
+            _read_into(f, array)
+            position = desc["offset"] + array.nbytes
+            out[key] = array
+        # Keep the order the arrays were stored in
+        return {key: out[key] for key in arrays.keys()}
+
+# Tried in order when storing a result. The last one must accept any result
+cache_serializers = [NumpySerializer(), NumpyDictSerializer(), PickleSerializer()]
+
+def register_cache_serializer(serializer):
+    '''Add a serializer for results stored in the cache.
+
+    Serializers have an 'extension' attribute with the file extension they
+    write, and can_store(out), store(out, f) and load(filename) methods.
+    Results are only compressed if the serializer also has a load_stream(f)
+    method, which reads a result from a file object. See
+    :class:`tinc.cache_compression.CacheCompression`.
+    Registered serializers take precedence over the built in ones.
+    '''
+    cache_serializers.insert(0, serializer)
+
+def serializer_for_result(out):
+    for serializer in cache_serializers:
+        if serializer.can_store(out):
+            return serializer
+
+def _read_into(f, array, chunk_size = 1024 * 1024):
+    # Read the array data from a file object in chunks, without an extra copy of the array
+    if array.nbytes == 0:
+        return
+    data = array.reshape(-1).view(np.uint8)
+    position = 0
+    while position < len(data):
+        count = f.readinto(memoryview(data[position:position + chunk_size]))
+        if not count:
+            raise ValueError("Array dict file is truncated")
+        position += count
+
+def serializer_for_file(filename):
+    for serializer in cache_serializers:
+        if filename.endswith(serializer.extension):
+            return serializer
+    # Files without a known extension were written by pickle
+    return PickleSerializer()
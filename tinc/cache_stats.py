@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Statistics on the use of a cache.
+"""
+
+import bisect
+import threading
+
+class LatencyHistogram(object):
+    '''Histogram of latencies in seconds.
+
+    Buckets grow in a 1, 2, 5 sequence, from 10 microseconds to 100 seconds.
+    Latencies above the last bucket are counted in an overflow bucket.
+    '''
+    bounds = [m * 10.0**e for e in range(-5, 2) for m in (1, 2, 5)] + [100.0]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, latency):
+        self.counts[bisect.bisect_left(self.bounds, latency)] += 1
+        self.count += 1
+        self.total += latency
+        self.max = max(self.max, latency)
+
+    def percentile(self, percentile):
+        '''Upper bound of the bucket that contains the percentile, or None if empty'''
+        if self.count == 0:
+            return None
+        target = self.count * percentile / 100.0
+        accumulated = 0
+        for i, count in enumerate(self.counts):
+            accumulated += count
+            if count > 0 and accumulated >= target:
+                return self.bounds[i] if i < len(self.bounds) else self.max
+        return self.max
+
+    def report(self):
+        '''Returns a dict with count, mean, max, percentiles and the non empty buckets as (upper bound, count)'''
+        return {"count": self.count,
+                "mean": self.total / self.count if self.count > 0 else None,
+                "max": self.max,
+                "percentiles": {p: self.percentile(p) for p in (50, 90, 99)},
+                "buckets": [(self.bounds[i] if i < len(self.bounds) else float('inf'), count)
+                            for i, count in enumerate(self.counts) if count > 0]}
+
+class CacheStats(object):
+    '''Lookups, hits, misses, bytes read and written and latencies of a cache.
+
+    Counts are kept in memory since the cache manager was created or
+    reset() was called. Hit counts and last access time per entry are
+    stored with the entries, in the cache metadata.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.lookups = 0
+            self.hits = 0
+            self.misses = 0
+            self.bytes_read = 0
+            self.bytes_written = 0
+            self.load_latency = LatencyHistogram()
+            self.store_latency = LatencyHistogram()
+
+    def record_lookup(self, hit):
+        with self._lock:
+            self.lookups += 1
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def record_load(self, size, latency):
+        with self._lock:
+            self.bytes_read += size
+            self.load_latency.record(latency)
+
+    def record_store(self, size, latency):
+        with self._lock:
+            self.bytes_written += size
+            self.store_latency.record(latency)
+
+    def report(self):
+        with self._lock:
+            return {"lookups": self.lookups,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "hit_rate": self.hits / self.lookups if self.lookups > 0 else None,
+                    "bytes_read": self.bytes_read,
+                    "bytes_written": self.bytes_written,
+                    "load_latency": self.load_latency.report(),
+                    "store_latency": self.store_latency.report()}
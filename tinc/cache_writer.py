@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+Write-behind of results to the cache, in a background thread.
+"""
+
+import atexit
+import collections
+import os
+import sys
+import threading
+import time
+import traceback
+
+class CacheWriter(object):
+    '''Writes results to the cache in a background thread.
+
+    Results are queued with submit() and written in order by a single
+    writer thread, so the caller can continue computing while the previous
+    results are stored. Results waiting to be written are kept in memory and
+    can be retrieved with get(), so they are found before they reach the
+    cache. The total size of the queued results is kept under max_bytes:
+    submit() blocks until the writer catches up if the budget is exceeded.
+
+    The write functions passed to submit() are responsible for making the
+    result file durable before publishing its cache entry, so that a crash
+    never leaves an entry pointing to an incomplete file. The on_idle
+    function is called when the queue becomes empty, or every
+    on_idle_interval seconds while it stays busy. It is meant to write the
+    cache metadata once for a batch of results instead of once per result.
+
+    Results are not copied, so they must not be modified after being
+    submitted. Results still queued when the interpreter exits are written
+    before it exits.
+
+    :param on_idle: (optional) Function called by the writer thread when the queue becomes empty
+    :param max_bytes: Maximum total size of the results waiting to be written
+    :param on_idle_interval: Maximum time in seconds between calls to on_idle while results are being written
+    '''
+    def __init__(self, on_idle = None, max_bytes = 256 * 1024 * 1024, on_idle_interval = 5.0):
+        self.on_idle = on_idle
+        self.max_bytes = max_bytes
+        self.on_idle_interval = on_idle_interval
+        self.errors = 0
+        self._queue = collections.deque()
+        # key -> list of results queued for that key, oldest first
+        self._pending = {}
+        self._bytes = 0
+        self._writing = False
+        self._closed = False
+        self._last_idle = time.monotonic()
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target = self._run, name = "tinc-cache-writer", daemon = True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def submit(self, key, result, size, write):
+        '''Queue a result to be written.
+
+        Blocks while the results already queued exceed max_bytes. A result
+        larger than max_bytes waits until the queue is empty.
+
+        :param key: Hashable key the result can be retrieved with through get() until it is written
+        :param result: The result
+        :param size: Estimated size of the result in bytes, see result_size()
+        :param write: Function called without arguments by the writer thread to store the result
+        '''
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("CacheWriter is closed")
+            while self._bytes > 0 and self._bytes + size > self.max_bytes:
+                self._condition.wait()
+            self._queue.append((key, result, size, write))
+            self._pending.setdefault(key, []).append(result)
+            self._bytes += size
+            self._condition.notify_all()
+
+    def call_when_written(self, function):
+        '''Call function in the writer thread once the results submitted so far are written'''
+        with self._condition:
+            if not self._queue and not self._writing:
+                call_now = True
+            else:
+                call_now = False
+                self._queue.append((None, None, 0, function))
+                self._condition.notify_all()
+        if call_now:
+            function()
+
+    def get(self, key):
+        '''Returns a tuple (found, result) with the last result queued for key and not yet written'''
+        with self._condition:
+            results = self._pending.get(key)
+            if results:
+                return True, results[-1]
+            return False, None
+
+    def flush(self, timeout = None):
+        '''Wait until all queued results are written and on_idle has been called
+
+        :param timeout: (optional) Maximum time to wait in seconds
+        :returns: True if the queue was flushed, False if the timeout expired
+        '''
+        if threading.current_thread() is self._thread:
+            raise RuntimeError("flush() can't be called from the writer thread")
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._queue and not self._writing, timeout)
+
+    def close(self):
+        '''Write all queued results and stop the writer thread'''
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+
+    def pending_count(self):
+        '''Number of results waiting to be written'''
+        with self._condition:
+            return sum(len(results) for results in self._pending.values())
+
+    def pending_bytes(self):
+        '''Estimated size in bytes of the results waiting to be written'''
+        return self._bytes
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._queue and not self._closed:
+                    self._condition.wait()
+                if not self._queue:
+                    return
+                key, result, size, write = self._queue.popleft()
+                self._writing = True
+            try:
+                write()
+            except:
+                self.errors += 1
+                print("ERROR writing result to cache")
+                traceback.print_exc()
+            with self._condition:
+                if key is not None:
+                    results = self._pending[key]
+                    results.pop(0)
+                    if not results:
+                        del self._pending[key]
+                self._bytes -= size
+                idle = not self._queue or time.monotonic() - self._last_idle >= self.on_idle_interval
+                # Submitters waiting for the memory budget can continue
+                self._condition.notify_all()
+            if idle and self.on_idle is not None:
+                try:
+                    self.on_idle()
+                except:
+                    print("ERROR writing cache metadata")
+                    traceback.print_exc()
+                self._last_idle = time.monotonic()
+            with self._condition:
+                self._writing = False
+                self._condition.notify_all()
+
+def result_size(result):
+    '''Estimated size of a result in bytes, for the memory budget of a CacheWriter
+
+    Uses nbytes for numpy arrays and similar, and sys.getsizeof() of the
+    result and its items for lists, tuples and dicts. Other results are
+    estimated with sys.getsizeof(), which does not include referenced objects.
+    '''
+    if hasattr(result, 'nbytes'):
+        return int(result.nbytes)
+    size = sys.getsizeof(result)
+    if isinstance(result, (list, tuple)):
+        size += sum(result_size(item) for item in result)
+    elif isinstance(result, dict):
+        size += sum(result_size(k) + result_size(v) for k, v in result.items())
+    return size
+
+def _fsync_directory(directory):
+    # Directories can't be opened for fsync on Windows, where the rename is
+    # made durable with the file
+    if os.name == 'nt':
+        return
+    fd = os.open(directory if directory != '' else '.', os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
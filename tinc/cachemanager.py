@@ -5,22 +5,43 @@ Created on Thu Oct 15 14:32:03 2020
 @author: Andres
 """
 
+import atexit
+import datetime
+import hashlib
+import heapq
 import json
 import os, shutil
 import jsonschema
 import threading
+import time
+import weakref
 
 import traceback
 
+from filelock import FileLock
+
 from typing import NamedTuple, List
 
 from .variant import VariantType
 # Causes cyclic import issue...
 #from .parameter import to_variant
 from .distributed_path import DistributedPath
+from .file_fingerprint import default_fingerprinter
+from .cache_stats import CacheStats
 
 TINC_META_VERSION_MAJOR = 1
-TINC_META_VERSION_MINOR = 0
+TINC_META_VERSION_MINOR = 1
+# Entry fields added in minor version 1. Metadata without them is written as
+# version 1.0, so it can still be read by the C++ implementation
+_META_VERSION_1_1_FIELDS = ("lastAccess", "compression")
+
+# Layouts of the cache files in the cache directory. 'flat' names files after
+# the function and its arguments, 'sharded' after source_info_hash() in two
+# levels of subdirectories, and 'content' after a hash of their content in
+# BLOB_DIRECTORY, so entries with identical results share a single file
+CACHE_FILE_LAYOUTS = ('sharded', 'flat', 'content')
+
+BLOB_DIRECTORY = "blobs/"
 
 # C++ cache structs - they are used as NamedTuple here
 class UserInfo(NamedTuple):
@@ -69,12 +90,124 @@ class CacheEntry(NamedTuple):
     source_info: SourceInfo = SourceInfo()
     cache_hits: int = 0
     stale: bool = False
+    last_access: str = ''
+    compression: str = ''
+
+# Variant types that hold the same kind of value are matched as equal in the cache,
+# e.g. an argument stored as VARIANT_INT32 matches the same value as VARIANT_INT64
+_VARIANT_TYPE_FAMILIES = {
+    VariantType.VARIANT_INT8: VariantType.VARIANT_INT64,
+    VariantType.VARIANT_INT16: VariantType.VARIANT_INT64,
+    VariantType.VARIANT_INT32: VariantType.VARIANT_INT64,
+    VariantType.VARIANT_INT64: VariantType.VARIANT_INT64,
+    VariantType.VARIANT_UINT8: VariantType.VARIANT_INT64,
+    VariantType.VARIANT_UINT16: VariantType.VARIANT_INT64,
+    VariantType.VARIANT_UINT32: VariantType.VARIANT_INT64,
+    VariantType.VARIANT_UINT64: VariantType.VARIANT_INT64,
+    VariantType.VARIANT_FLOAT: VariantType.VARIANT_DOUBLE,
+    VariantType.VARIANT_DOUBLE: VariantType.VARIANT_DOUBLE,
+    }
+
+def _hashable(value):
+    if type(value) == list or type(value) == tuple:
+        return tuple(_hashable(v) for v in value)
+    return value
+
+def _normalized_value(nctype, value):
+    family = _VARIANT_TYPE_FAMILIES.get(nctype, nctype)
+    try:
+        # Values read from json or passed as numpy scalars are converted to a
+        # single python type per family
+        if family == VariantType.VARIANT_INT64:
+            value = int(value)
+        elif family == VariantType.VARIANT_DOUBLE:
+            value = float(value)
+    except (TypeError, ValueError):
+        pass
+    return int(family), _hashable(value)
+
+def source_info_key(source_info):
+    '''Returns a hashable key for a SourceInfo
+
+    Two SourceInfo objects that find_cache() considers a match produce the same
+    key. Argument and dependency order does not affect the key, and values are
+    compared by type family (integer, floating point, etc.) rather than by exact
+    variant type. The paths of file dependencies are part of the key, but not
+    their fingerprints, which find_cache() checks separately.
+    '''
+    return _source_key(source_info.type, source_info.tinc_id, source_info.command_line_arguments,
+                       [(a.id, a.value.nctype, a.value.value) for a in source_info.arguments],
+                       [(a.id, a.value.nctype, a.value.value) for a in source_info.dependencies],
+                       [_file_dependency_path(f.file.protocol_id, f.file.root_path, f.file.relative_path, f.file.filename)
+                        for f in source_info.file_dependencies if f.file.filename != ''])
+
+def _source_key(type, tinc_id, command_line_arguments, arguments, dependencies, file_dependencies = []):
+    # source_info_key() from the fields of a SourceInfo. Arguments and
+    # dependencies are lists of (id, nctype, value), file dependencies a list
+    # of paths from _file_dependency_path()
+    args = sorted([(id,) + _normalized_value(nctype, value) for id, nctype, value in arguments],
+                  key = repr)
+    deps = sorted([(id,) + _normalized_value(nctype, value) for id, nctype, value in dependencies],
+                  key = repr)
+    key = (type, tinc_id, command_line_arguments, tuple(args), tuple(deps))
+    if len(file_dependencies) > 0:
+        # Only added when present, so keys of entries without file
+        # dependencies are unchanged
+        key += (tuple(sorted(file_dependencies)),)
+    return key
+
+def _file_dependency_path(protocol_id, root_path, relative_path, filename):
+    return protocol_id + ":" + root_path + relative_path + filename
+
+def _json_source_key(entry):
+    # source_info_key() of an entry in the json metadata format
+    source_info = entry["sourceInfo"]
+    return _source_key(source_info["type"], source_info["tincId"], source_info["commandLineArguments"],
+                       [(a["id"], a["nctype"], a["value"]) for a in source_info["arguments"]],
+                       [(a["id"], a["nctype"], a["value"]) for a in source_info["dependencies"]],
+                       [_file_dependency_path(f["file"]["protocolId"], f["file"]["rootPath"],
+                                              f["file"]["relativePath"], f["file"]["filename"])
+                        for f in source_info["fileDependencies"] if f["file"]["filename"] != ''])
+
+def source_info_hash(source_info):
+    '''Returns a hex digest of source_info_key()
+
+    Used to name cache files in the sharded layout.
+    '''
+    return hashlib.sha1(repr(source_info_key(source_info)).encode()).hexdigest()
+
+def shard_directory(file_hash):
+    '''Returns the directory of the sharded layout for a hash, relative to the cache directory, e.g. 'ab/cd/' '''
+    return file_hash[0:2] + "/" + file_hash[2:4] + "/"
+
+def blob_directory(content_hash):
+    '''Returns the directory of a file in the content layout, relative to the cache directory, e.g. 'blobs/ab/cd/' '''
+    return BLOB_DIRECTORY + shard_directory(content_hash)
+
+def cache_file_name(file_dependency):
+    '''Returns the path of a file of a cache entry, relative to the cache directory'''
+    return file_dependency.file.relative_path + file_dependency.file.filename
 
-# TODO implement a file based mutex (perhaps using file lock) to protect usage by multiple users
 class CacheManager(object):
+    '''Manages the metadata of the cache entries in a cache directory.
+
+    Several processes, on one or many machines, can share a cache directory.
+    Writes to the metadata file are done under a file lock, and merge the
+    entries other processes have written since it was last read with the
+    changes made by this process (entries appended and removed, and hits). The metadata file is replaced atomically, so
+    readers never see a partially written file.
+
+    Hit counts and access times recorded by find_cache() are written with
+    the next change to the metadata, at most access_write_interval seconds
+    after they happen, and by close(), which is also called when the
+    interpreter exits.
+
+    :param directory: Cache directory
+    :param metadata_file: Name of the metadata file in the cache directory
+    '''
     def __init__(self, directory = "python_cache", metadata_file = "tinc_cache.json"):
-        if not os.path.exists(directory):
-            os.makedirs(directory)
+        # Other processes might be creating it at the same time
+        os.makedirs(directory, exist_ok = True)
         self._cache_root = ''
         self._cache_dir = directory
         self._metadata_file = metadata_file
@@ -82,187 +215,539 @@ class CacheManager(object):
             self._cache_root += '/'
         if len(self._cache_dir) > 0 and not self._cache_dir[-1] == "/":
             self._cache_dir += '/'
-        self._validator = None
-        self._entries = []
+        # Entries by id, in insertion order. See CacheEntryStore
+        self._next_entry_id = 0
+        # Incremented when entries are added or removed
+        self._generation = 0
+        self._entries = CacheEntryStore(self._next_entry_id)
+        # Map of _index_key() to the id, or list of ids, of the entries with
+        # that key. The first one is used
+        self._index = {}
+        # Cache size budget. See set_cache_budget()
+        self._max_bytes = None
+        self._max_entries = None
+        self._eviction_policy = 'lru'
+        self._eviction_queue = None
+        self._fingerprinter = default_fingerprinter
+        self._stats = CacheStats()
+        # Changes not yet written to the metadata file. Entries added and
+        # removed by _entry_identity(), hits by entry id
+        self._pending_added = {}
+        self._pending_removed = set()
+        self._pending_hits = {}
+        # Maximum time in seconds hit counts are kept only in memory
+        self.access_write_interval = 60.0
+        self._last_write = time.monotonic()
+        # (optional) Function called with the source_info_key() of each entry
+        # removed, by this process or by others when the metadata is
+        # reloaded, and with None when the cache is cleared
+        self.on_remove = None
+        # Path and stat of the metadata file when it was last read or written
+        self._disk_signature = None
+        self._metadata_lock = None
         self.debug = False
         self.mutex = threading.Lock()
-        try:
-            schema_path = os.path.join(
-                    os.path.dirname(os.path.abspath(__file__)),
-                    'tinc_cache_schema.json')
-            with open(schema_path) as f:
-                schema = json.load(f)
-                self._validator = jsonschema.Draft7Validator(schema)
-                print("Validating json with " + schema_path)
-        except:
-            print("ERROR loading cache schema. Not validating schema.")
+        self._validator = _schema_validator()
         if os.path.exists(self.cache_directory() + self._metadata_file):
             self.update_from_disk()
         else:
             self.write_to_disk() # Generate empty cache file.
+        _open_cache_managers.add(self)
 
     def append_entry(self, entry):
         self._lock()
-        self._entries.append(entry)
+        entry_id = self._add_entry(entry)
+        self._pending_added[_entry_identity(entry)] = entry
+        if self._eviction_queue is not None:
+            self._evict(keep_id = entry_id)
+            self._compact_entries()
         self._unlock()
         
     def entries(self, count = 0):
+        '''Returns the entries in the cache, oldest first
+
+        Entries are returned as :class:`tinc.cache_entry_store.CacheEntryView`
+        objects, which have the attributes of CacheEntry.
+
+        :param count: If not 0, only the last count entries are returned
+        '''
         self._lock()
-        if count == 0 or count >= len(self._entries):
-            e = self._entries
-        else:
-            e = self._entries[len(self._entries) - count:]
+        e = list(self._entries.values())
         self._unlock()
-        return e
+        if count == 0 or count >= len(e):
+            return e
+        return e[len(e) - count:]
 
     def find_cache(self, source_info, verify_hash = True):
+        '''Find the cache files for a SourceInfo
+
+        The hit count and last access time of the entry found are updated.
+        File dependencies are checked with a :class:`tinc.file_fingerprint.FileFingerprinter`.
+
+        :param source_info: SourceInfo to match
+        :param verify_hash: If True, entries whose file dependencies have changed are removed with their files and ignored
+        :returns: A list of file names relative to the cache directory, empty if not found
+        '''
+        key = source_info_key(source_info)
         self._lock()
-        for entry in self._entries:
-            if entry.source_info.command_line_arguments == source_info.command_line_arguments \
-                and entry.source_info.tinc_id == source_info.tinc_id \
-                and entry.source_info.type == source_info.type:
-                    entry_args = entry.source_info.arguments[:]
-                    entry_deps = entry.source_info.dependencies[:]
-                    if len(source_info.arguments) == len(entry_args) \
-                        and len(source_info.dependencies) == len(entry_deps):
-                            match_count = 0
-                            for src_arg in source_info.arguments:
-                                for arg in entry_args:
-                                    if src_arg.id == arg.id:
-                                        if type(arg.value) == type(src_arg.value) \
-                                            and arg.value == src_arg.value:
-                                                entry_args.remove(arg)
-                                                match_count += 1
-                                                break
-                                        
-                            for src_dep in source_info.dependencies:
-                                for dep in entry_deps:
-                                    if src_dep.id == dep.id:
-                                        if type(dep.value) == type(src_dep.value) \
-                                            and dep.value == src_dep.value:
-                                                entry_deps.remove(dep)
-                                                match_count += 1
-                                                break
-                            if match_count == (len(source_info.arguments) + len(source_info.dependencies)) \
-                                and len(entry_args) == 0 and len(entry_deps) == 0:
-                                    self._unlock()
-                                    return [f.file.filename for f in entry.files]
-                    else:
-                        print(f"Warning, cache entry found, but argument size mismatch: {source_info.arguments}  --  {entry_args}")
-        
+        candidates = self._candidates(key)
+        self._unlock()
+        found = self._select_valid([candidates], verify_hash)[0]
+        if found is None:
+            self._stats.record_lookup(False)
+            return []
+        self._lock()
+        entry_id = found[0]
+        if not entry_id in self._entries:
+            # Evicted in the meantime
+            self._unlock()
+            self._stats.record_lookup(False)
+            return []
+        entry = self._entries[entry_id]
+        self._entries.update(entry_id, cache_hits = entry.cache_hits + 1, last_access = _timestamp())
+        self._pending_hits[entry_id] = (self._pending_hits.get(entry_id, (0, ''))[0] + 1, entry.last_access)
+        if self._eviction_queue is not None:
+            self._eviction_queue.touch(entry_id, entry)
         self._unlock()
-        return []
+        self._stats.record_lookup(True)
+        if time.monotonic() - self._last_write >= self.access_write_interval:
+            self.write_to_disk()
+        return [cache_file_name(f) for f in entry.files]
 
-    def clear_cache(self):
-        try:
-            self.update_from_disk()
-        except:
-            traceback.print_exc()
-            print("Failed to load cache, cached files will not be removed automatically")
+    def has_entry(self, source_info):
+        '''Returns True if the cache has an entry for a SourceInfo
+
+        The metadata file is not read. Entries written or removed by other
+        processes are seen once it is reloaded, e.g. by update_from_disk() or
+        write_to_disk(). File dependencies are not checked and the entry is
+        not counted as accessed.
+
+        :param source_info: SourceInfo to match
+        '''
+        key = source_info_key(source_info)
         self._lock()
-        for entry in self._entries:
-            for f in entry.files:
-                full_name = self.cache_directory() + f.file.filename
+        found = len(self._candidates(key)) > 0
+        self._unlock()
+        return found
+
+    def find_entries(self, source_infos, verify_hash = True):
+        '''Find cache entries for many SourceInfo objects at once
+
+        Unlike find_cache(), this does not count as an access to the entries,
+        and is not counted in stats().
+        File dependencies of all entries found are checked together.
+
+        :param source_infos: A list of SourceInfo
+        :param verify_hash: If True, entries whose file dependencies have changed are removed with their files and ignored
+        :returns: A list with the matching CacheEntry or None for each SourceInfo
+        '''
+        keys = [source_info_key(src_info) for src_info in source_infos]
+        self._lock()
+        candidates = [self._candidates(key) for key in keys]
+        self._unlock()
+        return [None if found is None else found[1] for found in self._select_valid(candidates, verify_hash)]
+
+    def _select_valid(self, candidate_lists, verify_hash):
+        # For each list of (entry id, entry) candidates, returns the first one
+        # whose file dependencies are unchanged, or None. Stale candidates are
+        # removed, so they are not checked again
+        selected = [candidates[0] if len(candidates) > 0 else None for candidates in candidate_lists]
+        if not verify_hash:
+            return selected
+        file_dependencies = {}
+        for found in selected:
+            if found is not None:
+                for fdep in _entry_file_dependencies(found[1]):
+                    file_dependencies[_file_dependency_key(fdep)] = fdep
+        unchanged = dict(zip(file_dependencies.keys(),
+                             self._fingerprinter.check_all(file_dependencies.values())))
+        for i, found in enumerate(selected):
+            if found is None:
+                continue
+            if all(unchanged[_file_dependency_key(fdep)] for fdep in _entry_file_dependencies(found[1])):
+                continue
+            self._remove_stale(found[0])
+            # Try other entries for the same source info
+            selected[i] = None
+            for candidate in candidate_lists[i][1:]:
+                if all(self._fingerprinter.check_all(_entry_file_dependencies(candidate[1]))):
+                    selected[i] = candidate
+                    break
+                self._remove_stale(candidate[0])
+        return selected
+
+    def _remove_stale(self, entry_id):
+        self._lock()
+        if entry_id in self._entries:
+            if self.debug:
+                print(f"Removing stale cache entry: {self._entries[entry_id].files}")
+            self._remove_entry(entry_id)
+            self._compact_entries()
+        self._unlock()
+
+    def fingerprint(self, source_info):
+        '''Returns a copy of source_info with the current fingerprint of its file dependencies
+
+        Fingerprints are recorded when storing an entry, and checked by find_cache().
+        '''
+        return source_info._replace(file_dependencies = self._fingerprinter.fingerprint_all(source_info.file_dependencies))
+
+    def set_cache_budget(self, max_bytes = None, max_entries = None, policy = 'lru'):
+        '''Limit the size of the cache
+
+        When appending an entry takes the cache over budget, entries are
+        evicted and their files deleted until it is within budget again. The
+        size of an entry is the size of its files as recorded in the metadata.
+        Files shared by several entries count towards the size of each, so the
+        budget is conservative for caches in the content layout, and a shared
+        file is only deleted with the last entry that references it.
+
+        :param max_bytes: Maximum total size of the cache files, or None for no limit
+        :param max_entries: Maximum number of entries, or None for no limit
+        :param policy: 'lru' to evict the least recently used entries first, 'lfu' to evict the least frequently used (fewest cache hits) first
+        '''
+        if policy not in ('lru', 'lfu'):
+            raise ValueError("policy must be 'lru' or 'lfu'")
+        self._lock()
+        self._max_bytes = max_bytes
+        self._max_entries = max_entries
+        self._eviction_policy = policy
+        self._rebuild_eviction_queue()
+        evicted = 0
+        if self._eviction_queue is not None:
+            evicted = self._evict()
+        self._unlock()
+        if evicted > 0:
+            self.write_to_disk()
+
+    def cache_size(self):
+        '''Returns the total size in bytes of the cache files
+
+        Files shared by several entries are counted once.
+        '''
+        self._lock()
+        files = {cache_file_name(f): f for entry in self._entries.values() for f in entry.files}
+        size = sum([_file_size(self.cache_directory(), f) for f in files.values()])
+        self._unlock()
+        return size
+
+    def entry_count(self):
+        self._lock()
+        count = len(self._entries)
+        self._unlock()
+        return count
+
+    def generation(self):
+        '''Returns a value that changes whenever entries are added or removed
+
+        Used to know when data derived from the entries must be recomputed.
+        '''
+        return self._generation
+
+    def stats(self):
+        '''Returns a dict with statistics on the use of the cache
+
+        Lookups, hits and misses are counted by find_cache(). Bytes read and
+        written and load and store latencies are reported by the code that
+        reads and writes the cache files through record_load() and
+        record_store(). 'entries' and 'disk_bytes' are the current number of
+        entries and size of the cache files. See :class:`tinc.cache_stats.CacheStats`
+        '''
+        stats = self._stats.report()
+        stats["entries"] = self.entry_count()
+        stats["disk_bytes"] = self.cache_size()
+        try:
+            stats["metadata_bytes"] = os.path.getsize(self.cache_directory() + self._metadata_file)
+        except OSError:
+            stats["metadata_bytes"] = 0
+        return stats
+
+    def reset_stats(self):
+        self._stats.reset()
+
+    def record_load(self, size, latency):
+        '''Record reading a result of size bytes from the cache files, which took latency seconds'''
+        self._stats.record_load(size, latency)
+
+    def record_store(self, size, latency):
+        '''Record writing a result of size bytes to the cache files, which took latency seconds'''
+        self._stats.record_store(size, latency)
+
+    def clear_cache(self):
+        with self._file_lock():
+            self._lock()
+            try:
+                self._reload()
+            except:
+                traceback.print_exc()
+                print("Failed to load cache, cached files will not be removed automatically")
+            # Files can be shared by several entries
+            for name in set(cache_file_name(f) for entry in self._entries.values() for f in entry.files):
+                full_name = self.cache_directory() + name
                 try:
                     os.remove(full_name)
                 except:
                     print("ERROR removing cache entry: " + full_name)
-        
-        self._entries = []
-        self._unlock()
-        self.write_to_disk()
+
+            self._entries = CacheEntryStore(self._next_entry_id)
+            self._generation += 1
+            self._index = {}
+            self._clear_pending()
+            self._rebuild_eviction_queue()
+            self._unlock()
+            self._write()
+        if self.on_remove:
+            self.on_remove(None)
+
+    def migrate_to_sharded(self):
+        '''Move the files of the entries in the flat layout to the sharded layout
+
+        Files are moved to 'ab/cd/<hash><extension>' in the cache directory,
+        where <hash> is the source_info_hash() of the entry, and the entries
+        are updated. Use when a cache was written with an earlier version or
+        with file_layout='flat', to avoid having many files in a single
+        directory.
+
+        :returns: The number of files moved
+        '''
+        with self._file_lock():
+            self._lock()
+            moved = 0
+            try:
+                self._reload()
+                entries = []
+                for entry in self._entries.values():
+                    entry, count = _migrate_entry_files(self.cache_directory(), entry)
+                    entries.append(entry)
+                    moved += count
+                self._entries = CacheEntryStore(self._next_entry_id)
+                self._generation += 1
+                self._index = {}
+                for entry in entries:
+                    self._add_entry(entry)
+                self._rebuild_eviction_queue()
+            except:
+                traceback.print_exc()
+                print("ERROR migrating cache files")
+            # The file is locked, so no other process has written since it was read
+            self._unlock()
+            self._write()
+        return moved
 
     def update_from_disk(self):
+        '''Reload the entries from the metadata file
+
+        Changes made by this process that have not been written yet are kept.
+        The file is not read again if it has not changed since it was last read
+        or written.
+        '''
         self._lock()
         try:
-            if os.path.exists(self.cache_directory() + self._metadata_file):
-                with open(self.cache_directory() + self._metadata_file) as f:
-                    try:
-                        j = json.load(f)
-                        if j["tincMetaVersionMajor"] != TINC_META_VERSION_MAJOR or \
-                            j["tincMetaVersionMinor"] != TINC_META_VERSION_MINOR:
-                                print("Invalid cache format")
-                                self._unlock()
-                                return
-                    except:
-                        if self.debug:
-                            traceback.print_exc()
-                        print("Metadata file is not a TINC cache file. Ignoring.")
-                        self._unlock()
-                        return
-                    
-                    if self._validator:
-                        try:
-                            self._validator.validate(j)
-                        except:
-                            print("Cache metadata not valid according to schema. Ignoring.")
-                            self._unlock()
-                            return
-                            
-                    self._entries = []
-                    for entry in j["entries"]:
-                        filenames = []
-                        for fdep in entry["files"]:
-                            filenames.append(FileDependency(file = DistributedPath(filename = fdep["file"]["filename"],
-                                                                            relative_path = fdep["file"]["relativePath"],
-                                                                            root_path = fdep["file"]["rootPath"],
-                                                                            protocol_id = fdep["file"]["protocolId"]),
-                                                    modified = fdep["modified"],
-                                                    size = fdep["size"],
-                                                    hash = fdep["hash"]
-                                                    ))
-                                    
-                        args = []
-                        for a in entry["sourceInfo"]["arguments"]:
-                            args.append(SourceArgument(id = a["id"], 
-                                                    value = VariantValue(nctype = VariantType(a["nctype"]),
-                                                                            value = a["value"])))
-                            
-                        deps = []
-                        for a in entry["sourceInfo"]["dependencies"]:
-                            deps.append(SourceArgument(id = a["id"], 
-                                                    value = VariantValue(nctype = VariantType(a["nctype"]),
-                                                                            value = a["value"])))
-                            
-                        fdeps = []
-                        for fdep in entry["sourceInfo"]["fileDependencies"]:
-                            fdeps.append(FileDependency(file = DistributedPath(filename = fdep["file"]["filename"],
-                                                                            relative_path = fdep["file"]["relativePath"],
-                                                                            root_path = fdep["file"]["rootPath"],
-                                                                            protocol_id = fdep["file"]["protocolId"]),
-                                                    modified = fdep["modified"],
-                                                    size = fdep["size"],
-                                                    hash = fdep["hash"]
-                                                    ))
-
-                        user_info = UserInfo(user_name = entry["userInfo"]["userName"],
-                                            user_hash = entry["userInfo"]["userHash"],
-                                            ip = entry["userInfo"]["ip"],
-                                            port = entry["userInfo"]["port"],
-                                            server = entry["userInfo"]["server"])
-                        
-                        source_info = SourceInfo(type = entry["sourceInfo"]["type"],
-                                                tinc_id = entry["sourceInfo"]["tincId"],
-                                                command_line_arguments = entry["sourceInfo"]["commandLineArguments"],
-                                                working_path_rel = entry["sourceInfo"]["workingPath"]["relativePath"],
-                                                working_path_root = entry["sourceInfo"]["workingPath"]["rootPath"],
-                                                arguments = args,
-                                                dependencies = deps,
-                                                file_dependencies = fdeps)
-                        
-                        new_entry = CacheEntry(timestamp_start = entry["timestamp"]["start"],
-                                            timestamp_end = entry["timestamp"]["end"],
-                                            files = filenames,
-                                            user_info = user_info,
-                                            source_info = source_info,
-                                            cache_hits = entry["cacheHits"],
-                                            stale = entry["stale"])
-                        self._entries.append(new_entry)
+            self._reload()
         except:
-            print("Writing entry failed")
-            
+            traceback.print_exc()
+            print("ERROR reading cache metadata")
         self._unlock()
 
+    def _reload(self):
+        # Replace the entries with the ones in the metadata file, plus the
+        # pending changes. Must be called with the mutex held
+        path = self.cache_directory() + self._metadata_file
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return
+        signature = (path, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if signature == self._disk_signature:
+            return
+        with open(path, 'rb') as f:
+            data = f.read()
+        try:
+            j = json.loads(data)
+        except:
+            if self.debug:
+                traceback.print_exc()
+            print("Metadata file is not a TINC cache file. Ignoring.")
+            return
+        # Metadata written by a CacheManager was valid when it was written,
+        # so it is only validated against the schema if it has changed since
+        validator = self._validator
+        if validator is not None and _read_digest(path) == hashlib.sha1(data).hexdigest():
+            validator = None
+        j_entries = _metadata_entries(j, validator, self.debug)
+        if j_entries is None:
+            return
+        self._disk_signature = signature
+        # Pending hits move to the ids of the reloaded entries
+        old_entries = self._entries
+        pending_hits = {_entry_identity(old_entries[entry_id]): hits
+                        for entry_id, hits in self._pending_hits.items() if entry_id in old_entries}
+        self._pending_hits = {}
+        self._entries = CacheEntryStore(self._next_entry_id)
+        self._generation += 1
+        old_index = self._index
+        self._index = {}
+        on_disk = set()
+        has_pending = len(self._pending_added) > 0 or len(self._pending_removed) > 0 \
+            or len(pending_hits) > 0
+        for j_entry in j_entries:
+            key = _json_source_key(j_entry)
+            if has_pending:
+                identity = (key, tuple(f["file"]["relativePath"] + f["file"]["filename"] for f in j_entry["files"]),
+                            j_entry["timestamp"]["start"], j_entry["timestamp"]["end"])
+                on_disk.add(identity)
+                if identity in self._pending_removed:
+                    continue
+                if identity in pending_hits:
+                    self._add_pending_entry(identity, _entry_from_json(j_entry), pending_hits)
+                    continue
+            # Entries are stored without converting them to CacheEntry
+            self._index_entry(_index_key(key), self._entries.add_json(j_entry))
+        for identity, entry in self._pending_added.items():
+            if not identity in on_disk:
+                self._add_pending_entry(identity, entry, pending_hits)
+        self._entries.shrink()
+        self._rebuild_eviction_queue()
+        if self.on_remove:
+            # Entries removed by other processes
+            if len(self._index) == 0 and len(old_index) > 0:
+                self.on_remove(None)
+            else:
+                for key in old_index.keys() - self._index.keys():
+                    entry_ids = old_index[key]
+                    for source_key in set(source_info_key(old_entries[entry_id].source_info)
+                                          for entry_id in (entry_ids if type(entry_ids) == list else [entry_ids])):
+                        self.on_remove(source_key)
+
+    def _add_pending_entry(self, identity, entry, pending_hits):
+        # Adds an entry with its hits not yet written, which remain pending
+        # under its new id
+        entry_id = self._add_entry(entry)
+        if identity in pending_hits:
+            hits, last_access = pending_hits[identity]
+            self._pending_hits[entry_id] = pending_hits[identity]
+            self._entries.update(entry_id, cache_hits = entry.cache_hits + hits,
+                                 last_access = max(entry.last_access, last_access))
+
+    def _clear_pending(self):
+        self._pending_added = {}
+        self._pending_removed = set()
+        self._pending_hits = {}
+
+    def _add_entry(self, entry):
+        entry_id = self._entries.add(entry)
+        self._index_entry(_index_key(source_info_key(entry.source_info)), entry_id)
+        if self._eviction_queue is not None:
+            self._eviction_queue.add(entry_id, entry, _entry_size(self.cache_directory(), entry))
+        return entry_id
+
+    def _index_entry(self, key, entry_id):
+        self._next_entry_id = entry_id + 1
+        self._generation += 1
+        entry_ids = self._index.get(key)
+        if entry_ids is None:
+            self._index[key] = entry_id
+        elif type(entry_ids) == list:
+            entry_ids.append(entry_id)
+        else:
+            self._index[key] = [entry_ids, entry_id]
+
+    def _remove_entry(self, entry_id):
+        entry = self._entries.pop(entry_id)
+        self._generation += 1
+        self._pending_hits.pop(entry_id, None)
+        identity = _entry_identity(entry)
+        self._pending_added.pop(identity, None)
+        self._pending_removed.add(identity)
+        source_key = source_info_key(entry.source_info)
+        key = _index_key(source_key)
+        entry_ids = [i for i in self._indexed_ids(key) if i != entry_id]
+        if len(entry_ids) > 1:
+            self._index[key] = entry_ids
+        elif len(entry_ids) == 1:
+            self._index[key] = entry_ids[0]
+        else:
+            del self._index[key]
+        if self.on_remove:
+            self.on_remove(source_key)
+        # Entries with the same source info write to the same files, and in
+        # the content layout entries with the same result share their files,
+        # so files are only removed with the last entry that references them
+        for f in entry.files:
+            if f.file.filename == '' \
+                or self._entries.file_references(f.file.relative_path, f.file.filename) > 0:
+                    continue
+            full_name = self.cache_directory() + cache_file_name(f)
+            try:
+                os.remove(full_name)
+            except FileNotFoundError:
+                pass
+            except:
+                print("ERROR removing cache entry: " + full_name)
+        if self._eviction_queue is not None:
+            self._eviction_queue.remove(entry_id)
+
+    def _compact_entries(self):
+        # Removed entries are only marked as removed in the store. Once they
+        # outnumber the others, the entries left are copied to a new store,
+        # which releases the removed ones and the strings only they used.
+        # Entry ids change, views of the old store remain valid. Must be
+        # called with the mutex held
+        if self._entries.removed_count() <= max(_COMPACT_MIN_REMOVED, len(self._entries)):
+            return
+        old_entries = self._entries
+        self._entries = CacheEntryStore(self._next_entry_id)
+        ids = {entry_id: self._entries.add(entry) for entry_id, entry in old_entries.items()}
+        self._entries.shrink()
+        self._next_entry_id += len(ids)
+        self._index = {key: [ids[i] for i in entry_ids] if type(entry_ids) == list else ids[entry_ids]
+                       for key, entry_ids in self._index.items()}
+        self._pending_hits = {ids[entry_id]: hits for entry_id, hits in self._pending_hits.items()}
+        if self._eviction_queue is not None:
+            self._eviction_queue.rename(ids)
+
+    def _candidates(self, key):
+        # List of (entry id, entry) of the entries with a source_info_key().
+        # The index only narrows the search, as different keys can have the
+        # same _index_key(). Must be called with the mutex held
+        candidates = []
+        for entry_id in self._indexed_ids(_index_key(key)):
+            entry = self._entries[entry_id]
+            if source_info_key(entry.source_info) == key:
+                candidates.append((entry_id, entry))
+        return candidates
+
+    def _indexed_ids(self, key):
+        # Ids of the entries with an _index_key(). Must be called with the mutex held
+        entry_ids = self._index.get(key, [])
+        if type(entry_ids) == list:
+            return entry_ids
+        return [entry_ids]
+
+    def _rebuild_eviction_queue(self):
+        if self._max_bytes is None and self._max_entries is None:
+            self._eviction_queue = None
+            return
+        self._eviction_queue = _EvictionQueue(self._eviction_policy)
+        # Oldest access first, so access order is kept
+        for entry_id, entry in sorted(self._entries.items(),
+                                      key = lambda item: item[1].last_access or item[1].timestamp_end):
+            self._eviction_queue.add(entry_id, entry, _entry_size(self.cache_directory(), entry))
+
+    def _evict(self, keep_id = None):
+        # Remove entries until the cache is within budget. Returns the number of entries removed
+        evicted = 0
+        while (self._max_entries is not None and len(self._entries) > self._max_entries) \
+            or (self._max_bytes is not None and self._eviction_queue.total_size > self._max_bytes):
+                entry_id = self._eviction_queue.next_victim(keep_id)
+                if entry_id is None:
+                    break
+                if self.debug:
+                    print(f"Evicting cache entry: {self._entries[entry_id].files}")
+                self._remove_entry(entry_id)
+                evicted += 1
+        return evicted
+
     '''
     Get full cache path
     '''
@@ -270,100 +755,404 @@ class CacheManager(object):
         return self._cache_root + self._cache_dir
                     
     def write_to_disk(self):
+        '''Write the entries to the metadata file
+
+        Entries written by other processes since the file was last read are
+        merged with the changes made by this process, and the cache budget is
+        applied to the merged entries.
+        '''
+        with self._file_lock():
+            self._write()
+
+    def _write(self):
+        # Must be called with the file lock held
         self._lock()
+        j = None
         try:
-            if os.path.exists(self.cache_directory() + self._metadata_file):
-                bak_filename = self.cache_directory() + self._metadata_file + ".bak"
+            self._reload()
+            if self._eviction_queue is not None:
+                self._evict()
+            path = self.cache_directory() + self._metadata_file
+            if os.path.exists(path):
+                bak_filename = path + ".bak"
                 if(os.path.exists(bak_filename)):
                     os.remove(bak_filename) # Is this remove needed?
  
-                shutil.copy(self.cache_directory() + self._metadata_file,
-                    bak_filename)
-
-
-            j = {}
-            j["tincMetaVersionMajor"] = TINC_META_VERSION_MAJOR
-            j["tincMetaVersionMinor"] = TINC_META_VERSION_MINOR
-            j["entries"] = []
-            for entry in self._entries:
-                j_entry = {"timestamp":{"start": entry.timestamp_start, "end" :entry.timestamp_end }}
-                j_entry["files"] = []
-                for fdep in entry.files:
-                    f_entry = {"file": {"filename": fdep.file.filename, 
-                                    "relativePath": fdep.file.relative_path,
-                                    "rootPath": fdep.file.root_path,
-                                    "protocolId": fdep.file.protocol_id},
-                        "modified": fdep.modified,
-                        "size" : fdep.size,
-                        "hash" : fdep.hash}
-                    j_entry["files"].append(f_entry)
-
-
-                j_entry["cacheHits"] = entry.cache_hits
-                j_entry["stale"] = entry.stale
-                j_entry["userInfo"] = {
-                    "userName": entry.user_info.user_name,
-                    "userHash": entry.user_info.user_hash,
-                    "ip": entry.user_info.ip,
-                    "port": entry.user_info.port,
-                    "server": entry.user_info.server
-                    }
-                    
-                args = []
-                for a in entry.source_info.arguments:
-                    args.append({"id" : a.id, 
-                        "nctype" : int(a.value.nctype), "value" : a.value.value})
-                        
-                deps = []
-                for a in entry.source_info.dependencies:
-                    deps.append({"id" : a.id, 
-                        "nctype" : int(a.value.nctype), "value" : a.value.value})
-                    
-                fdeps = []
-                for fdep in entry.source_info.file_dependencies:
-                    dep = {"file": {"filename": fdep.file.filename, 
-                                    "relativePath": fdep.file.relative_path,
-                                    "rootPath": fdep.file.root_path,
-                                    "protocolId": fdep.file.protocol_id},
-                        "modified": fdep.modified,
-                        "size" : fdep.size,
-                        "hash" : fdep.hash}
-                    fdeps.append(dep)
-
-                j_entry["sourceInfo"] = {
-                    "type": entry.source_info.type,
-                    "tincId" : entry.source_info.tinc_id,
-                    "commandLineArguments" : entry.source_info.command_line_arguments,
-                    "workingPath" : {"relativePath":entry.source_info.working_path_rel,
-                                    "rootPath":entry.source_info.working_path_root},
-                    "arguments" : args,
-                    "dependencies" : deps,
-                    "fileDependencies" : fdeps
-                    }
-                # TODO compute CRC
-                #hash = str(zlib.crc32())
-
-                j["entries"].append(j_entry)
-            
-            with open(self.cache_directory() + self._metadata_file, 'w') as f:
-                json.dump(j, f, indent=4)
+                shutil.copy(path, bak_filename)
+
+            j = _metadata_json(self._entries.to_json())
+            # json.dumps() uses the C encoder, which json.dump() and indent don't
+            data = json.dumps(j).encode()
+            tmp_filename = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_filename, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_filename, path)
+            _write_digest(path, hashlib.sha1(data).hexdigest())
+            stat = os.stat(path)
+            self._disk_signature = (path, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            self._clear_pending()
+            self._last_write = time.monotonic()
         except:
             print("ERROR writing cache entry metadata")
             print(j)
             traceback.print_exc()
         self._unlock()
 
+    def close(self):
+        '''Write the changes not yet written to the metadata file, such as hit counts'''
+        self._lock()
+        has_pending = len(self._pending_added) > 0 or len(self._pending_removed) > 0 \
+            or len(self._pending_hits) > 0
+        self._unlock()
+        if has_pending and os.path.isdir(self.cache_directory()):
+            try:
+                self.write_to_disk()
+            except:
+                print("ERROR writing cache entry metadata")
+                traceback.print_exc()
+
     def dump(self):
         #print json metadata
         pass
 
     def _lock(self):
-        # FIXME Implement file locking as well to protect cache metadata from multiple user access
+        # Protects the entries within this process. See _file_lock() for other processes
         self.mutex.acquire()
 
     def _unlock(self):
         self.mutex.release()
 
+    def _file_lock(self):
+        # Protects the metadata file from other processes. The cache directory
+        # can be changed after construction, so the path is checked every time
+        lock_filename = self.cache_directory() + self._metadata_file + ".lock"
+        if self._metadata_lock is None or self._metadata_lock[0] != lock_filename:
+            self._metadata_lock = (lock_filename, FileLock(lock_filename))
+        return self._metadata_lock[1]
+
+
+# Minimum number of removed entries before the entry store is compacted
+_COMPACT_MIN_REMOVED = 1024
+
+# Closed when the interpreter exits, so hit counts are not lost. Registered
+# before any CacheWriter, so queued results are written first
+_open_cache_managers = weakref.WeakSet()
+
+@atexit.register
+def _close_cache_managers():
+    for cache_manager in list(_open_cache_managers):
+        cache_manager.close()
+
+class _EvictionQueue(object):
+    # Priority queue of cache entries in eviction order. Entries are pushed
+    # again when accessed, and outdated heap items are skipped when popping
+    def __init__(self, policy):
+        self.policy = policy
+        self.total_size = 0
+        self._heap = []
+        self._priorities = {}
+        self._sizes = {}
+        self._access_count = 0
+
+    def _priority(self, entry):
+        self._access_count += 1
+        if self.policy == 'lfu':
+            return (entry.cache_hits, self._access_count)
+        return (self._access_count,)
+
+    def add(self, entry_id, entry, size):
+        self._sizes[entry_id] = size
+        self.total_size += size
+        self.touch(entry_id, entry)
+
+    def touch(self, entry_id, entry):
+        priority = self._priority(entry)
+        self._priorities[entry_id] = priority
+        heapq.heappush(self._heap, (priority, entry_id))
+        if len(self._heap) > 2 * len(self._priorities) + 64:
+            self._heap = [(p, i) for i, p in self._priorities.items()]
+            heapq.heapify(self._heap)
+
+    def rename(self, ids):
+        # Replaces the entry ids with ids[entry_id], keeping their order
+        self._priorities = {ids[entry_id]: priority for entry_id, priority in self._priorities.items()}
+        self._sizes = {ids[entry_id]: size for entry_id, size in self._sizes.items()}
+        self._heap = [(priority, entry_id) for entry_id, priority in self._priorities.items()]
+        heapq.heapify(self._heap)
+
+    def remove(self, entry_id):
+        self.total_size -= self._sizes.pop(entry_id)
+        del self._priorities[entry_id]
+
+    def next_victim(self, keep_id = None):
+        kept = None
+        victim = None
+        while len(self._heap) > 0:
+            priority, entry_id = heapq.heappop(self._heap)
+            if self._priorities.get(entry_id) != priority:
+                continue
+            if entry_id == keep_id:
+                kept = (priority, entry_id)
+                continue
+            victim = entry_id
+            break
+        if kept is not None:
+            heapq.heappush(self._heap, kept)
+        return victim
+
+def _file_dependency_key(fdep):
+    return (fdep.file.root_path + fdep.file.relative_path + fdep.file.filename,
+            fdep.modified, fdep.size, fdep.hash)
+
+def _entry_size(directory, entry):
+    return sum([_file_size(directory, f) for f in entry.files])
+
+def _file_size(directory, fdep):
+    if fdep.size > 0:
+        return fdep.size
+    try:
+        return os.path.getsize(directory + cache_file_name(fdep))
+    except OSError:
+        return 0
+
+def _file_extension(filename):
+    # Extension of a cache file in the flat layout, e.g. '.pkl' or '.pkl.zz'
+    end = filename.rfind("_cache")
+    if end >= 0:
+        return filename[end + len("_cache"):]
+    return os.path.splitext(filename)[1]
+
+def _migrate_entry_files(directory, entry):
+    # Returns the entry with its files in the sharded layout, and the number of files moved
+    file_hash = source_info_hash(entry.source_info)
+    files = []
+    moved = 0
+    for i, f in enumerate(entry.files):
+        # Files in the content layout are already sharded
+        if f.file.relative_path == shard_directory(file_hash) or f.file.filename == '' \
+            or f.file.relative_path.startswith(BLOB_DIRECTORY):
+                files.append(f)
+                continue
+        # Entries with more than one file are numbered
+        filename = file_hash + (f"_{i}" if i > 0 else "") + _file_extension(f.file.filename)
+        new_file = f._replace(file = DistributedPath(filename = filename,
+                                                     relative_path = shard_directory(file_hash),
+                                                     root_path = f.file.root_path,
+                                                     protocol_id = f.file.protocol_id))
+        old_path = directory + cache_file_name(f)
+        # Several entries with the same source info share their files
+        if os.path.exists(old_path):
+            os.makedirs(directory + shard_directory(file_hash), exist_ok = True)
+            os.replace(old_path, directory + cache_file_name(new_file))
+            moved += 1
+        files.append(new_file)
+    return entry._replace(files = files), moved
+
+def _index_key(key):
+    # 64 bit digest of a source_info_key(), to index entries without keeping the keys
+    return int(hashlib.sha1(repr(key).encode()).hexdigest()[:16], 16)
+
+def _entry_file_dependencies(entry):
+    # Views of stored entries decode only the file dependencies
+    if isinstance(entry, CacheEntryView):
+        return entry.file_dependencies
+    return entry.source_info.file_dependencies
+
+def _entry_identity(entry):
+    # Identifies an entry across processes, as entry ids are local to each CacheManager
+    return (source_info_key(entry.source_info),
+            tuple(cache_file_name(f) for f in entry.files),
+            entry.timestamp_start, entry.timestamp_end)
+
+def _timestamp():
+    return datetime.datetime.now().astimezone().isoformat()
+
+def _schema_validator():
+    try:
+        schema_path = os.path.join(
+                os.path.dirname(os.path.abspath(__file__)),
+                'tinc_cache_schema.json')
+        with open(schema_path) as f:
+            schema = json.load(f)
+            validator = jsonschema.Draft7Validator(schema)
+            print("Validating json with " + schema_path)
+            return validator
+    except:
+        print("ERROR loading cache schema. Not validating schema.")
+    return None
+
+def _distributed_path_from_json(j):
+    return DistributedPath(filename = j["filename"],
+                           relative_path = j["relativePath"],
+                           root_path = j["rootPath"],
+                           protocol_id = j["protocolId"])
+
+def _file_dependency_from_json(j):
+    return FileDependency(file = _distributed_path_from_json(j["file"]),
+                          modified = j["modified"],
+                          size = j["size"],
+                          hash = j["hash"])
+
+def _file_dependency_to_json(fdep):
+    return {"file": {"filename": fdep.file.filename, 
+                     "relativePath": fdep.file.relative_path,
+                     "rootPath": fdep.file.root_path,
+                     "protocolId": fdep.file.protocol_id},
+            "modified": fdep.modified,
+            "size" : fdep.size,
+            "hash" : fdep.hash}
+
+def _entry_from_json(entry):
+    # Converts an entry from the json metadata format into a CacheEntry
+    filenames = [_file_dependency_from_json(fdep) for fdep in entry["files"]]
+                    
+    args = []
+    for a in entry["sourceInfo"]["arguments"]:
+        args.append(SourceArgument(id = a["id"], 
+                                   value = VariantValue(nctype = VariantType(a["nctype"]),
+                                                        value = a["value"])))
+        
+    deps = []
+    for a in entry["sourceInfo"]["dependencies"]:
+        deps.append(SourceArgument(id = a["id"], 
+                                   value = VariantValue(nctype = VariantType(a["nctype"]),
+                                                        value = a["value"])))
+        
+    fdeps = [_file_dependency_from_json(fdep) for fdep in entry["sourceInfo"]["fileDependencies"]]
+
+    user_info = UserInfo(user_name = entry["userInfo"]["userName"],
+                         user_hash = entry["userInfo"]["userHash"],
+                         ip = entry["userInfo"]["ip"],
+                         port = entry["userInfo"]["port"],
+                         server = entry["userInfo"]["server"])
+    
+    source_info = SourceInfo(type = entry["sourceInfo"]["type"],
+                             tinc_id = entry["sourceInfo"]["tincId"],
+                             command_line_arguments = entry["sourceInfo"]["commandLineArguments"],
+                             working_path_rel = entry["sourceInfo"]["workingPath"]["relativePath"],
+                             working_path_root = entry["sourceInfo"]["workingPath"]["rootPath"],
+                             arguments = args,
+                             dependencies = deps,
+                             file_dependencies = fdeps)
+    
+    return CacheEntry(timestamp_start = entry["timestamp"]["start"],
+                      timestamp_end = entry["timestamp"]["end"],
+                      files = filenames,
+                      user_info = user_info,
+                      source_info = source_info,
+                      cache_hits = entry["cacheHits"],
+                      stale = entry["stale"],
+                      last_access = entry.get("lastAccess", ""),
+                      compression = entry.get("compression", ""))
+
+def _entry_to_json(entry):
+    # Converts a CacheEntry to the json metadata format
+    j_entry = {"timestamp":{"start": entry.timestamp_start, "end" :entry.timestamp_end }}
+    j_entry["files"] = [_file_dependency_to_json(fdep) for fdep in entry.files]
+
+    j_entry["cacheHits"] = entry.cache_hits
+    j_entry["stale"] = entry.stale
+    if entry.last_access != '':
+        j_entry["lastAccess"] = entry.last_access
+    if entry.compression != '':
+        j_entry["compression"] = entry.compression
+    j_entry["userInfo"] = {
+        "userName": entry.user_info.user_name,
+        "userHash": entry.user_info.user_hash,
+        "ip": entry.user_info.ip,
+        "port": entry.user_info.port,
+        "server": entry.user_info.server
+        }
+        
+    args = []
+    for a in entry.source_info.arguments:
+        args.append({"id" : a.id, 
+            "nctype" : int(a.value.nctype), "value" : a.value.value})
+            
+    deps = []
+    for a in entry.source_info.dependencies:
+        deps.append({"id" : a.id, 
+            "nctype" : int(a.value.nctype), "value" : a.value.value})
+        
+    fdeps = [_file_dependency_to_json(fdep) for fdep in entry.source_info.file_dependencies]
+
+    j_entry["sourceInfo"] = {
+        "type": entry.source_info.type,
+        "tincId" : entry.source_info.tinc_id,
+        "commandLineArguments" : entry.source_info.command_line_arguments,
+        "workingPath" : {"relativePath":entry.source_info.working_path_rel,
+                        "rootPath":entry.source_info.working_path_root},
+        "arguments" : args,
+        "dependencies" : deps,
+        "fileDependencies" : fdeps
+        }
+    # TODO compute CRC
+    #hash = str(zlib.crc32())
+    return j_entry
+
+def _metadata_to_json(entries):
+    return _metadata_json([_entry_to_json(entry) for entry in entries])
+
+def _metadata_json(j_entries):
+    # Metadata from entries already in the json format
+    j = {}
+    j["tincMetaVersionMajor"] = TINC_META_VERSION_MAJOR
+    j["tincMetaVersionMinor"] = _metadata_minor_version(j_entries)
+    j["entries"] = j_entries
+    return j
+
+def _metadata_minor_version(j_entries):
+    # Lowest minor version that can hold the entries
+    for entry in j_entries:
+        if any(field in entry for field in _META_VERSION_1_1_FIELDS):
+            return TINC_META_VERSION_MINOR
+    return 0
+
+def _read_digest(path):
+    # Digest of the metadata file recorded by the process that wrote it, or None
+    try:
+        with open(path + ".sha1") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def _write_digest(path, digest):
+    tmp_filename = f"{path}.sha1.{os.getpid()}.tmp"
+    with open(tmp_filename, 'w') as f:
+        f.write(digest)
+    os.replace(tmp_filename, path + ".sha1")
+
+def _entries_from_metadata(j, validator = None, debug = False):
+    # Returns an iterator over the CacheEntry in json metadata, or None if it is not valid
+    j_entries = _metadata_entries(j, validator, debug)
+    if j_entries is None:
+        return None
+    # Converted as they are used, so all entries are not held as CacheEntry at once
+    return (_entry_from_json(entry) for entry in j_entries)
+
+def _metadata_entries(j, validator = None, debug = False):
+    # Returns the list of entries in json metadata, or None if it is not valid
+    try:
+        if j["tincMetaVersionMajor"] != TINC_META_VERSION_MAJOR or \
+            j["tincMetaVersionMinor"] > TINC_META_VERSION_MINOR:
+                print("Invalid cache format")
+                return None
+    except:
+        if debug:
+            traceback.print_exc()
+        print("Metadata file is not a TINC cache file. Ignoring.")
+        return None
+    
+    if validator:
+        try:
+            validator.validate(j)
+        except:
+            print("Cache metadata not valid according to schema. Ignoring.")
+            return None
+    return j["entries"]
+
+# Imported last, as it uses the entry types above
+from .cache_entry_store import CacheEntryStore, CacheEntryView
 
 if __name__ == "__main__":
     c = CacheManager()
@@ -11,9 +11,30 @@ from .processor import ProcessorScript
 
 import netCDF4
 import numpy as np
+import itertools
 import traceback
 import os
 
+class DataSlice(np.ndarray):
+    '''Array with the values of a field sliced from a :class:`DataPool`
+
+    dimensions are the names of the dimensions along each axis, and
+    coordinates a dict of dimension name to its values along its axis. They
+    describe the whole slice, and are copied as is to arrays derived from it
+    by indexing or operations.
+    '''
+    def __new__(cls, data, dimensions = (), coordinates = None):
+        obj = np.asarray(data).view(cls)
+        obj.dimensions = list(dimensions)
+        obj.coordinates = {} if coordinates is None else dict(coordinates)
+        return obj
+
+    def __array_finalize__(self, obj):
+        if obj is None:
+            return
+        self.dimensions = getattr(obj, 'dimensions', [])
+        self.coordinates = getattr(obj, 'coordinates', {})
+
 class DataPool(TincObject):
     '''The DataPool class can unify through a single interface homogeneous data spread across the filesystem.
     
@@ -89,11 +110,18 @@ class DataPool(TincObject):
     def create_data_slice(self, field, slice_dimensions, override_value = None):
         '''Write data slice to file.
 
-        The slice will be created as a NetCDF4 file with a single variable called
-        "data" that spans a dimension "values". The result will be a multi-
-        dimensional slice containing the values of the "field" across all values
-        for slice_dimensions (that must be registered in the parameter space).
-        
+        The slice will be created as a NetCDF4 file with a variable called
+        "data" with one dimension for each of slice_dimensions, named after
+        it. The result will be a multi-dimensional slice containing the values
+        of the "field" across all values for slice_dimensions (that must be
+        registered in the parameter space). Each dimension also has a
+        coordinate variable with its name, holding the dimension values along
+        the slice. Samples whose data file is missing are NaN.
+
+        Slice dimensions can be any combination of filesystem dimensions
+        (that change the path to the data files) and the dimension in the
+        data file. Each data file is read once.
+
         :param field: Name of the field to extract
         :param slice_dimensions: The name of a dimension or a list of dimension names
         :param override_value: (optional) Override current values in the parameter space. Should contain a map of names to values
@@ -104,94 +132,21 @@ class DataPool(TincObject):
             slice_dimensions = [slice_dimensions]
         elif type(slice_dimensions) != list:
             raise ValueError("slice_dimensions must be string or list.")
-        filesystem_dims = []
-        fixed_dims = []
-        slice_values = None
-        for dim in self._parameter_space.get_dimensions():
-            if self._parameter_space.is_filesystem_dimension(dim.id):
-                filesystem_dims.append(dim)
-            if not dim.id in slice_dimensions:
-                fixed_dims.append(dim)
-        if len(filesystem_dims) > 1:
-            raise ValueError("Only one filesystem dimension supported")
-        
-        filename = "_slice_" + field + "_"
-        # FIXME implement slicing aloneg more than one direction
-        field_size = 1 # FIXME get actual field size
-        dim_count = field_size
         # This function is not thread safe. There can be race conditions if the parameter
         # is changed while running this. Should we protect?
-        for dim_name in slice_dimensions:
-            dim = self._parameter_space.get_dimension(dim_name)
-            if not dim is None and dim.get_space_stride() > 0:
-                dim_count = dim_count * (len(dim.values)/dim.get_space_stride() )
-            else:
-                raise ValueError(f"Unknown dimension '{dim_name}'")
-        
-        if self.debug:
-            print(f'Field: {field} Filesystem dims: {[d.id for d in filesystem_dims]} Fixed dims: {[d.id for d in fixed_dims]}')
+        slice_values, coordinates = self._gather_slice(field, slice_dimensions, override_value)
+
         # TODO check if file exists and is the correct slice to use cache instead.
         # TODO for this we need to add metadata to the file indicating where the
         # slice came from. This is part of the bigger TINC metadata idea
-        slice_values = []
-        index_map = {}
-        if len(slice_dimensions) > 2:
-            raise ValueError("multidimensional slicing not supported yet.")
-        elif len(slice_dimensions) == 2:
-            # Fake it for now. There are much more efficient ways to do it, but this is a quick way to get it working
-            p1 = self._parameter_space.get_dimension(slice_dimensions[0])
-            for v in p1.values:
-                part_slice_file = self.get_slice(field, slice_dimensions, override_value)
-
-
-            return   
-        
+        filename = "_slice_" + field + "_"
         for dim_name in slice_dimensions:
-            dim = self._parameter_space.get_dimension(dim_name)
-            this_dim_count = (len(dim.values)/dim.get_space_stride() )
-            if self._parameter_space.is_filesystem_dimension(dim.id):
-                for i in range(int(this_dim_count)):
-                    index_map = {dim.id: i * dim.get_space_stride()}
-                    if dim.get_space_stride() > 1:
-                        ids = {j:dim.ids[i * dim.get_space_stride() + j] for j in range(dim.get_space_stride())}
-                        for fs_dim in filesystem_dims:
-                            if fs_dim.id != dim_name:
-                                new_ids = fs_dim.get_current_ids()
-                                to_remove = []
-                                for id in ids.values():
-                                    if not id in new_ids:
-                                        to_remove.append(list(ids.keys())[list(ids.values()).index(id)])
-                                for r in to_remove:
-                                    ids.pop(r)
-                        if len(ids) == 1:
-                            index_map[dim.id] += list(ids.keys())[0]
-                    path = self._parameter_space.get_root_path()
-                    if len(path) > 0:
-                        path += '/'
-                    path += self._parameter_space.resolve_template( \
-                                self._parameter_space._path_template, index_map) + '/'
-                    #TODO support multiple files. This only works for one file. 
-                    for data_filename, dim_in_file  in self._data_file_names.items():
-                        temp_slice_values = self._get_field_from_file(field, path + data_filename)
-                        index = self._parameter_space.get_dimension(dim_in_file).get_current_index()
-                        if temp_slice_values is not None:
-                            slice_values.append(temp_slice_values[index])
-                        else:
-                            slice_values.append(None)
-            else:
-                path = self._parameter_space.get_root_path()
-                if len(path) > 0:
-                    path += "/" 
-                path += self._parameter_space.get_current_relative_path() + "/"
-                for data_filename, dim_in_file  in self._data_file_names.items():
-                    # TODO support more than one file
-                    slice_values = self._get_field_from_file(field, path + data_filename)
-                    break
-
             filename += dim_name + "_"
-
         for dim in self._parameter_space.get_dimensions():
-            filename += dim.id + "_" + str(dim.value) + "_"
+            if override_value is not None and dim.id in override_value:
+                filename += dim.id + "_" + str(override_value[dim.id]) + "_"
+            else:
+                filename += dim.id + "_" + str(dim.value) + "_"
 
         # TODO Windows paths cant end with dot or space
         filename = ProcessorScript.sanitize_name(filename)
@@ -209,8 +164,20 @@ class DataPool(TincObject):
         try:
             outfile = netCDF4.Dataset(slice_path + filename, mode='w', format='NETCDF4')
             datatype = np.float32
-            outfile.createDimension('data_dim', size=len(slice_values))
-            var = outfile.createVariable('data', datatype, ('data_dim'), zlib=True)
+            dimension_names = list(slice_dimensions)
+            # Fields with more than one value per sample add dimensions
+            for i in range(len(slice_dimensions), slice_values.ndim):
+                dimension_names.append(f'data_dim_{i - len(slice_dimensions)}')
+            for name, size in zip(dimension_names, slice_values.shape):
+                outfile.createDimension(name, size = size)
+            for dim_name, values in zip(slice_dimensions, coordinates):
+                if values.dtype.kind in 'biuf':
+                    coordinate_var = outfile.createVariable(dim_name, np.float64, (dim_name,))
+                else:
+                    coordinate_var = outfile.createVariable(dim_name, str, (dim_name,))
+                    values = values.astype(object)
+                coordinate_var[:] = values
+            var = outfile.createVariable('data', datatype, tuple(dimension_names), zlib=True)
 
             var[:] = slice_values
         except:
@@ -223,12 +190,103 @@ class DataPool(TincObject):
             print(f'DataPool wrote slice: {filename} in {slice_path}')
         return filename
 
+    def _gather_slice(self, field, slice_dimensions, override_value = None):
+        # Returns the slice as an array with an axis for each slice dimension,
+        # and a list with the values of each slice dimension along its axis
+        ps = self._parameter_space
+        dims = []
+        for dim_name in slice_dimensions:
+            dim = ps.get_dimension(dim_name)
+            if dim is None or dim.get_space_stride() <= 0:
+                raise ValueError(f"Unknown dimension '{dim_name}'")
+            dims.append(dim)
+
+        # Indeces of the dimensions that are not sliced
+        index_map = {}
+        for dim in ps.get_dimensions():
+            if len(dim.values) == 0:
+                index_map[dim.id] = -1
+            elif override_value is not None and dim.id in override_value:
+                matches = np.where(np.asarray(dim.values) == override_value[dim.id])[0]
+                if len(matches) == 0:
+                    raise ValueError(f"Override value {override_value[dim.id]} not found in dimension '{dim.id}'")
+                index_map[dim.id] = int(matches[0])
+            else:
+                index_map[dim.id] = int(dim.get_current_index())
+
+        filesystem_dims = [dim for dim in ps.get_dimensions() if ps.is_filesystem_dimension(dim.id)]
+        filesystem_ids = [dim.id for dim in filesystem_dims]
+        internal_dims = [dim for dim in dims if not dim.id in filesystem_ids]
+        if len(internal_dims) > 1:
+            raise ValueError("Only one dimension that is not a filesystem dimension can be sliced")
+        if len(self._data_file_names) == 0:
+            raise ValueError("No data files registered")
+        data_filename, dim_in_file = next(iter(self._data_file_names.items()))
+        if len(internal_dims) == 1:
+            # The data file that contains the dimension
+            in_file = [name for name, dim_name in self._data_file_names.items() if dim_name == internal_dims[0].id]
+            if len(in_file) == 0:
+                raise ValueError(f'Dimension "{internal_dims[0].id}" is not a filesystem dimension or the dimension in a data file')
+            data_filename, dim_in_file = in_file[0], internal_dims[0].id
+
+        strides = [dim.get_space_stride() for dim in dims]
+        coordinates = [np.asarray(dim.values)[::stride] for dim, stride in zip(dims, strides)]
+        in_file_dim = ps.get_dimension(dim_in_file)
+
+        root_path = ps.get_root_path()
+        if len(root_path) > 0:
+            root_path += '/'
+        # Data files are read once, even if several samples are in the same file
+        file_data = {}
+        cells = []
+        axes = [i for i, dim in enumerate(dims) if dim.id in filesystem_ids]
+        for indeces in itertools.product(*[range(len(coordinates[i])) for i in axes]):
+            cell_map = dict(index_map)
+            for i, index in zip(axes, indeces):
+                cell_map[dims[i].id] = index * strides[i]
+            for i in axes:
+                cell_map[dims[i].id] = _resolve_repeated_value(dims[i], cell_map, filesystem_dims)
+            path = root_path + ps.resolve_template(ps._path_template, cell_map) + '/' + data_filename
+            if not path in file_data:
+                values = self._get_field_from_file(field, path)
+                file_data[path] = None if values is None else np.asarray(values, dtype = np.float64)
+            values = file_data[path]
+            if values is not None and in_file_dim is not None and values.ndim > 0:
+                if len(internal_dims) == 1:
+                    values = values[::strides[dims.index(internal_dims[0])]]
+                else:
+                    values = values[cell_map[dim_in_file]]
+            cells.append((indeces, values))
+
+        item_shape = ()
+        for indeces, values in cells:
+            if values is not None:
+                item_shape = values.shape
+                break
+        if len(internal_dims) == 1:
+            # The dimension in the file is the first dimension of the values
+            item_shape = item_shape[1:]
+        shape = tuple(len(c) for c in coordinates)
+        slice_values = np.full(shape + item_shape, np.nan)
+        for indeces, values in cells:
+            if values is None:
+                continue
+            index = [slice(None)] * len(dims)
+            for i, value_index in zip(axes, indeces):
+                index[i] = value_index
+            slice_values[tuple(index)] = values
+        return slice_values, coordinates
+
     # TODO this function is called readDataSlice() in C++
     def get_slice(self, field, slice_dimensions, override_value = None):
         '''Get data slice from the data pool.
 
         Called readDataSlice() in the C++ API.
 
+        The slice has an axis for each of slice_dimensions, in that order.
+        It is returned as a :class:`DataSlice`, with the values of each
+        dimension along its axis in its coordinates attribute.
+
         :param field: Name of the field to extract
         :param slice_dimensions: The name of a dimension or a list of dimension names
         :param override_value: (optional) Override current values in the parameter space. Should contain a map of names to values
@@ -251,7 +309,10 @@ class DataPool(TincObject):
         if self.debug:
             print(f'DataPool reading slice: {slice_file} in {slice_path}')
         # print(nc.variables.keys())
-        slice_data = nc.variables['data'][:]
+        var = nc.variables['data']
+        # Slices written by earlier versions have no coordinate variables
+        coordinates = {name: nc.variables[name][:] for name in var.dimensions if name in nc.variables}
+        slice_data = DataSlice(var[:], var.dimensions, coordinates)
         nc.close()
 
         return slice_data
@@ -295,6 +356,23 @@ class DataPool(TincObject):
         raise RuntimeError("To extract data locally use the DataPool data specific classes (e.g. DataPoolJson)")
     
 
+def _resolve_repeated_value(dim, index_map, filesystem_dims):
+    # For dimensions whose values are repeated with different ids, choose
+    # among the indeces of a value the one whose id is also an id of the
+    # values of the other filesystem dimensions
+    stride = dim.get_space_stride()
+    start = index_map[dim.id] - index_map[dim.id] % stride
+    if stride == 1 or len(dim.ids) < len(dim.values):
+        return index_map[dim.id]
+    ids = {j: dim.ids[start + j] for j in range(stride)}
+    for fs_dim in filesystem_dims:
+        if fs_dim.id != dim.id and index_map[fs_dim.id] >= 0 and len(fs_dim.ids) > 0:
+            other_ids = fs_dim.get_ids_for_value(fs_dim.values[index_map[fs_dim.id]])
+            ids = {j: id for j, id in ids.items() if id in other_ids}
+    if len(ids) == 1:
+        return start + list(ids.keys())[0]
+    return index_map[dim.id]
+
 class DataPoolJson(DataPool):
     '''DataPool to read JSON files
     '''
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+Fingerprints of files that cached results depend on.
+"""
+
+import concurrent.futures
+import datetime
+import os
+import threading
+import zlib
+
+class FileFingerprinter(object):
+    '''Computes and checks the modification time, size and hash of files.
+
+    A file is considered unchanged if its size and modification time match
+    the recorded ones. Only if the modification time differs is the content
+    hashed and compared to the recorded hash, so files that were touched but
+    not modified are still considered unchanged when a hash was recorded.
+
+    When files are fingerprinted, their modification time, size and hash
+    are recorded. Files whose modification time changed and that have no
+    recorded hash, e.g. in entries written by other tools, are considered
+    changed.
+
+    Hashes are CRC32 of the file contents, computed in chunks. They are
+    memoized per file (device, inode), modification time and size, so a file
+    is only read once while it doesn't change. Many files are checked in
+    parallel in a thread pool.
+
+    :param max_workers: Number of threads used to check files. Defaults to the concurrent.futures default
+    :param chunk_size: Size in bytes of the chunks read to compute hashes
+    '''
+    def __init__(self, max_workers = None, chunk_size = 1024 * 1024):
+        self.max_workers = max_workers
+        self.chunk_size = chunk_size
+        self._hashes = {}
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def file_path(self, file_dependency):
+        return file_dependency.file.root_path + file_dependency.file.relative_path + file_dependency.file.filename
+
+    def file_hash(self, path, stat = None):
+        '''Returns the hash of a file as a string'''
+        if stat is None:
+            stat = os.stat(path)
+        file_hash = self.memoized_hash(stat)
+        if file_hash != '':
+            return file_hash
+        key = _hash_key(stat)
+        crc = 0
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(self.chunk_size)
+                if not chunk:
+                    break
+                crc = zlib.crc32(chunk, crc)
+        file_hash = str(crc)
+        with self._lock:
+            self._hashes[key] = file_hash
+        return file_hash
+
+    def memoized_hash(self, stat):
+        '''Returns the hash of the file with an os.stat() result if it was already computed, or an empty string'''
+        with self._lock:
+            return self._hashes.get(_hash_key(stat), '')
+
+    def fingerprint(self, file_dependency):
+        '''Returns a copy of a FileDependency with the current modification time, size and hash of its file.
+
+        The file is only read if its hash is not memoized.
+
+        File dependencies without a file name or whose file does not exist are returned unchanged.
+        '''
+        if file_dependency.file.filename == '':
+            return file_dependency
+        path = self.file_path(file_dependency)
+        try:
+            stat = os.stat(path)
+            return file_dependency._replace(modified = _modified_time(stat),
+                                            size = stat.st_size,
+                                            hash = self.file_hash(path, stat))
+        except OSError:
+            print(f"ERROR: can't read file dependency {path}")
+            return file_dependency
+
+    def is_unchanged(self, file_dependency):
+        '''Returns True if the file matches the recorded fingerprint.
+
+        File dependencies without a file name or without a recorded fingerprint are always unchanged.
+        '''
+        if file_dependency.file.filename == '' \
+            or (file_dependency.modified == '' and file_dependency.hash == ''):
+                return True
+        path = self.file_path(file_dependency)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        if stat.st_size != file_dependency.size:
+            return False
+        if _modified_time(stat) == file_dependency.modified:
+            return True
+        if file_dependency.hash == '':
+            return False
+        try:
+            return self.file_hash(path, stat) == file_dependency.hash
+        except OSError:
+            return False
+
+    def fingerprint_all(self, file_dependencies):
+        '''fingerprint() for a list of FileDependency, in parallel'''
+        return self._map(self.fingerprint, file_dependencies)
+
+    def check_all(self, file_dependencies):
+        '''is_unchanged() for a list of FileDependency, in parallel. Returns a list of bool'''
+        return self._map(self.is_unchanged, file_dependencies)
+
+    def _map(self, function, file_dependencies):
+        file_dependencies = list(file_dependencies)
+        if len([f for f in file_dependencies if f.file.filename != '']) < 2:
+            return [function(f) for f in file_dependencies]
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(max_workers = self.max_workers)
+        return list(self._executor.map(function, file_dependencies))
+
+def _hash_key(stat):
+    return (stat.st_dev, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+def _modified_time(stat):
+    return datetime.datetime.fromtimestamp(stat.st_mtime_ns / 1e9, datetime.timezone.utc).isoformat()
+
+# Shared by all cache managers, so hashes are memoized across caches
+default_fingerprinter = FileFingerprinter()
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+In-memory cache of results, in front of the cache on disk.
+"""
+
+import collections
+import threading
+
+class MemoryCache(object):
+    '''Keeps recently used results in memory.
+
+    Results are stored by key up to a total size of max_bytes, evicting the
+    least recently used results first. The size of a result is estimated
+    from the size of its cache file, so the budget is approximate.
+
+    Results are returned as stored, not copied, so they should not be
+    modified in place by the caller.
+
+    :param max_bytes: Maximum total size of the results kept in memory
+    '''
+    def __init__(self, max_bytes = 256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._size = 0
+        self._results = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, token = None, is_valid = None):
+        '''Returns a tuple (found, result)
+
+        :param key: Hashable key
+        :param token: (optional) Value that changes when results may have become invalid, e.g. a cache generation
+        :param is_valid: (optional) Function called with the key of a result found, if it was stored or last checked with another token. If it returns False, the result is removed and not returned
+        '''
+        with self._lock:
+            item = self._results.get(key)
+        if item is not None and is_valid is not None and item[2] != token:
+            if is_valid(key):
+                with self._lock:
+                    if key in self._results:
+                        result, size, _ = self._results[key]
+                        self._results[key] = (result, size, token)
+            else:
+                self.remove(key)
+                item = None
+        with self._lock:
+            if item is not None and key in self._results:
+                self._results.move_to_end(key)
+                self.hits += 1
+                return True, self._results[key][0]
+            self.misses += 1
+            return False, None
+
+    def put(self, key, result, size, token = None):
+        '''Store a result. Results larger than max_bytes are not stored.
+
+        :param key: Hashable key
+        :param result: Result to store
+        :param size: Size of the result in bytes
+        :param token: (optional) Token the result is valid for. See get()
+        '''
+        with self._lock:
+            self._remove(key)
+            if size > self.max_bytes:
+                return
+            self._results[key] = (result, size, token)
+            self._size += size
+            while self._size > self.max_bytes:
+                self._size -= self._results.popitem(last = False)[1][1]
+
+    def remove(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+            self._size = 0
+
+    def size(self):
+        '''Total size in bytes of the results in memory'''
+        return self._size
+
+    def stats(self):
+        '''Returns a dict with the number of hits and misses, entries and size in bytes'''
+        with self._lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "entries": len(self._results),
+                    "bytes": self._size}
+
+    def _remove(self, key):
+        if key in self._results:
+            self._size -= self._results.pop(key)[1]
@@ -6,13 +6,30 @@ Created on Tue Sep  1 17:13:15 2020
 """
 
 from .tinc_object import TincObject
-from .cachemanager import CacheEntry, CacheManager, DistributedPath, FileDependency, SourceArgument, SourceInfo, UserInfo, VariantValue, VariantType
+from .cachemanager import CacheEntry, CacheManager, DistributedPath, FileDependency, SourceArgument, SourceInfo, UserInfo, VariantValue, VariantType, BLOB_DIRECTORY, CACHE_FILE_LAYOUTS, blob_directory, cache_file_name, shard_directory, source_info_hash, source_info_key
 from .parameter import *
+from .sqlite_cachemanager import SqliteCacheManager
+from .sweep_checkpoint import SweepCheckpoint
+from .sweep_plan import SweepPlan, _entry_duration
+from .sweep_queue import SweepWorkQueue, _LeaseHeartbeat
+from .sweep_progress import SweepProgress
+from .memory_cache import MemoryCache
+from .cache_serializers import serializer_for_file, serializer_for_result
+from .cache_compression import CacheCompression, codec_for_file, load_compressed
+from .cache_writer import CacheWriter, _fsync_directory, result_size
+from .approximate_cache import ApproximateLookup, NearestSample, ProcessResult, SampleIndex, _continuous_ids, _group_key, _index_entry
 
 import traceback
 import os
-import pickle
+import asyncio
+import concurrent.futures
+import datetime
+import functools
+import hashlib
+import itertools
 import threading
+import time
+import weakref
 from threading import Lock
 
 import inspect, dis
@@ -33,6 +50,12 @@ class ParameterSpace(TincObject):
         self._parameters = []
         self.tinc_client = tinc_client
         self._cache_manager = None
+        self._memory_cache = None
+        self._cache_compression = None
+        self._cache_writer = None
+        self._cache_file_layout = 'sharded'
+        self._disk_cache_hits = 0
+        self._disk_cache_misses = 0
         self._path_template = ""
         self._process_lock = Lock()
         # self._local_current_path
@@ -40,6 +63,11 @@ class ParameterSpace(TincObject):
         self.debug = False
         self.sweep_running = False
         self.sweep_threads = []
+        self._call_plans = weakref.WeakKeyDictionary()
+        # Spatial indeces of cached samples for approximate lookups
+        self._approximate_indeces = {}
+        # Progress of the current or last sweep
+        self.sweep_progress = SweepProgress()
     
     def __str__(self):
         details = f" ** ParameterSpace '{self.id}'\n"
@@ -107,17 +135,143 @@ class ParameterSpace(TincObject):
                 self._parameters.remove(p)
                 break
             
-    def enable_cache(self, directory = "python_cache"):
-        '''Enable caching for processes run through run_process()'''
+    def enable_cache(self, directory = "python_cache", metadata_backend = 'json',
+                     max_bytes = None, max_entries = None, eviction_policy = 'lru', file_layout = 'sharded'):
+        '''Enable caching for processes run through run_process()
+
+        Results that are numpy arrays, or dicts of numpy arrays, are stored
+        as .npy or .npd files and loaded as read only np.memmap. Other
+        results, including subclasses of np.ndarray, are pickled.
+
+        :param directory: Cache directory
+        :param metadata_backend: 'json' to store cache metadata in a json file compatible with TINC in C++, or 'sqlite' to use a SQLite database, which is faster for large caches. See :class:`tinc.sqlite_cachemanager.SqliteCacheManager`
+        :param max_bytes: (optional) Maximum size of the cache files in bytes
+        :param max_entries: (optional) Maximum number of cache entries
+        :param eviction_policy: 'lru' or 'lfu'. Entries evicted first when the cache goes over budget. See :meth:`tinc.cachemanager.CacheManager.set_cache_budget`
+        :param file_layout: 'sharded' to name result files after a hash of the source info, in subdirectories 'ab/cd/<hash>.pkl', 'flat' to name them after the function and its arguments in the cache directory, or 'content' to name them after a hash of their content, in 'blobs/ab/cd/<hash>.pkl', so samples with identical results share a single file. Existing entries are read in any layout. See :meth:`tinc.cachemanager.CacheManager.migrate_to_sharded`
+        '''
+        if file_layout not in CACHE_FILE_LAYOUTS:
+            raise ValueError("file_layout must be 'sharded', 'flat' or 'content'")
+        self.flush_cache()
+        if self._cache_manager:
+            self._cache_manager.close()
         if self.tinc_client:
             if directory != "":
                 print("Connected to client. enable_cache() ignoring directory")
-        self._cache_manager = CacheManager(directory)
+        if metadata_backend == 'json':
+            self._cache_manager = CacheManager(directory)
+        elif metadata_backend == 'sqlite':
+            self._cache_manager = SqliteCacheManager(directory)
+        else:
+            raise ValueError("metadata_backend must be 'json' or 'sqlite'")
+        self._cache_manager.on_remove = self._cache_entry_removed
+        self._cache_file_layout = file_layout
+        if max_bytes is not None or max_entries is not None:
+            self._cache_manager.set_cache_budget(max_bytes, max_entries, eviction_policy)
+        self._approximate_indeces = {}
         
     def disable_cache(self):
+        self.flush_cache()
+        if self._cache_manager:
+            self._cache_manager.close()
         self._cache_manager = None
+        self._approximate_indeces = {}
+
+    def enable_memory_cache(self, max_bytes = 256 * 1024 * 1024):
+        '''Keep recently used results in memory, in front of the cache on disk
+
+        Results found in memory are returned without reading the cache files,
+        which is useful when the same samples are requested repeatedly, e.g.
+        when moving a slider back and forth. The cache on disk must also be
+        enabled with enable_cache(), and remains the authoritative copy.
+
+        :param max_bytes: Maximum size of the results kept in memory. See :class:`tinc.memory_cache.MemoryCache`
+        '''
+        self._memory_cache = MemoryCache(max_bytes)
+
+    def disable_memory_cache(self):
+        self._memory_cache = None
+
+    def _cache_entry_removed(self, key):
+        # Called by the cache manager when entries are evicted, removed or cleared
+        memory_cache = self._memory_cache
+        if memory_cache:
+            if key is None:
+                memory_cache.clear()
+            else:
+                memory_cache.remove(key)
+        if key is None:
+            self._approximate_indeces = {}
+        else:
+            for generation, normalization, index in list(self._approximate_indeces.values()):
+                index.remove(key)
+
+    def enable_cache_compression(self, codec = 'zlib', level = None, min_size = 64 * 1024):
+        '''Compress results stored in the cache
+
+        Reduces the size of the cache for compressible results, which makes
+        reading and writing them faster on slow or network filesystems. The
+        codec is recorded in the cache entry, and results already in the
+        cache are read whether they are compressed or not.
+
+        :param codec: 'zlib', 'bz2' or 'lzma'
+        :param level: Compression level, or None for the codec default
+        :param min_size: Results smaller than this number of bytes are stored uncompressed. See :class:`tinc.cache_compression.CacheCompression`
+        '''
+        self._cache_compression = CacheCompression(codec, level, min_size)
+
+    def disable_cache_compression(self):
+        self._cache_compression = None
+
+    def enable_write_behind(self, max_bytes = 256 * 1024 * 1024):
+        '''Write results to the cache in a background thread
+
+        Results are stored after the function returns, while the next samples
+        are computed, and the cache metadata is written once per batch of
+        results instead of once per result. Results waiting to be written are
+        kept in memory and found by lookups. A result file is flushed to disk
+        before its entry is added to the cache, so an interrupted process never
+        leaves entries pointing to incomplete files. Sweeps with a checkpoint
+        only mark samples as done once their results are written.
+
+        Results must not be modified after the function returns them. Call
+        flush_cache() to wait until all results are in the cache, e.g. before
+        other processes read it.
+
+        :param max_bytes: Maximum size of the results waiting to be written. Computing blocks while it is exceeded. See :class:`tinc.cache_writer.CacheWriter`
+        '''
+        self.disable_write_behind()
+        self._cache_writer = CacheWriter(self._write_cache_metadata, max_bytes)
+
+    def disable_write_behind(self):
+        '''Write the results waiting in the background and store results synchronously from now on'''
+        if self._cache_writer:
+            self._cache_writer.close()
+            self._cache_writer = None
+
+    def flush_cache(self):
+        '''Wait until results being written in the background are stored in the cache
+
+        Does nothing if write-behind is not enabled. See enable_write_behind()
+        '''
+        if self._cache_writer:
+            self._cache_writer.flush()
+
+    def cache_stats(self):
+        '''Returns a dict with hit and miss counts for the memory and disk caches
+
+        The 'memory' value is None if the memory cache is not enabled. See
+        :meth:`tinc.cachemanager.CacheManager.stats` for more detailed
+        statistics of the cache on disk.
+        '''
+        return {"memory": self._memory_cache.stats() if self._memory_cache else None,
+                "disk": {"hits": self._disk_cache_hits,
+                         "misses": self._disk_cache_misses}}
         
     def clear_cache(self):
+        self.flush_cache()
+        if self._memory_cache:
+            self._memory_cache.clear()
         if self._cache_manager:
             self._cache_manager.clear_cache()
 
@@ -295,285 +449,1231 @@ class ParameterSpace(TincObject):
         else:
             return self._local_root_path
  
+    def sample_count(self, params = None):
+        '''Number of samples in the parameter space
+
+        :param params: If set, only count samples across these parameters
+        '''
+        if params is None:
+            params = self._parameters
+        count = 1
+        for p in params:
+            count *= len(p.values)
+        return count
+
+    def _sample_strides(self, params):
+        # Flat sample index layout: first parameter changes fastest
+        strides = []
+        stride = 1
+        for p in params:
+            strides.append(stride)
+            stride *= len(p.values)
+        return strides
+
+    def _sample_indeces(self, flat_index, params, strides):
+        # Works for both integers and numpy arrays of flat indeces
+        return [(flat_index // stride) % len(p.values) for p, stride in zip(params, strides)]
+
+    def sample_at(self, flat_index, params = None):
+        '''Get the parameter values for a sample by its flat index
+
+        Samples are ordered with the first parameter changing fastest, which
+        is the order used by sweep().
+
+        :param flat_index: Index of the sample, between 0 and sample_count() - 1
+        :param params: If set, index samples across these parameters only
+        :returns: A dict of parameter ids to values
+        '''
+        if params is None:
+            params = self._parameters
+        if flat_index < 0 or flat_index >= self.sample_count(params):
+            raise IndexError(f"Sample index {flat_index} out of range")
+        indeces = self._sample_indeces(flat_index, params, self._sample_strides(params))
+        return {p.id: p.values[i] for p, i in zip(params, indeces)}
+
+    def index_of(self, values, params = None):
+        '''Get the flat sample index for a set of parameter values
+
+        This is the inverse of sample_at().
+
+        :param values: A dict of parameter ids to values
+        :param params: If set, index samples across these parameters only
+        :returns: The flat index of the sample
+        '''
+        if params is None:
+            params = self._parameters
+        flat_index = 0
+        for p, stride in zip(params, self._sample_strides(params)):
+            try:
+                index = list(p.values).index(values[p.id])
+            except ValueError:
+                raise ValueError(f"Value {values[p.id]} not found in parameter '{p.id}'")
+            flat_index += index * stride
+        return flat_index
+
+    def iter_samples(self, start = 0, stop = None, step = 1, params = None):
+        '''Lazily iterate over the parameter space samples
+
+        Arguments work like range(). As any flat index can be computed directly,
+        iteration can start anywhere, e.g. to process a shard of the space.
+
+        :param start: First flat index
+        :param stop: Stop before this flat index. If None, iterate to the end
+        :param step: Step between flat indeces
+        :param params: If set, iterate across these parameters only
+        :returns: A generator of dicts of parameter ids to values
+        '''
+        if params is None:
+            params = self._parameters
+        count = self.sample_count(params)
+        if stop is None or stop > count:
+            stop = count
+        strides = self._sample_strides(params)
+        for flat_index in range(start, stop, step):
+            indeces = self._sample_indeces(flat_index, params, strides)
+            yield {p.id: p.values[i] for p, i in zip(params, indeces)}
+
+    def iter_progressive_indeces(self, params = None):
+        '''Generate all flat sample indeces ordered from coarse to fine
+
+        The first samples are spread over the whole space: samples where the
+        index in every dimension is a multiple of a large power of two come
+        first, then the power of two is halved on each pass until every
+        sample has been generated once. Stopping early leaves a lower
+        resolution, but complete, view of the parameter space.
+
+        :param params: If set, index samples across these parameters only
+        '''
+        if params is None:
+            params = self._parameters
+        shape = [len(p.values) for p in params]
+        if len(shape) == 0 or 0 in shape:
+            return
+        strides = self._sample_strides(params)
+        levels = max((n - 1).bit_length() for n in shape)
+        for level in range(levels, -1, -1):
+            step = 1 << level
+            coarser_step = step << 1
+            # product() changes the last element fastest, reverse to keep first dimension fastest
+            grid = [range(0, n, step) for n in reversed(shape)]
+            for sample_indeces in itertools.product(*grid):
+                if level < levels and all(i % coarser_step == 0 for i in sample_indeces):
+                    # Generated in a previous pass
+                    continue
+                yield sum(i * stride for i, stride in zip(sample_indeces, reversed(strides)))
+
+    def iter_running_paths(self, fixed_dimensions = []):
+        '''Lazily generate the data paths for all samples in the parameter space
+
+        :param fixed_dimensions: Names of dimensions kept at their current value
+        '''
+        params = [dim for dim in self._parameters if not dim.id in fixed_dimensions]
+        strides = self._sample_strides(params)
+        for flat_index in range(self.sample_count(params)):
+            indeces = self._sample_indeces(flat_index, params, strides)
+            index_map = {p.id: i for p, i in zip(params, indeces)}
+            yield self.resolve_template(self._path_template, index_map)
+
     def running_paths(self, fixed_dimensions = []):
-        paths = []
-        params = []
-        fixed_params = {}
-        for dim in self._parameters:
-            if dim.id != fixed_dimensions:
-                params.append(dim)
-            else:
-                # TODO support other paramter representations. This hard codes VALUE
-                fixed_params[dim.id] = str(dim.value)
-
-        indeces = [0]*len(params)
-        index_max = [len(p.values) for p in params]
-
-        done = False 
-        while not done and self.sweep_running:
-            sweep_values = {p.id:str(p.values[indeces[i]]) for i, p in enumerate(params)}
-            sweep_values.update(fixed_params)
-
-            paths.append(self._substitute_values(self._path_template, sweep_values))
-
-            indeces[0] += 1
-            current_p = 0
-            while indeces[current_p] == index_max[current_p]:
-                indeces[current_p] = 0
-                if current_p == len(indeces) - 1:
-                    if indeces == [0]*len(params):
-                        done = True
+        return list(self.iter_running_paths(fixed_dimensions))
+    
+    def _sweep_parameters(self, params):
+        if params is None or len(params) == 0:
+            return self._parameters
+        for p in params:
+            registered = False
+            for existing_param in self._parameters:    
+                if p.get_osc_address() == existing_param.get_osc_address():
+                    registered = True
                     break
-                indeces[current_p + 1] += 1
-                current_p += 1
+            if not registered:
+                print(f"Warning: Parameter {p.get_osc_address()} not registered with ParameterSpace")
+        return params
 
-        return paths
-    
-    def sweep(self, function, params=None, dependencies = [], force_recompute = False, force_values = False):
+    def _iter_sweep_values(self, params, checkpoint = None, order = 'lexicographic'):
+        # Generates (flat_index, sample values), skipping samples completed in checkpoint
+        if order == 'progressive':
+            indeces = self.iter_progressive_indeces(params)
+            if checkpoint is not None:
+                indeces = (i for i in indeces if not checkpoint.is_done(i))
+        elif order != 'lexicographic':
+            raise ValueError("order must be 'lexicographic' or 'progressive'")
+        elif checkpoint is None:
+            indeces = range(self.sample_count(params))
+        else:
+            indeces = checkpoint.pending()
+        strides = self._sample_strides(params)
+        for index in indeces:
+            if not self.sweep_running:
+                break
+            sample_indeces = self._sample_indeces(index, params, strides)
+            yield index, {p.id: p.values[i] for p, i in zip(params, sample_indeces)}
+
+    def _sweep_signature(self, function, params, dependencies):
+        # Identifies a sweep: function, sweept values, fixed values and dependencies
+        signature = function.__name__ + '|' + repr([(p.id, list(p.values)) for p in params])
+        signature += '|' + repr([(p.id, p.value) for p in self._parameters if not p in params])
+        signature += '|' + repr([d if type(d) == str else (d.id, d.value) for d in dependencies])
+        return hashlib.sha1(signature.encode()).hexdigest()
+
+    def _sweep_checkpoint(self, checkpoint, function, params, dependencies, checkpoint_interval):
+        if checkpoint is None:
+            return None
+        signature = self._sweep_signature(function, params, dependencies)
+        return SweepCheckpoint(checkpoint, self.sample_count(params), signature, checkpoint_interval)
+
+    def _mark_sample_done(self, checkpoint, index):
+        # With write-behind, samples are recorded as done only once their
+        # results are in the cache, so a restarted sweep doesn't skip them
+        if self._cache_writer:
+            self._cache_writer.call_when_written(functools.partial(checkpoint.mark_done, index))
+        else:
+            checkpoint.mark_done(index)
+
+    def _start_sweep_progress(self, params, checkpoint = None):
+        completed = checkpoint.completed_count() if checkpoint else 0
+        self.sweep_progress.start(self.sample_count(params), completed)
+
+    def plan_sweep(self, function, params = None, dependencies = []):
+        '''Find which samples of a sweep are already in the cache
+
+        The cache is scanned once for all samples, instead of once per sample.
+        The returned plan reports the hit ratio and the estimated time for the
+        missing samples, and can be passed to sweep() or sweep_parallel() so
+        that only the missing samples are computed.
+
+        :param function: Function to run for each parameter space sample
+        :param params: If set, only the parameters provided will be sweept. The rest of the parameters in the ParameterSpace will be kept constant at their current value
+        :param dependencies: Parameters that the function depends on, but are not passed as arguments, and paths of files it reads
+        :returns: A :class:`tinc.sweep_plan.SweepPlan`
+        '''
+        return self._plan_sweep(function, self._sweep_parameters(params), dependencies)
+
+    def _plan_sweep(self, function, params, dependencies, indeces = None):
+        # plan_sweep() for the samples at the flat indeces, or all samples if None
+        sample_count = self.sample_count(params)
+        if indeces is None:
+            indeces = range(sample_count)
+            samples = self.iter_samples(params = params)
+        else:
+            indeces = list(indeces)
+            samples = (self.sample_at(index, params) for index in indeces)
+        if not self._cache_manager:
+            return SweepPlan(self, params, sample_count, {}, list(indeces))
+        # Results still being written would be reported as missing
+        self.flush_cache()
+
+        def source_infos():
+            for sweep_values in samples:
+                args = self._complete_args(dict(sweep_values))
+                yield self._make_source_info(function, self._get_calling_args(function, args), dependencies)
+
+        hits = {}
+        misses = []
+        durations = []
+        for index, entry in zip(indeces, self._cache_manager.find_entries(source_infos())):
+            if entry is None:
+                misses.append(index)
+            else:
+                hits[index] = [cache_file_name(f) for f in entry.files]
+                duration = _entry_duration(entry)
+                if duration is not None:
+                    durations.append(duration)
+        sample_time = sum(durations)/len(durations) if len(durations) > 0 else None
+        return SweepPlan(self, params, sample_count, hits, misses, sample_time)
+
+    def _sweep_plan(self, plan, function, params, dependencies, force_recompute, checkpoint = None):
+        if force_recompute or not self._cache_manager:
+            return None
+        if plan is None:
+            if checkpoint is not None and checkpoint.completed_count() > 0:
+                # Completed samples are skipped without looking them up
+                return self._plan_sweep(function, params, dependencies, checkpoint.pending())
+            return self._plan_sweep(function, params, dependencies)
+        if plan.sample_count != self.sample_count(params):
+            raise ValueError("SweepPlan does not match the parameters being sweept")
+        return plan
+
+    def sweep(self, function, params=None, dependencies = [], force_recompute = False, force_values = False,
+              checkpoint = None, checkpoint_interval = 30.0, plan = None, order = 'lexicographic'):
         '''Sweep the parameter space running the function for all value combinations
         
         :param function: Function to run for each parameter space sample
         :param params: If set, only the parameters provided will be sweept. The rest of the parameters in the ParameterSpace will be kept constant at their current value
-        :param dependencies: 
+        :param dependencies: Parameters that the function depends on, but are not passed as arguments, and paths of files it reads
         :param force_recompute: Always recompute function even if there is cache available
         :param force_values: Set all parameters' value every sample. This will trigger parameter callbacks. This is required when you query the parameter values within the function rather than taking the parameter values as function parameters
+        :param checkpoint: (optional) Checkpoint file name. Completed samples are recorded there, and a restarted sweep skips them. Remove the file to run the full sweep again
+        :param checkpoint_interval: Time in seconds between writes of the checkpoint file
+        :param plan: (optional) A :class:`tinc.sweep_plan.SweepPlan` from plan_sweep(). If not provided and the cache is enabled, it is computed before starting. Not used with force_values
+        :param order: 'lexicographic' to change the first parameter fastest, or 'progressive' to cover the whole space at low resolution first and then refine (see iter_progressive_indeces())
         '''
 
         if self.sweep_running:
             print("Sweep is already running")
             return
         self.sweep_running = True
-        if params is None or len(params) == 0:
-            params = self._parameters
-        else:
-            for p in params:
-                registered = False
-                for existing_param in self._parameters:    
-                    if p.get_osc_address() == existing_param.get_osc_address():
-                        registered = True
-                        break
-                if not registered:
-                    print(f"Warning: Parameter p.get_osc_address() not registered with ParameterSpace")
+        params = self._sweep_parameters(params)
 
         # TODO store metadata about function to know if we need to reprocess cache
         if self.debug:
             print(dis.dis(function))
             print(inspect.getsource(function))
         
-        indeces = [0]*len(params)
-        index_max = [len(p.values) for p in params]
-        
         # original_values used to restore values if self.force_values
         original_values = {p:p.value for p in params}
+        checkpoint = self._sweep_checkpoint(checkpoint, function, params, dependencies, checkpoint_interval)
+        self._start_sweep_progress(params, checkpoint)
     
-        done = False 
-        while not done and self.sweep_running:
+        try:
+            if not force_values:
+                plan = self._sweep_plan(plan, function, params, dependencies, force_recompute, checkpoint)
+            for index, sweep_values in self._iter_sweep_values(params, checkpoint, order):
+                start = time.monotonic()
+                cached = False
+                ok = True
+                if force_values:
+                    for p in params:
+                        p.value = sweep_values[p.id]
+                    ok, out = self._run_sample(function, params, dependencies, force_recompute)
+                elif plan is None:
+                    ok, out = self._run_sample(function, sweep_values, dependencies, force_recompute)
+                elif not plan.is_cached(index):
+                    # Already known to be missing from the cache
+                    ok, out = self._run_sample(function, sweep_values, dependencies, True)
+                else:
+                    cached = True
+                self.sweep_progress.record(index, time.monotonic() - start, cached)
+                # Samples that failed are retried when the sweep is resumed
+                if ok and checkpoint:
+                    self._mark_sample_done(checkpoint, index)
+        finally:
+            if checkpoint:
+                self.flush_cache()
+                checkpoint.flush()
+            self.sweep_progress.finish()
             if force_values:
-                for i,p in enumerate(params):
-                    p.set_at(indeces[i])
-                self.run_process(function, params, dependencies, force_recompute)
+                for p, orig_val in original_values.items():
+                    p.value = orig_val
+            self.sweep_running = False
+
+    def sweep_parallel(self, function, params = None, dependencies = [], force_recompute = False,
+                       num_workers = None, backend = 'process', chunk_size = None, callback = None,
+                       checkpoint = None, checkpoint_interval = 30.0, plan = None, order = 'lexicographic'):
+        '''Sweep the parameter space distributing samples across a pool of workers
+
+        The samples are split into disjoint chunks that are dispatched to a
+        concurrent.futures pool. The cache is checked for all samples before
+        dispatching (see plan_sweep()), and cache writes are done by the
+        calling thread, so all workers share the cache directory safely. Only
+        samples missing from the cache are sent to the workers.
+
+        Parameter values are passed as function arguments, so force_values is
+        not supported. When using the 'process' backend, the function must be
+        picklable (e.g. defined at module level).
+
+        :param function: Function to run for each parameter space sample
+        :param params: If set, only the parameters provided will be sweept. The rest of the parameters in the ParameterSpace will be kept constant at their current value
+        :param dependencies: Parameters that the function depends on, but are not passed as arguments, and paths of files it reads
+        :param force_recompute: Always recompute function even if there is cache available
+        :param num_workers: Number of workers in the pool. If None the concurrent.futures default is used
+        :param backend: 'process' or 'thread'
+        :param chunk_size: Number of samples sent to a worker at once. If None, a size is chosen from the number of workers, up to 64 samples
+        :param callback: (optional) Function called as callback(sample_values, result) as results arrive
+        :param checkpoint: (optional) Checkpoint file name. See sweep()
+        :param checkpoint_interval: Time in seconds between writes of the checkpoint file
+        :param plan: (optional) A :class:`tinc.sweep_plan.SweepPlan` from plan_sweep(). If not provided and the cache is enabled, it is computed before starting
+        :param order: Order in which samples are dispatched. See sweep()
+        '''
+        if backend == 'process':
+            executor_class = concurrent.futures.ProcessPoolExecutor
+        elif backend == 'thread':
+            executor_class = concurrent.futures.ThreadPoolExecutor
+        else:
+            raise ValueError("backend must be 'process' or 'thread'")
+        if self.sweep_running:
+            print("Sweep is already running")
+            return
+        self.sweep_running = True
+        params = self._sweep_parameters(params)
+
+        if num_workers is None:
+            num_workers = os.cpu_count() or 1
+        if chunk_size is None:
+            chunk_size = max(1, min(_MAX_CHUNK_SIZE, self.sample_count(params) // (num_workers * 4)))
+        max_in_flight = num_workers * 2
+        checkpoint = self._sweep_checkpoint(checkpoint, function, params, dependencies, checkpoint_interval)
+
+        self._start_sweep_progress(params, checkpoint)
+
+        pending = {}
+        in_flight = set()
+
+        def collect(futures):
+            for future in futures:
+                for index, out, ok, timestamps, duration in future.result():
+                    sweep_values, calling_args, src_info = pending.pop(index)
+                    if ok and self._cache_manager:
+                        self._store_cache_locked(function, calling_args, src_info, out, timestamps)
+                    self.sweep_progress.record(index, duration)
+                    if callback:
+                        callback(sweep_values, out)
+                    if ok and checkpoint:
+                        self._mark_sample_done(checkpoint, index)
+
+        try:
+            plan = self._sweep_plan(plan, function, params, dependencies, force_recompute, checkpoint)
+            with executor_class(max_workers = num_workers) as executor:
+                chunk = []
+                for index, sweep_values in self._iter_sweep_values(params, checkpoint, order):
+                    if plan is not None and plan.is_cached(index):
+                        if callback:
+                            callback(sweep_values, plan.load(index))
+                        self.sweep_progress.record(index, 0.0, True)
+                        if checkpoint:
+                            checkpoint.mark_done(index)
+                        continue
+                    calling_args = self._get_calling_args(function, self._complete_args(dict(sweep_values)))
+                    src_info = None
+                    if self._cache_manager:
+                        src_info = self._make_source_info(function, calling_args, dependencies)
+                    pending[index] = (sweep_values, calling_args, src_info)
+                    chunk.append((index, calling_args))
+                    if len(chunk) == chunk_size:
+                        in_flight.add(executor.submit(_run_sweep_chunk, function, chunk))
+                        chunk = []
+                        if len(in_flight) >= max_in_flight:
+                            done, in_flight = concurrent.futures.wait(in_flight,
+                                return_when = concurrent.futures.FIRST_COMPLETED)
+                            collect(done)
+                if len(chunk) > 0 and self.sweep_running:
+                    in_flight.add(executor.submit(_run_sweep_chunk, function, chunk))
+                while len(in_flight) > 0:
+                    if not self.sweep_running:
+                        for future in in_flight:
+                            future.cancel()
+                    done, in_flight = concurrent.futures.wait(in_flight,
+                        return_when = concurrent.futures.FIRST_COMPLETED)
+                    collect([f for f in done if not f.cancelled()])
+        finally:
+            if checkpoint:
+                self.flush_cache()
+                checkpoint.flush()
+            self.sweep_progress.finish()
+            self.sweep_running = False
+    
+    def sweep_distributed(self, function, queue_directory, params = None, dependencies = [], force_recompute = False,
+                          coordinator = True, lease_size = 1000, lease_timeout = 60.0, worker_id = None,
+                          poll_interval = 5.0):
+        '''Sweep the parameter space together with workers on other machines
+
+        Work is coordinated through a :class:`tinc.sweep_queue.SweepWorkQueue` in
+        queue_directory, which must be on a filesystem shared by all machines
+        (e.g. NFS). Each machine runs this function with the same parameter
+        space, function and cache directory. Workers claim leases of samples,
+        renew them while they work, and take over leases abandoned by workers
+        that stopped. This function returns when all leases are done.
+
+        Results are written to the cache, which should be enabled on the same
+        shared directory on all machines.
+
+        :param function: Function to run for each parameter space sample
+        :param queue_directory: Shared directory for the work queue
+        :param params: If set, only the parameters provided will be sweept. The rest of the parameters in the ParameterSpace will be kept constant at their current value
+        :param dependencies: Parameters that the function depends on, but are not passed as arguments, and paths of files it reads
+        :param force_recompute: Always recompute function even if there is cache available
+        :param coordinator: If True, create the queue if it doesn't exist. Otherwise wait for a coordinator to create it
+        :param lease_size: Number of samples in each lease. Only used by the coordinator
+        :param lease_timeout: Time in seconds after which a lease that was not renewed is reclaimed
+        :param worker_id: Name of this worker in the queue. If None, one is generated
+        :param poll_interval: Time in seconds to wait when there are no pending leases
+        '''
+        if self.sweep_running:
+            print("Sweep is already running")
+            return
+        self.sweep_running = True
+        params = self._sweep_parameters(params)
+        signature = self._sweep_signature(function, params, dependencies)
+        queue = SweepWorkQueue(queue_directory, worker_id, lease_timeout)
+        strides = self._sample_strides(params)
+        self._start_sweep_progress(params)
+        try:
+            if coordinator:
+                queue.create(self.sample_count(params), lease_size, signature)
             else:
-                sweep_values = {p.id:p.values[indeces[i]] for i, p in enumerate(params)}
-                self.run_process(function, sweep_values, dependencies, force_recompute)
-            indeces[0] += 1
-            current_p = 0
-            while indeces[current_p] == index_max[current_p]:
-                indeces[current_p] = 0
-                if current_p == len(indeces) - 1:
-                    if indeces == [0]*len(params):
-                        done = True
+                while not queue.wait_for_queue(poll_interval, poll_interval / 5.0):
+                    if not self.sweep_running:
+                        return
+            if queue.info()["signature"] != signature:
+                raise ValueError(f"Sweep queue in {queue_directory} is for a different sweep")
+
+            while self.sweep_running:
+                lease_id = queue.claim()
+                if lease_id is None and queue.reclaim_expired() > 0:
+                    lease_id = queue.claim()
+                if lease_id is None:
+                    if queue.is_finished():
+                        break
+                    # Other workers still hold leases
+                    time.sleep(poll_interval)
+                    continue
+                heartbeat = _LeaseHeartbeat(queue, lease_id)
+                try:
+                    start, stop = queue.lease_range(lease_id)
+                    for index in range(start, stop):
+                        if not self.sweep_running or heartbeat.lost:
+                            break
+                        sample_indeces = self._sample_indeces(index, params, strides)
+                        sweep_values = {p.id: p.values[i] for p, i in zip(params, sample_indeces)}
+                        sample_start = time.monotonic()
+                        self._process_shared(function, self._complete_args(sweep_values), dependencies, force_recompute)
+                        self.sweep_progress.record(index, time.monotonic() - sample_start)
+                finally:
+                    heartbeat.stop()
+                if self.sweep_running and not heartbeat.lost:
+                    queue.complete(lease_id)
+                elif not heartbeat.lost:
+                    queue.release(lease_id)
+        finally:
+            self.sweep_progress.finish()
+            self.sweep_running = False
+
+    def _process_shared(self, function, args, dependencies, force_recompute):
+        # Like _process(), but merges with the cache metadata on disk, which other
+        # machines might have written to
+        calling_args = self._get_calling_args(function, args)
+        src_info = None
+        if self._cache_manager:
+            src_info = self._make_source_info(function, calling_args, dependencies)
+            if not force_recompute:
+                # Only reads the metadata if another process has written to it
+                self._cache_manager.update_from_disk()
+                found, out = self._load_cache_locked(src_info)
+                if found:
+                    return out
+        try:
+            start = _timestamp()
+            out = function(**calling_args)
+        except Exception:
+            print("Function call exception")
+            traceback.print_exc()
+            return None
+        if self._cache_manager:
+            # Writing the metadata merges with the entries other processes have written
+            self._store_cache_locked(function, calling_args, src_info, out, (start, _timestamp()))
+        return out
+
+    def sweep_vectorized(self, function, params = None, dependencies = [], force_recompute = False,
+                         chunk_size = 4096, output = 'cache'):
+        '''Sweep the parameter space evaluating many samples in a single function call
+
+        The function is called with a numpy array for each swept parameter,
+        holding the values for a chunk of samples (parameters not swept are
+        passed as their current value). It must return an array whose first
+        axis has one element per sample in the chunk, e.g. a function built
+        from numpy ufuncs.
+
+        :param function: Function to run for each chunk of samples
+        :param params: If set, only the parameters provided will be sweept. The rest of the parameters in the ParameterSpace will be kept constant at their current value
+        :param dependencies: Parameters that the function depends on, but are not passed as arguments, and paths of files it reads
+        :param force_recompute: Always recompute function even if there is cache available. Only used when output is 'cache'
+        :param chunk_size: Maximum number of samples passed to the function in a single call
+        :param output: 'cache' to store every sample as a cache entry, or 'array' to return the results
+        :returns: If output is 'array' a numpy array with one axis per swept parameter (plus any axes of the per sample result), otherwise None
+        '''
+        if output not in ('cache', 'array'):
+            raise ValueError("output must be 'cache' or 'array'")
+        if output == 'cache' and not self._cache_manager:
+            raise ValueError("Cache must be enabled with enable_cache() to use output='cache'")
+        if self.sweep_running:
+            print("Sweep is already running")
+            return
+        self.sweep_running = True
+        params = self._sweep_parameters(params)
+
+        shape = tuple(len(p.values) for p in params)
+        sample_count = self.sample_count(params)
+        strides = self._sample_strides(params)
+        space_values = [np.asarray(p.values) for p in params]
+        fixed_args = {p.id: p.value for p in self._parameters if not p in params}
+        result = None
+        self._start_sweep_progress(params)
+        try:
+            for start in range(0, sample_count, chunk_size):
+                if not self.sweep_running:
                     break
-                indeces[current_p + 1] += 1
-                current_p += 1
+                stop = min(start + chunk_size, sample_count)
+                indeces = tuple(self._sample_indeces(np.arange(start, stop), params, strides))
+
+                src_infos = None
+                if output == 'cache':
+                    samples = []
+                    for i in range(stop - start):
+                        args = {p.id: p.values[indeces[dim][i]] for dim, p in enumerate(params)}
+                        args.update(fixed_args)
+                        samples.append(self._get_calling_args(function, args))
+                    src_infos = [self._make_source_info(function, calling_args, dependencies) for calling_args in samples]
+                    if not force_recompute:
+                        src_infos = [None if len(self._cache_manager.find_cache(src_info)) > 0 else src_info
+                                     for src_info in src_infos]
+                        if all(src_info is None for src_info in src_infos):
+                            for index in range(start, stop):
+                                self.sweep_progress.record(index, 0.0, True)
+                            continue
+
+                args = {p.id: space_values[dim][indeces[dim]] for dim, p in enumerate(params)}
+                args.update(fixed_args)
+                start_time = datetime.datetime.now().astimezone()
+                out = np.asarray(function(**self._get_calling_args(function, args)))
+                # Store the average time per sample for the chunk
+                sample_duration = (datetime.datetime.now().astimezone() - start_time)/(stop - start)
+                timestamps = (start_time.isoformat(), (start_time + sample_duration).isoformat())
+                if out.ndim == 0:
+                    out = np.broadcast_to(out, (stop - start,))
+                elif out.shape[0] != stop - start:
+                    raise ValueError(f"Function returned {out.shape[0]} results for {stop - start} samples")
+
+                if output == 'array':
+                    if result is None:
+                        result = np.empty(shape + out.shape[1:], dtype = out.dtype)
+                    result[indeces] = out
+                else:
+                    with self._process_lock:
+                        for i, src_info in enumerate(src_infos):
+                            if src_info is None:
+                                continue
+                            # Check again together with the write, another writer may have
+                            # stored the sample while the chunk was computed
+                            if not force_recompute and len(self._cache_manager.find_cache(src_info)) > 0:
+                                continue
+                            self._store_cache(function, samples[i], src_info, out[i], timestamps)
+                for i in range(stop - start):
+                    self.sweep_progress.record(start + i, sample_duration.total_seconds(),
+                                               src_infos is not None and src_infos[i] is None)
+        finally:
+            self.sweep_progress.finish()
+            self.sweep_running = False
+        return result
 
-                
-        if force_values:
-            for p, orig_val in original_values.items():
-                p.value = orig_val
-        self.sweep_running = False
-                
-    
     def sweep_async(self, function, args=None, dependencies = [], force_recompute = False, force_values = False,num_threads = 1):
+        '''Run sweep() in the background.
+
+        If num_threads is larger than 1, the samples are distributed across a
+        thread pool using sweep_parallel(). force_values is not supported in
+        that case.
+        '''
         self.sweep_threads.clear()
-        # FIXME self.sweep_running is set at the end of sweep(), so num_threads > 1 will not work correctly
-        # FIXME support num_threads > 1 by slicing parameter space 
-        for i in range(num_threads):
+        if num_threads > 1:
+            if force_values:
+                print("force_values not supported with num_threads > 1. Ignoring")
+            self.sweep_threads.append(threading.Thread(target=self.sweep_parallel, 
+                args=(function, args, dependencies, force_recompute),
+                kwargs={'num_workers': num_threads, 'backend': 'thread'}))
+        else:
             self.sweep_threads.append(threading.Thread(target=self.sweep, 
                 args=(function, args, dependencies, force_recompute, force_values)))
-            self.sweep_threads[-1].start()
+        self.sweep_threads[-1].start()
 
     def stop_sweep(self):
         self.sweep_running = False
         for th in self.sweep_threads:
             th.join()
-        # TODO wait for sweep threads to end.
     
-    def run_process(self, function, args = None, dependencies = [], force_recompute = False):
-        # TODO add asynchronous mode
+    def run_process(self, function, args = None, dependencies = [], force_recompute = False, approximate = None):
+        '''Run function with the current parameter values, or the values in args
+
+        If the cache is enabled, the result is loaded from the cache when
+        available. Files listed in dependencies are fingerprinted when the
+        result is stored, and the cached result is not used if they change.
+
+        numpy arrays, and dicts of numpy arrays, loaded from the cache are
+        returned as read only np.memmap, so they must be copied before they
+        are modified in place.
+
+        With approximate lookups, if the result for the requested values is
+        not in the cache, the result of the nearest cached samples is used
+        when they are within tolerance, which avoids computing while exploring
+        a space interactively. The function is computed otherwise. The result
+        is then returned in a :class:`tinc.approximate_cache.ProcessResult`,
+        which says whether it is exact.
+
+        :param function: Function to run
+        :param args: (optional) dict of parameter id to value, or list of parameters. Parameters not set use their current value
+        :param dependencies: Parameters that the function depends on, but are not passed as arguments, and paths of files it reads
+        :param force_recompute: Always recompute function even if there is cache available
+        :param approximate: (optional) A :class:`tinc.approximate_cache.ApproximateLookup`, or True for the default options. Requires the cache to be enabled
+        '''
         with self._process_lock:
-            if args is None:
-                args = self._parameters
-            else:
-                if type(args) == list:
-                    for p in self._parameters:
-                        if not p in args:
-                            args.append(p)
-                elif type(args) == dict:
-                    for p in self._parameters:
-                        if p.id not in args.keys():
-                            args[p.id] = p.value
+            args = self._complete_args(args)
+            if approximate:
+                if approximate is True:
+                    approximate = ApproximateLookup()
+                return self._process_approximate(function, args, dependencies, force_recompute, approximate)
             # print("running _process()")
             return self._process(function, args, dependencies, force_recompute)
-            
-    def _process(self,function, args, dependencies = [], force_recompute = False):
+
+    def _run_sample(self, function, args, dependencies, force_recompute):
+        # Like run_process(), but returns a tuple (ok, output). ok is False if function raised
+        with self._process_lock:
+            return self._process_checked(function, self._complete_args(args), dependencies, force_recompute)
+
+    async def run_process_async(self, function, args = None, dependencies = [], force_recompute = False):
+        '''Awaitable version of run_process()
+
+        If function is a coroutine function it is awaited on the running event
+        loop, otherwise it is run in the loop's default executor. Cache lookups
+        and stores are also run in the executor so they don't block the loop.
+        '''
+        ok, out = await self._run_sample_async(function, args, dependencies, force_recompute)
+        return out
+
+    async def _run_sample_async(self, function, args, dependencies, force_recompute):
+        # Like run_process_async(), but returns a tuple (ok, output). ok is False if function raised
+        loop = asyncio.get_running_loop()
+        args = self._complete_args(args)
+        calling_args = self._get_calling_args(function, args)
         
-        named_args = inspect.getfullargspec(function)[0]
+        out = None
+        src_info = None
+        if self._cache_manager:
+            src_info = self._make_source_info(function, calling_args, dependencies)
+            if not force_recompute:
+                found, out = await loop.run_in_executor(None, self._load_cache_locked, src_info)
+                if found:
+                    return True, out
+        try:
+            start = _timestamp()
+            if inspect.iscoroutinefunction(function):
+                out = await function(**calling_args)
+            else:
+                out = await loop.run_in_executor(None, functools.partial(function, **calling_args))
+            if self._cache_manager:
+                await loop.run_in_executor(None, self._store_cache_locked, function, calling_args, src_info, out,
+                                           (start, _timestamp()))
+        except Exception as e:
+            print("Function call exception")
+            traceback.print_exc()
+            return False, out
+        return True, out
+
+    async def sweep_async_io(self, coro_fn, params = None, dependencies = [], force_recompute = False,
+                             max_concurrency = 8, callback = None, checkpoint = None, checkpoint_interval = 30.0,
+                             order = 'lexicographic'):
+        '''Sweep the parameter space on the running asyncio event loop
+
+        At most max_concurrency samples are processed at the same time through
+        run_process_async(). This is useful when the work for each sample is
+        mostly waiting, e.g. for subprocesses or remote commands.
+
+        :param coro_fn: Coroutine function (or function) to run for each parameter space sample
+        :param params: If set, only the parameters provided will be sweept. The rest of the parameters in the ParameterSpace will be kept constant at their current value
+        :param dependencies: Parameters that the function depends on, but are not passed as arguments, and paths of files it reads
+        :param force_recompute: Always recompute function even if there is cache available
+        :param max_concurrency: Maximum number of samples processed concurrently
+        :param callback: (optional) Function called as callback(sample_values, result) as results arrive
+        :param checkpoint: (optional) Checkpoint file name. See sweep()
+        :param checkpoint_interval: Time in seconds between writes of the checkpoint file
+        :param order: Order in which samples are processed. See sweep()
+        '''
+        if self.sweep_running:
+            print("Sweep is already running")
+            return
+        self.sweep_running = True
+        params = self._sweep_parameters(params)
+        checkpoint = self._sweep_checkpoint(checkpoint, coro_fn, params, dependencies, checkpoint_interval)
+        # Shared by all workers. Advancing the generator never awaits, so this is safe on a single loop
+        samples = self._iter_sweep_values(params, checkpoint, order)
+        self._start_sweep_progress(params, checkpoint)
+
+        async def worker():
+            for index, sweep_values in samples:
+                start = time.monotonic()
+                ok, out = await self._run_sample_async(coro_fn, dict(sweep_values), dependencies, force_recompute)
+                self.sweep_progress.record(index, time.monotonic() - start)
+                if callback:
+                    callback(sweep_values, out)
+                # Samples that failed are retried when the sweep is resumed
+                if ok and checkpoint:
+                    self._mark_sample_done(checkpoint, index)
+
+        try:
+            await asyncio.gather(*[worker() for i in range(max_concurrency)])
+        finally:
+            if checkpoint:
+                await asyncio.get_running_loop().run_in_executor(None, self.flush_cache)
+                checkpoint.flush()
+            self.sweep_progress.finish()
+            self.sweep_running = False
+
+    def _complete_args(self, args):
+        # Add current values for parameters not in args
+        if args is None:
+            args = self._parameters
+        else:
+            if type(args) == list:
+                for p in self._parameters:
+                    if not p in args:
+                        args.append(p)
+            elif type(args) == dict:
+                for p in self._parameters:
+                    if p.id not in args.keys():
+                        args[p.id] = p.value
+        return args
+
+    def _call_plan(self, function):
+        # Call plans are cached per function, and dropped when the function is garbage collected
+        try:
+            plan = self._call_plans.get(function)
+        except TypeError:
+            # Function can't be weakly referenced
+            return _CallPlan(self, function)
+        if plan is None:
+            plan = _CallPlan(self, function)
+            self._call_plans[function] = plan
+        return plan
+
+    def _get_calling_args(self, function, args):
+        named_args = self._call_plan(function).named_args
         # Only use arguments that can be passed to the function
-        calling_args = {}
         if type(args) == dict:
-            for key, value in args.items():
-                if key in named_args:
-                    calling_args[key] = value
-            unused_args = [a for a in calling_args.keys() if not a in named_args]
+            calling_args = {key: value for key, value in args.items() if key in named_args}
         elif type(args) == list:
+            calling_args = {}
             for p in args:
                 if issubclass(type(p),Parameter):
                     if p.id in named_args:
                         calling_args[p.id] = p.value
-                elif issubclass(type(p),ParameterString):
-                    if p.id in named_args:
-                        calling_args[p.id] = p.value
                 else:
                     print("ERROR argument element to _process() is not a Parameter type. Ignoring")
-            
-            unused_args = [p for p in calling_args.keys() if not p in named_args]
         else:
             raise ValueError("args argument can take a list of parameter or a dict of values")
+        return calling_args
+
+    def _make_source_info(self, function, calling_args, dependencies = []):
+        # TODO store metadata about function to know if we need to reprocess cache
+        # TODO set working path and hash in src_info
+        plan = self._call_plan(function)
         
-        if len(unused_args) > 0:
-            print(f'Ignoring parameters: {unused_args}. Not used in function')
-        
-        out = None
-        if self._cache_manager:
-            # TODO store metadata about function to know if we need to reprocess cache
-            # TODO set working path and hash in src_info
-            
-            args = []
-            for id,value in calling_args.items():
+        args = []
+        for id,value in calling_args.items():
+            variant_type = _ARG_VARIANT_TYPES.get(type(value))
+            if variant_type is None:
+                print(f"Unsupported type for arg: {id} - {type(value)}")
                 nctype = VariantType.VARIANT_DOUBLE
-                if type(value) == int:
-                    nctype = VariantType.VARIANT_INT64
-                elif type(value) == float:
-                    nctype = VariantType.VARIANT_DOUBLE
-                elif type(value) == np.int32:
-                    nctype = VariantType.VARIANT_INT32
-                    value = int(value) # json can't handle int32
-                elif type(value) == np.float64:
-                    nctype = VariantType.VARIANT_DOUBLE
-                    # value = value
-                else:
-                    print(f"Unsupported type for arg: {id} - {type(value)}")
-
-                args.append(SourceArgument(id = id, 
-                                            value = VariantValue(nctype = nctype,
-                                                                value = value)))
-
-            deps = []
-            for dep in dependencies:
-                if type(dep) == Parameter:
-                    nctype = VariantType.VARIANT_FLOAT
-                elif type(dep) == ParameterInt:
-                    nctype = VariantType.VARIANT_INT32
-                elif type(dep) == ParameterString:
-                    nctype = VariantType.VARIANT_STRING
+            else:
+                nctype, converter = variant_type
+                if converter is not None:
+                    value = converter(value)
+
+            args.append(SourceArgument(id = id, 
+                                        value = VariantValue(nctype = nctype,
+                                                            value = value)))
+
+        deps = []
+        file_deps = []
+        for dep in dependencies:
+            if type(dep) == str:
+                path = os.path.abspath(dep)
+                file_deps.append(FileDependency(file = DistributedPath(filename = os.path.basename(path),
+                                                                       relative_path = os.path.dirname(path) + '/',
+                                                                       protocol_id = "file")))
+                continue
+            nctype = _DEPENDENCY_VARIANT_TYPES.get(type(dep))
+            if nctype is None:
+                # TODO ML add support for all types
+                print("Warning unsupported type")
+                nctype = VariantType.VARIANT_NONE
+
+            deps.append(SourceArgument(id = dep.id, 
+                                       value = VariantValue(nctype = nctype,
+                                                            value = dep.value)))
+
+        # TODO there needs to be a special character to avoid tinc id clashes for these auto generated
+        # tinc ids. e.g. self.id + '@' + function.__name__. The disallow @ in all other tinc id names.
+        # Perhaps use space? That is already disallowed because of OSC address limitations.
+        
+        return SourceInfo(
+                type = "PythonInMemory",
+                tinc_id = plan.tinc_id,
+                command_line_arguments = "", # This could be used to store function information
+                working_path_rel = "",
+                working_path_root = "",
+                arguments = args,
+                dependencies = deps,
+                file_dependencies = plan.file_dependencies() + file_deps)
+
+    def _load_cache(self, src_info):
+        '''Returns a tuple (found, output)'''
+        if self._cache_writer:
+            found, out = self._cache_writer.get(source_info_key(src_info))
+            if found:
+                return True, out
+        # Results in memory are not checked against their file dependencies
+        use_memory_cache = self._memory_cache and not _has_file_dependencies(src_info)
+        if use_memory_cache:
+            # Entries removed from the cache on disk are dropped from memory
+            # by _cache_entry_removed(), but the SQLite backend is not told of
+            # removals by other processes. Results are checked again when the
+            # generation of the cache changes
+            generation = self._cache_manager.generation()
+            found, out = self._memory_cache.get(source_info_key(src_info), generation,
+                                                lambda key: self._cache_manager.has_entry(src_info))
+            if found:
+                return True, out
+        cache_filenames = self._cache_manager.find_cache(src_info)
+        # TODO mark as stale if needed
+        found, out = self._load_cache_files(cache_filenames)
+        if found:
+            self._disk_cache_hits += 1
+            if use_memory_cache:
+                self._memory_cache.put(source_info_key(src_info), out,
+                                       self._cache_files_size(cache_filenames), generation)
+        else:
+            self._disk_cache_misses += 1
+        return found, out
+
+    def _cache_files_size(self, cache_filenames):
+        size = 0
+        for fname in cache_filenames:
+            try:
+                size += os.path.getsize(self._cache_manager.cache_directory() + fname)
+            except OSError:
+                pass
+        return size
+
+    def _load_cache_files(self, cache_filenames):
+        try:
+            for fname in cache_filenames:
+                cache_file_path = self._cache_manager.cache_directory() +"/" + fname
+                if os.path.exists(cache_file_path):
+                    start = time.perf_counter()
+                    codec = codec_for_file(fname)
+                    if codec is None:
+                        out = serializer_for_file(fname).load(cache_file_path)
+                    else:
+                        out = load_compressed(serializer_for_file(fname[:-len(codec.extension)]),
+                                              codec, cache_file_path)
+                    self._cache_manager.record_load(os.path.getsize(cache_file_path),
+                                                    time.perf_counter() - start)
+                    if self.debug:
+                        print(f"loaded cache: {cache_file_path}")
+                    return True, out
                 else:
-                    # TODO ML add support for all types
-                    print("Warning unsupported type")
+                    print(f"ERROR finding cache file: {self._cache_manager.cache_directory() + '/' +fname}")
+        except:
+            print("Cache is empty. Trying to generate cache")
+            traceback.print_exc()
+        return False, None
 
-                deps.append(SourceArgument(id = dep.id, 
-                                           value = VariantValue(nctype = nctype,
-                                                                value = dep.value)))
+    def _store_cache(self, function, calling_args, src_info, out, timestamps = None):
+        # FIXME write complete metadata 
+        if timestamps is None:
+            timestamps = (_timestamp(), _timestamp())
+        if self._cache_writer:
+            self._cache_writer.submit(source_info_key(src_info), out, result_size(out),
+                                      functools.partial(self._write_cache, function, calling_args, src_info, out,
+                                                        timestamps, True))
+        elif self._write_cache(function, calling_args, src_info, out, timestamps):
+            self._cache_manager.write_to_disk()
 
-            fdeps = []
+    def _write_cache(self, function, calling_args, src_info, out, timestamps, durable = False):
+        # Writes the result file and appends its entry. Returns True on success
+        # If durable, the file is flushed to disk before the entry is appended
+        try:
+            start = time.perf_counter()
+            serializer = serializer_for_result(out)
+            cache_directory = self._cache_manager.cache_directory()
+            if self._cache_file_layout == 'content':
+                # Named after the hash of the content once it is written
+                relative_path = BLOB_DIRECTORY
+                base_name = str(threading.get_ident())
+            elif self._cache_file_layout == 'sharded':
+                # The mapping from arguments to file is only kept in the metadata
+                file_hash = source_info_hash(src_info)
+                relative_path = shard_directory(file_hash)
+                base_name = file_hash
+            else:
+                relative_path = ''
+                args_text = '_'.join([str(v) for v in calling_args.values()])
+                base_name = self._call_plan(function).cache_file_prefix + args_text + "_cache"
+            os.makedirs(cache_directory + relative_path, exist_ok = True)
+            # Replace the file instead of overwriting it, as it might be memory mapped
+            # The temporary file is unique to the process, as other processes
+            # sharing the cache directory might be storing the same result
+            tmp_path = f"{cache_directory}{relative_path}{base_name}{serializer.extension}.{os.getpid()}.tmp"
+            compression = ''
+            content_hash = ''
+            with open(tmp_path, "wb") as f:
+                writer = _HashingWriter(f) if self._cache_file_layout == 'content' else f
+                if self._cache_compression and self._cache_compression.can_compress(serializer):
+                    compression = self._cache_compression.store(serializer, out, writer)
+                else:
+                    serializer.store(out, writer)
+                if self._cache_file_layout == 'content':
+                    content_hash = writer.hexdigest()
+                    relative_path = blob_directory(content_hash)
+                    base_name = content_hash
+                filename = base_name + serializer.extension
+                if compression != '':
+                    filename += self._cache_compression.codec.extension
+                fullpath = cache_directory + relative_path + filename
+                # Identical results are stored once in the content layout
+                duplicate = content_hash != '' and os.path.exists(fullpath)
+                if durable and not duplicate:
+                    f.flush()
+                    os.fsync(f.fileno())
             if self.debug:
-                print(dis.dis(function))
-                print(inspect.getsource(function))
-            # TODO set filename and root path
-            dist_path =  DistributedPath()
-            dist_path.filename = ""
-            dist_path.relative_path = os.getcwd()
-            dist_path.root_path = ""
-            dist_path.protocol_id = "python"
-            fdeps.append(FileDependency(file = dist_path,
-                                        modified = "",
-                                        size = 0,
-                                        hash = ""
-                                        ))
-            # TODO there needs to be a special character to avoid tinc id clashes for these auto generated
-            # tinc ids. e.g. self.id + '@' + function.__name__. The disallow @ in all other tinc id names.
-            # Perhaps use space? That is already disallowed because of OSC address limitations.
+                print("storing cache: " + fullpath + (" (already stored)" if duplicate else ""))
+            if duplicate:
+                os.remove(tmp_path)
+            else:
+                os.makedirs(cache_directory + relative_path, exist_ok = True)
+                os.replace(tmp_path, fullpath)
+                if durable:
+                    _fsync_directory(os.path.dirname(fullpath))
+            size = os.path.getsize(fullpath)
+            self._cache_manager.record_store(0 if duplicate else size, time.perf_counter() - start)
+            if self._memory_cache and not _has_file_dependencies(src_info):
+                self._memory_cache.put(source_info_key(src_info), out, size)
+            src_info = self._cache_manager.fingerprint(src_info)
+            dist_path = DistributedPath()
+            dist_path.filename = filename
+            dist_path.relative_path = relative_path
+            entry = CacheEntry(timestamp_start=timestamps[0],
+                            timestamp_end=timestamps[1],
+                            files=[FileDependency(file = dist_path, size = size, hash = content_hash)],
+                            user_info=UserInfo(user_name='name',
+                                                user_hash='hash',
+                                                ip='ip',
+                                                port=9001,
+                                                server=False),
+                            source_info=src_info,
+                            cache_hits=0,
+                            stale=False,
+                            compression=compression)
+            if len(self._approximate_indeces) > 0:
+                generation = self._cache_manager.generation()
+                self._cache_manager.append_entry(entry)
+                self._index_sample(entry, generation)
+            else:
+                self._cache_manager.append_entry(entry)
+            return True
+        except:
+            print("Error creating cache")
+            traceback.print_exc()
+            return False
+
+    def _write_cache_metadata(self):
+        # Called by the write-behind thread after a batch of results is written
+        if self._cache_manager:
+            self._cache_manager.write_to_disk()
             
-            src_info = SourceInfo(
-                    type = "PythonInMemory",
-                    tinc_id = self.id + "_" + function.__name__,
-                    command_line_arguments = "", # This could be used to store function information
-                    working_path_rel = "",
-                    working_path_root = "",
-                    arguments = args,
-                    dependencies = deps,
-                    file_dependencies = fdeps)
+    def _process_approximate(self, function, args, dependencies, force_recompute, lookup):
+        if not self._cache_manager:
+            raise ValueError("Cache must be enabled with enable_cache() for approximate lookups")
+        calling_args = self._get_calling_args(function, args)
+        if not force_recompute:
+            src_info = self._make_source_info(function, calling_args, dependencies)
+            found, out = self._load_cache(src_info)
+            if found:
+                return ProcessResult(out, True)
+            continuous_ids = _continuous_ids(calling_args)
+            if len(continuous_ids) > 0:
+                neighbours = self._nearest_samples(src_info, calling_args, continuous_ids, lookup)
+                if len(neighbours) > 0:
+                    if lookup.interpolate is None:
+                        out = neighbours[0].result
+                    else:
+                        out = lookup.interpolate({id: calling_args[id] for id in continuous_ids}, neighbours)
+                    return ProcessResult(out, False, neighbours[0].distance, neighbours)
+        return ProcessResult(self._process(function, args, dependencies, True), True)
+
+    def _nearest_samples(self, src_info, calling_args, continuous_ids, lookup):
+        # Cached samples within tolerance of the requested one, nearest first.
+        # Without interpolation only the nearest sample that can be loaded is
+        # returned, so the results of the others are not read
+        normalization = [self._normalization(id) for id in continuous_ids]
+        index = self._sample_index(src_info, continuous_ids, normalization)
+        point = [(calling_args[id] - offset) / scale for id, (offset, scale) in zip(continuous_ids, normalization)]
+        neighbours = []
+        for distance, (values, cache_filenames) in index.query(point, lookup.k, lookup.tolerance):
+            found, out = self._load_cache_files(cache_filenames)
+            if found:
+                neighbours.append(NearestSample(values, distance, out))
+                if lookup.interpolate is None:
+                    break
+        return neighbours
+
+    def _normalization(self, param_id):
+        # (offset, scale) that map the range of a parameter to [0, 1]
+        p = self.get_parameter(param_id)
+        if p is None or p.maximum <= p.minimum:
+            return (0.0, 1.0)
+        return (float(p.minimum), float(p.maximum - p.minimum))
+
+    def _sample_index(self, src_info, continuous_ids, normalization):
+        # The index is rebuilt when entries are added to or removed from the
+        # cache other than by _write_cache(), see _index_sample()
+        self.flush_cache()
+        key = _group_key(src_info, continuous_ids)
+        generation = self._cache_manager.generation()
+        cached = self._approximate_indeces.get(key)
+        if cached is not None and cached[0] == generation and cached[1] == normalization:
+            return cached[2]
+        coordinates = []
+        samples = []
+        keys = []
+        for entry in self._cache_manager.entries():
+            source_info = entry.source_info
+            if entry.stale or source_info.tinc_id != src_info.tinc_id \
+                or _group_key(source_info, continuous_ids) != key:
+                    continue
+            sample = _index_entry(entry, continuous_ids, normalization)
+            if sample is not None:
+                coordinates.append(sample[0])
+                samples.append(sample[1])
+                keys.append(sample[2])
+        index = SampleIndex(coordinates, samples, keys)
+        self._approximate_indeces[key] = (generation, normalization, index)
+        return index
+
+    def _index_sample(self, entry, generation):
+        # Adds an entry appended by _write_cache() to the indeces of
+        # _sample_index() that were up to date at generation, before it was
+        # appended, instead of rebuilding them. Entries evicted when it was
+        # appended are removed by _cache_entry_removed(). Entries added by
+        # other processes in the meantime are only seen after a rebuild
+        new_generation = self._cache_manager.generation()
+        for key, (index_generation, normalization, index) in list(self._approximate_indeces.items()):
+            if index_generation != generation:
+                continue
+            continuous_ids = key[1]
+            if _group_key(entry.source_info, continuous_ids) == key:
+                sample = _index_entry(entry, continuous_ids, normalization)
+                if sample is not None:
+                    index.add(*sample)
+            self._approximate_indeces[key] = (new_generation, normalization, index)
+
+    def _load_cache_locked(self, src_info):
+        with self._process_lock:
+            return self._load_cache(src_info)
+
+    def _load_cache_files_locked(self, cache_filenames):
+        with self._process_lock:
+            return self._load_cache_files(cache_filenames)
+
+    def _store_cache_locked(self, function, calling_args, src_info, out, timestamps = None):
+        with self._process_lock:
+            self._store_cache(function, calling_args, src_info, out, timestamps)
+
+    def _process(self,function, args, dependencies = [], force_recompute = False):
+        ok, out = self._process_checked(function, args, dependencies, force_recompute)
+        return out
+
+    def _process_checked(self, function, args, dependencies = [], force_recompute = False):
+        # Returns a tuple (ok, output). ok is False if function raised
+        calling_args = self._get_calling_args(function, args)
+        
+        out = None
+        src_info = None
+        if self._cache_manager:
+            src_info = self._make_source_info(function, calling_args, dependencies)
             if not force_recompute:
-                cache_filenames = self._cache_manager.find_cache(src_info, dependencies)
-                # TODO mark as stale if needed
-                try:
-                    for fname in cache_filenames:
-                        cache_file_path = self._cache_manager.cache_directory() +"/" + fname
-                        if os.path.exists(cache_file_path):
-                            with open(cache_file_path, 'rb') as f:
-                                out = pickle.load(f)
-                                if self.debug:
-                                    print(f"loaded cache: {cache_file_path}")
-                                return out
-                                # TODO increase cache hits
-                        else:
-                            print(f"ERROR finding cache file: {self._cache_manager.cache_directory() + '/' +fname}")
-                except:
-                    print("Cache is empty. Trying to generate cache")
-                    traceback.print_exc()
+                found, out = self._load_cache(src_info)
+                if found:
+                    return True, out
         try:
             #print("Calling function with: " + str(calling_args))
+            start = _timestamp()
             out = function(**calling_args)
             if self._cache_manager:
-                # FIXME write complete metadata 
-                try:
-                    args_text = '_'.join([str(v) for v in calling_args.values()])
-                    filename = self.id + "_" + function.__name__ + "_" + args_text + "_cache.pkl"
-                    fullpath = self._cache_manager.cache_directory() + "/" + filename
-                    if self.debug:
-                        print("storing cache: " + fullpath)
-                    with open(fullpath, "wb") as f:
-                        pickle.dump(out, f)
-                    dist_path = DistributedPath()
-                    dist_path.filename = filename
-                    entry = CacheEntry(timestamp_start='a',
-                                    timestamp_end='b',
-                                    files=[FileDependency(file = dist_path)],
-                                    user_info=UserInfo(user_name='name',
-                                                        user_hash='hash',
-                                                        ip='ip',
-                                                        port=9001,
-                                                        server=False),
-                                    source_info=src_info,
-                                    cache_hits=0,
-                                    stale=False)
-                    self._cache_manager.append_entry(entry)
-                    self._cache_manager.write_to_disk()
-                except:
-                    print("Error creating cache")
-                    traceback.print_exc()
+                self._store_cache(function, calling_args, src_info, out, (start, _timestamp()))
         except Exception as e:
             print("Function call exception")
             traceback.print_exc()
-            
+            return False, out
         # print("done _process()")
-        return out
+        return True, out
+
+
+# Python type to (VariantType, converter to a json compatible value) for function arguments
+_ARG_VARIANT_TYPES = {
+    int: (VariantType.VARIANT_INT64, None),
+    float: (VariantType.VARIANT_DOUBLE, None),
+    np.int32: (VariantType.VARIANT_INT32, int), # json can't handle int32
+    np.float64: (VariantType.VARIANT_DOUBLE, None),
+    }
+
+_DEPENDENCY_VARIANT_TYPES = {
+    Parameter: VariantType.VARIANT_FLOAT,
+    ParameterInt: VariantType.VARIANT_INT32,
+    ParameterString: VariantType.VARIANT_STRING,
+    }
+
+class _CallPlan(object):
+    # Per function data needed to call it and cache its results, computed once
+    def __init__(self, parameter_space, function):
+        self.named_args = frozenset(inspect.getfullargspec(function)[0])
+        self.tinc_id = parameter_space.id + "_" + function.__name__
+        self.cache_file_prefix = self.tinc_id + "_"
+        self._working_path = None
+        self._file_dependencies = None
+        if parameter_space.debug:
+            print(dis.dis(function))
+            print(inspect.getsource(function))
+
+    def file_dependencies(self):
+        working_path = os.getcwd()
+        if working_path != self._working_path:
+            # TODO set filename and root path
+            dist_path =  DistributedPath()
+            dist_path.filename = ""
+            dist_path.relative_path = working_path
+            dist_path.root_path = ""
+            dist_path.protocol_id = "python"
+            self._file_dependencies = [FileDependency(file = dist_path,
+                                                      modified = "",
+                                                      size = 0,
+                                                      hash = ""
+                                                      )]
+            self._working_path = working_path
+        return self._file_dependencies
+
+class _HashingWriter(object):
+    # Writes to a file and computes the hash of the data written, to name
+    # files in the content layout
+    def __init__(self, f):
+        self._f = f
+        self._hash = hashlib.sha1()
+
+    def write(self, data):
+        self._hash.update(data)
+        return self._f.write(data)
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+def _has_file_dependencies(src_info):
+    return any(f.file.filename != '' for f in src_info.file_dependencies)
+
+def _timestamp():
+    return datetime.datetime.now().astimezone().isoformat()
+
+# Upper bound for the default chunk size of sweep_parallel(), so large sweeps
+# are not held in a few big chunks and progress is reported steadily
+_MAX_CHUNK_SIZE = 64
+
+def _run_sweep_chunk(function, chunk):
+    # Runs in the worker pool for ParameterSpace.sweep_parallel()
+    results = []
+    for index, calling_args in chunk:
+        start = _timestamp()
+        start_time = time.monotonic()
+        try:
+            out = function(**calling_args)
+            results.append((index, out, True, (start, _timestamp()), time.monotonic() - start_time))
+        except Exception:
+            print("Function call exception")
+            traceback.print_exc()
+            results.append((index, None, False, None, time.monotonic() - start_time))
+    return results
@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+"""
+Cache metadata stored in a SQLite database instead of a json file.
+"""
+
+import json
+import os
+import sqlite3
+import traceback
+
+from .cachemanager import CacheManager, _entries_from_metadata, _entry_from_json, _entry_size, _entry_to_json, _file_size, _metadata_to_json, _migrate_entry_files, _timestamp, cache_file_name, source_info_hash, source_info_key
+
+class SqliteCacheManager(CacheManager):
+    '''Cache manager that stores its metadata in a SQLite database.
+
+    Entries are written to the database as they are appended and looked up
+    through an indexed key column, so the cost of appending and finding
+    entries does not grow with the size of the cache. The database uses WAL
+    journaling, so other processes can read it while it is written.
+
+    The cache files are the same as for :class:`CacheManager`. Use
+    import_json() and export_json() to convert from and to the json metadata
+    format used by TINC in C++.
+
+    :param directory: Cache directory
+    :param metadata_file: Name of the database file in the cache directory
+    '''
+    def __init__(self, directory = "python_cache", metadata_file = "tinc_cache.sqlite"):
+        self._db = None
+        super().__init__(directory, metadata_file)
+        # Other processes sharing the cache can hold the write lock for a while
+        self._db = sqlite3.connect(self.cache_directory() + self._metadata_file, check_same_thread = False,
+                                   timeout = 60)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS entries ("
+                         "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                         "key TEXT NOT NULL, "
+                         "tinc_id TEXT NOT NULL, "
+                         "entry TEXT NOT NULL, "
+                         "size INTEGER NOT NULL DEFAULT 0, "
+                         "hits INTEGER NOT NULL DEFAULT 0, "
+                         "access INTEGER NOT NULL DEFAULT 0)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS entries_key ON entries (key)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS entries_access ON entries (access)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS entries_hits ON entries (hits, access)")
+        # Files of each entry, to only remove files shared by several entries with the last one
+        has_files_table = self._db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'files'").fetchone() is not None
+        self._db.execute("CREATE TABLE IF NOT EXISTS files ("
+                         "entry_id INTEGER NOT NULL, "
+                         "name TEXT NOT NULL, "
+                         "size INTEGER NOT NULL DEFAULT 0)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS files_name ON files (name)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS files_entry ON files (entry_id)")
+        if not has_files_table:
+            # Databases written by earlier versions
+            for entry_id, entry in self._db.execute("SELECT id, entry FROM entries").fetchall():
+                self._insert_files(entry_id, _entry_from_json(json.loads(entry)))
+        self._db.commit()
+        # Increasing counter that orders entries by last access
+        self._access_count = self._db.execute("SELECT COALESCE(MAX(access), 0) FROM entries").fetchone()[0]
+
+    def append_entry(self, entry):
+        self._lock()
+        try:
+            entry_id = self._insert(entry)
+            if self._max_bytes is not None or self._max_entries is not None:
+                self._evict(keep_id = entry_id)
+            self._db.commit()
+        finally:
+            self._unlock()
+
+    def entries(self, count = 0):
+        self._lock()
+        try:
+            if count == 0:
+                rows = self._db.execute("SELECT entry FROM entries ORDER BY id").fetchall()
+            else:
+                rows = self._db.execute("SELECT entry FROM entries ORDER BY id DESC LIMIT ?", (count,)).fetchall()
+                rows.reverse()
+        finally:
+            self._unlock()
+        return [_entry_from_json(json.loads(row[0])) for row in rows]
+
+    def find_cache(self, source_info, verify_hash = True):
+        self._lock()
+        try:
+            rows = self._db.execute("SELECT id, entry FROM entries WHERE key = ? ORDER BY id",
+                                    (_db_key(source_info),)).fetchall()
+        finally:
+            self._unlock()
+        candidates = _matching_entries(source_info_key(source_info), rows)
+        found = self._select_valid([candidates], verify_hash)[0]
+        self._stats.record_lookup(found is not None)
+        if found is None:
+            return []
+        entry_id, entry = found
+        entry = entry._replace(cache_hits = entry.cache_hits + 1, last_access = _timestamp())
+        self._lock()
+        try:
+            self._access_count += 1
+            self._db.execute("UPDATE entries SET entry = ?, hits = ?, access = ? WHERE id = ?",
+                             (json.dumps(_entry_to_json(entry)), entry.cache_hits, self._access_count, entry_id))
+            self._db.commit()
+        finally:
+            self._unlock()
+        return [cache_file_name(f) for f in entry.files]
+
+    def has_entry(self, source_info):
+        self._lock()
+        try:
+            rows = self._db.execute("SELECT id, entry FROM entries WHERE key = ?",
+                                    (_db_key(source_info),)).fetchall()
+        finally:
+            self._unlock()
+        return len(_matching_entries(source_info_key(source_info), rows)) > 0
+
+    def find_entries(self, source_infos, verify_hash = True):
+        source_infos = list(source_infos)
+        keys = [_db_key(src_info) for src_info in source_infos]
+        found = {}
+        self._lock()
+        try:
+            unique_keys = list(set(keys))
+            # Stay below the SQLite limit on the number of query parameters
+            for start in range(0, len(unique_keys), 500):
+                batch = unique_keys[start:start + 500]
+                rows = self._db.execute("SELECT key, id, entry FROM entries WHERE key IN ("
+                                        + ",".join("?" * len(batch)) + ") ORDER BY id", batch).fetchall()
+                for key, entry_id, entry in rows:
+                    found.setdefault(key, []).append((entry_id, entry))
+        finally:
+            self._unlock()
+        candidates = [_matching_entries(source_info_key(src_info), found.get(key, []))
+                      for src_info, key in zip(source_infos, keys)]
+        return [None if f is None else f[1] for f in self._select_valid(candidates, verify_hash)]
+
+    def clear_cache(self):
+        self._lock()
+        try:
+            for row in self._db.execute("SELECT DISTINCT name FROM files"):
+                full_name = self.cache_directory() + row[0]
+                try:
+                    os.remove(full_name)
+                except:
+                    print("ERROR removing cache entry: " + full_name)
+            self._db.execute("DELETE FROM entries")
+            self._db.execute("DELETE FROM files")
+            self._generation += 1
+            self._db.commit()
+        finally:
+            self._unlock()
+        if self.on_remove:
+            self.on_remove(None)
+
+    def set_cache_budget(self, max_bytes = None, max_entries = None, policy = 'lru'):
+        if policy not in ('lru', 'lfu'):
+            raise ValueError("policy must be 'lru' or 'lfu'")
+        self._lock()
+        try:
+            self._max_bytes = max_bytes
+            self._max_entries = max_entries
+            self._eviction_policy = policy
+            if self._max_bytes is not None or self._max_entries is not None:
+                self._evict()
+            self._db.commit()
+        finally:
+            self._unlock()
+
+    def cache_size(self):
+        self._lock()
+        try:
+            # Files shared by several entries are counted once
+            return self._db.execute("SELECT COALESCE(SUM(size), 0) FROM "
+                                    "(SELECT MAX(size) AS size FROM files GROUP BY name)").fetchone()[0]
+        finally:
+            self._unlock()
+
+    def entry_count(self):
+        self._lock()
+        try:
+            return self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        finally:
+            self._unlock()
+
+    def generation(self):
+        # Incremented by the changes of this process. PRAGMA data_version
+        # changes when other connections commit, without scanning the table
+        self._lock()
+        try:
+            return (self._generation, self._db.execute("PRAGMA data_version").fetchone()[0])
+        finally:
+            self._unlock()
+
+    def migrate_to_sharded(self):
+        self._lock()
+        moved = 0
+        try:
+            for entry_id, entry in self._db.execute("SELECT id, entry FROM entries").fetchall():
+                entry = _entry_from_json(json.loads(entry))
+                new_entry, count = _migrate_entry_files(self.cache_directory(), entry)
+                if new_entry != entry:
+                    self._db.execute("UPDATE entries SET entry = ? WHERE id = ?",
+                                     (json.dumps(_entry_to_json(new_entry)), entry_id))
+                    self._db.execute("DELETE FROM files WHERE entry_id = ?", (entry_id,))
+                    self._insert_files(entry_id, new_entry)
+                    self._generation += 1
+                moved += count
+            self._db.commit()
+        finally:
+            self._unlock()
+        return moved
+
+    def update_from_disk(self):
+        # Queries always read the database, nothing to reload
+        pass
+
+    def write_to_disk(self):
+        # Entries are committed when appended
+        pass
+
+    def import_json(self, filename = None):
+        '''Append the entries from a json metadata file
+
+        :param filename: Path to the json file. Defaults to tinc_cache.json in the cache directory
+        :returns: The number of entries imported
+        '''
+        if filename is None:
+            filename = self.cache_directory() + "tinc_cache.json"
+        try:
+            with open(filename) as f:
+                j = json.load(f)
+        except:
+            if self.debug:
+                traceback.print_exc()
+            print(f"Can't read cache metadata file {filename}")
+            return 0
+        entries = _entries_from_metadata(j, self._validator, self.debug)
+        if entries is None:
+            return 0
+        count = 0
+        self._lock()
+        try:
+            for entry in entries:
+                self._insert(entry)
+                count += 1
+            self._db.commit()
+        finally:
+            self._unlock()
+        return count
+
+    def export_json(self, filename = None):
+        '''Write all entries to a json metadata file that TINC in C++ can read
+
+        :param filename: Path to the json file. Defaults to tinc_cache.json in the cache directory
+        '''
+        if filename is None:
+            filename = self.cache_directory() + "tinc_cache.json"
+        j = _metadata_to_json(self.entries())
+        tmp_filename = filename + ".tmp"
+        with open(tmp_filename, 'w') as f:
+            json.dump(j, f, indent=4)
+        os.replace(tmp_filename, filename)
+
+    def close(self):
+        # Hits are committed as they happen
+        self._lock()
+        try:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+        finally:
+            self._unlock()
+
+    def _remove_stale(self, entry_id):
+        self._lock()
+        try:
+            if self._delete_entry(entry_id) is not None:
+                self._db.commit()
+        finally:
+            self._unlock()
+
+    def _insert(self, entry):
+        size = _entry_size(self.cache_directory(), entry)
+        self._access_count += 1
+        self._generation += 1
+        cursor = self._db.execute("INSERT INTO entries (key, tinc_id, entry, size, hits, access) VALUES (?, ?, ?, ?, ?, ?)",
+                                  (_db_key(entry.source_info), entry.source_info.tinc_id,
+                                   json.dumps(_entry_to_json(entry)), size, entry.cache_hits, self._access_count))
+        self._insert_files(cursor.lastrowid, entry)
+        return cursor.lastrowid
+
+    def _insert_files(self, entry_id, entry):
+        self._db.executemany("INSERT INTO files (entry_id, name, size) VALUES (?, ?, ?)",
+                             [(entry_id, cache_file_name(f), _file_size(self.cache_directory(), f))
+                              for f in entry.files if f.file.filename != ''])
+
+    def _evict(self, keep_id = None):
+        # Other processes add and remove entries too, so the totals are read
+        # in the same write transaction as the victims are removed. Victims
+        # are found through the access or hits index
+        if not self._db.in_transaction:
+            self._db.execute("BEGIN IMMEDIATE")
+        entry_count, total_size = self._db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        if self._eviction_policy == 'lfu':
+            order = "hits, access"
+        else:
+            order = "access"
+        evicted = 0
+        while (self._max_entries is not None and entry_count > self._max_entries) \
+            or (self._max_bytes is not None and total_size > self._max_bytes):
+                row = self._db.execute("SELECT id, size FROM entries WHERE id != ? ORDER BY "
+                                       + order + " LIMIT 1", (-1 if keep_id is None else keep_id,)).fetchone()
+                if row is None:
+                    break
+                entry_id, size = row
+                self._delete_entry(entry_id)
+                entry_count -= 1
+                total_size -= size
+                evicted += 1
+        return evicted
+
+    def _delete_entry(self, entry_id):
+        # Deletes an entry and the files no other entry references. Returns
+        # the size of the entry, or None if it doesn't exist. Must be called
+        # with the mutex held, and committed by the caller
+        row = self._db.execute("SELECT size, entry FROM entries WHERE id = ?", (entry_id,)).fetchone()
+        if row is None:
+            return None
+        self._generation += 1
+        if self.on_remove:
+            self.on_remove(source_info_key(_entry_from_json(json.loads(row[1])).source_info))
+        names = [name for name, in self._db.execute("SELECT name FROM files WHERE entry_id = ?", (entry_id,))]
+        self._db.execute("DELETE FROM entries WHERE id = ?", (entry_id,))
+        self._db.execute("DELETE FROM files WHERE entry_id = ?", (entry_id,))
+        # Files are shared by entries with the same source info, and
+        # in the content layout by entries with the same result
+        for name in names:
+            if self._db.execute("SELECT 1 FROM files WHERE name = ? LIMIT 1", (name,)).fetchone() is not None:
+                continue
+            full_name = self.cache_directory() + name
+            try:
+                os.remove(full_name)
+            except FileNotFoundError:
+                pass
+            except:
+                print("ERROR removing cache entry: " + full_name)
+        return row[0]
+
+def _db_key(source_info):
+    return source_info_hash(source_info)
+
+def _matching_entries(key, rows):
+    # List of (entry id, entry) for the (id, entry json) rows whose entry has
+    # a source_info_key(). Rows are found by _db_key(), a hash of the key, so
+    # they are compared with the key before they are used
+    candidates = []
+    for entry_id, entry in rows:
+        entry = _entry_from_json(json.loads(entry))
+        if source_info_key(entry.source_info) == key:
+            candidates.append((entry_id, entry))
+    return candidates
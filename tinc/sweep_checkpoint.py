@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+Checkpoint files to resume interrupted parameter space sweeps.
+"""
+
+import json
+import os
+import struct
+import threading
+import time
+
+class SweepCheckpoint(object):
+    '''Records which samples of a sweep have been completed.
+
+    Completed samples are stored by flat sample index (see
+    :meth:`tinc.parameter_space.ParameterSpace.sample_at`) in a bitmap that is
+    periodically flushed to disk. A restarted sweep using the same checkpoint
+    file skips completed samples without looking them up in the cache.
+
+    The checkpoint is only reused if the number of samples and the signature
+    match, otherwise it is reset.
+
+    :param filename: Path to the checkpoint file
+    :param sample_count: Number of samples in the sweep
+    :param signature: String identifying the sweep (function and parameter space)
+    :param flush_interval: Minimum time in seconds between automatic flushes to disk
+    '''
+    _MAGIC = b'TINCSWCK'
+    _VERSION = 1
+
+    def __init__(self, filename, sample_count, signature = '', flush_interval = 30.0):
+        self.filename = filename
+        self.sample_count = sample_count
+        self.signature = signature
+        self.flush_interval = flush_interval
+        self._bitmap = bytearray((sample_count + 7) // 8)
+        self._completed = 0
+        self._dirty = False
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        # Held while writing the file, which can be flushed from several threads
+        self._flush_lock = threading.Lock()
+        if os.path.exists(filename):
+            self._load()
+
+    def _load(self):
+        try:
+            with open(self.filename, 'rb') as f:
+                if f.read(len(self._MAGIC)) != self._MAGIC:
+                    raise ValueError("Not a sweep checkpoint file")
+                header_size = struct.unpack('<I', f.read(4))[0]
+                header = json.loads(f.read(header_size).decode())
+                bitmap = f.read()
+        except:
+            print(f"Can't read sweep checkpoint {self.filename}. Starting from the beginning.")
+            return
+        if header["version"] != self._VERSION \
+            or header["sampleCount"] != self.sample_count \
+            or header["signature"] != self.signature \
+            or len(bitmap) != len(self._bitmap):
+                print(f"Sweep checkpoint {self.filename} does not match sweep. Starting from the beginning.")
+                return
+        self._bitmap = bytearray(bitmap)
+        self._completed = sum(bin(b).count('1') for b in self._bitmap)
+
+    def is_done(self, index):
+        return (self._bitmap[index >> 3] >> (index & 7)) & 1 == 1
+
+    def mark_done(self, index):
+        '''Mark a sample as completed. Flushes to disk if flush_interval has elapsed.'''
+        with self._lock:
+            if not self.is_done(index):
+                self._bitmap[index >> 3] |= 1 << (index & 7)
+                self._completed += 1
+                self._dirty = True
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def completed_count(self):
+        return self._completed
+
+    def pending(self, start = 0, stop = None):
+        '''Generator of the flat indeces not yet completed.
+
+        Whole bytes of completed samples are skipped at once.
+        '''
+        if stop is None or stop > self.sample_count:
+            stop = self.sample_count
+        index = start
+        while index < stop:
+            if index & 7 == 0 and self._bitmap[index >> 3] == 0xFF:
+                index += 8
+                continue
+            if not self.is_done(index):
+                yield index
+            index += 1
+
+    def flush(self):
+        '''Write the checkpoint to disk. The file is replaced atomically.
+
+        Can be called from any thread. Samples can be marked as done while
+        the file is written.
+        '''
+        with self._flush_lock:
+            with self._lock:
+                if not self._dirty and os.path.exists(self.filename):
+                    self._last_flush = time.monotonic()
+                    return
+                header = json.dumps({"version": self._VERSION,
+                                     "sampleCount": self.sample_count,
+                                     "signature": self.signature}).encode()
+                bitmap = bytes(self._bitmap)
+                self._dirty = False
+            try:
+                tmp_filename = self.filename + '.tmp'
+                with open(tmp_filename, 'wb') as f:
+                    f.write(self._MAGIC)
+                    f.write(struct.pack('<I', len(header)))
+                    f.write(header)
+                    f.write(bitmap)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_filename, self.filename)
+            except:
+                # Written by the next flush
+                with self._lock:
+                    self._dirty = True
+                raise
+            self._last_flush = time.monotonic()
+
+    def remove(self):
+        '''Delete the checkpoint file and reset all samples to not completed.'''
+        with self._lock:
+            self._bitmap = bytearray(len(self._bitmap))
+            self._completed = 0
+            self._dirty = False
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
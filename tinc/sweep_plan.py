@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+Classification of sweep samples into cached and missing samples.
+"""
+
+import datetime
+
+class SweepPlan(object):
+    '''Cache status of every sample in a sweep, computed before the sweep starts.
+
+    Create with :meth:`tinc.parameter_space.ParameterSpace.plan_sweep`. Only
+    the missing samples need to be computed, cached results can be loaded on
+    demand with load().
+
+    Samples are identified by their flat index (see
+    :meth:`tinc.parameter_space.ParameterSpace.sample_at`).
+    '''
+    def __init__(self, parameter_space, params, sample_count, hits, misses, sample_time = None):
+        self.parameter_space = parameter_space
+        self.params = params
+        self.sample_count = sample_count
+        # Map of flat index to cache file names
+        self.hits = hits
+        # Sorted list of flat indeces
+        self.misses = misses
+        # Average time in seconds to compute a sample, if known
+        self.sample_time = sample_time
+
+    def __str__(self):
+        details = f" ** SweepPlan for ParameterSpace '{self.parameter_space.id}'\n"
+        details += f"    Samples: {self.sample_count}\n"
+        details += f"    Cached: {self.hit_count()} ({self.hit_ratio()*100:.1f}%)\n"
+        details += f"    Missing: {self.miss_count()}\n"
+        remaining = self.estimated_remaining_time()
+        if remaining is not None:
+            details += f"    Estimated time: {remaining:.1f} s\n"
+        return details
+
+    def hit_count(self):
+        return len(self.hits)
+
+    def miss_count(self):
+        return len(self.misses)
+
+    def hit_ratio(self):
+        if self.sample_count == 0:
+            return 0.0
+        return len(self.hits)/self.sample_count
+
+    def estimated_remaining_time(self):
+        '''Estimated time in seconds to compute the missing samples (serially).
+
+        The estimate is based on the time taken to compute the cached samples,
+        so it is None if there are no cached samples with timing information.
+        '''
+        if self.sample_time is None:
+            return None
+        return self.sample_time * len(self.misses)
+
+    def is_cached(self, index):
+        return index in self.hits
+
+    def load(self, index):
+        '''Load the cached result for the sample at flat index.
+
+        :returns: The cached result or None if the sample is not cached
+        '''
+        if not index in self.hits:
+            return None
+        found, out = self.parameter_space._load_cache_files_locked(self.hits[index])
+        return out
+
+def _entry_duration(entry):
+    try:
+        start = datetime.datetime.fromisoformat(entry.timestamp_start)
+        end = datetime.datetime.fromisoformat(entry.timestamp_end)
+    except ValueError:
+        return None
+    return (end - start).total_seconds()
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+Progress and throughput reporting for parameter space sweeps.
+"""
+
+try:
+    import ipywidgets as widgets
+except:
+    pass
+
+import collections
+import heapq
+import threading
+import time
+
+import numpy as np
+
+class SweepProgress(object):
+    '''Live progress of a parameter space sweep.
+
+    Every :class:`tinc.parameter_space.ParameterSpace` has one in its
+    sweep_progress attribute. It is reset when a sweep starts and updated as
+    samples complete. All methods can be called from any thread while the
+    sweep is running.
+
+    :param latency_window: Number of most recent samples used to compute latency percentiles
+    :param slowest_count: Number of slowest samples to keep track of
+    '''
+    def __init__(self, latency_window = 10000, slowest_count = 10):
+        self._lock = threading.Lock()
+        self._latencies = collections.deque(maxlen = latency_window)
+        self._slowest_count = slowest_count
+        self._interactive_widget = None
+        self._last_widget_update = 0.0
+        self.start(0)
+        self.running = False
+
+    def __str__(self):
+        r = self.report()
+        details = f" ** SweepProgress {r['completed']}/{r['total']} "
+        details += "(running)\n" if r['running'] else "\n"
+        details += f"    Cache hits: {r['cache_hits']} misses: {r['cache_misses']}\n"
+        details += f"    Samples/s: {r['samples_per_second']:.2f}\n"
+        if r['eta'] is not None:
+            details += f"    ETA: {r['eta']:.1f} s\n"
+        if r['latency_percentiles']:
+            details += "    Latency (s): " + " ".join([f"p{p}: {v:.4f}" for p, v in r['latency_percentiles'].items()]) + "\n"
+        return details
+
+    def start(self, total, completed = 0):
+        '''Reset for a new sweep.
+
+        :param total: Number of samples in the sweep
+        :param completed: Number of samples already completed before starting (e.g. from a checkpoint)
+        '''
+        with self._lock:
+            self.total = total
+            self.completed = completed
+            self.cache_hits = 0
+            self.cache_misses = 0
+            self.running = True
+            self._start_time = time.monotonic()
+            self._end_time = None
+            self._done_in_run = 0
+            self._latencies.clear()
+            # min heap of (latency, sample index) for the slowest samples
+            self._slowest = []
+        self._update_widget(True)
+
+    def record(self, index, latency, cached = False):
+        '''Record a completed sample.
+
+        :param index: Flat index of the sample
+        :param latency: Time in seconds taken by the sample
+        :param cached: True if the result came from the cache
+        '''
+        with self._lock:
+            self.completed += 1
+            self._done_in_run += 1
+            if cached:
+                self.cache_hits += 1
+            else:
+                self.cache_misses += 1
+                self._latencies.append(latency)
+                if len(self._slowest) < self._slowest_count:
+                    heapq.heappush(self._slowest, (latency, index))
+                elif latency > self._slowest[0][0]:
+                    heapq.heapreplace(self._slowest, (latency, index))
+        self._update_widget()
+
+    def finish(self):
+        with self._lock:
+            self.running = False
+            self._end_time = time.monotonic()
+        self._update_widget(True)
+
+    def elapsed(self):
+        end = self._end_time if self._end_time is not None else time.monotonic()
+        return end - self._start_time
+
+    def samples_per_second(self):
+        elapsed = self.elapsed()
+        if elapsed <= 0:
+            return 0.0
+        return self._done_in_run / elapsed
+
+    def eta(self):
+        '''Estimated time in seconds to complete the sweep, or None if unknown.'''
+        rate = self.samples_per_second()
+        if rate == 0:
+            return None
+        return (self.total - self.completed) / rate
+
+    def latency_percentiles(self, percentiles = (50, 90, 99)):
+        '''Latency percentiles in seconds of recent computed (not cached) samples.'''
+        with self._lock:
+            latencies = list(self._latencies)
+        if len(latencies) == 0:
+            return {}
+        values = np.percentile(latencies, percentiles)
+        return {p: float(v) for p, v in zip(percentiles, values)}
+
+    def slowest_samples(self):
+        '''List of (latency, flat index) for the slowest samples, slowest first.
+
+        Use :meth:`tinc.parameter_space.ParameterSpace.sample_at` to get their parameter values.
+        '''
+        with self._lock:
+            return sorted(self._slowest, reverse = True)
+
+    def report(self):
+        '''Returns a dict with the current state of the sweep.'''
+        return {"running": self.running,
+                "total": self.total,
+                "completed": self.completed,
+                "remaining": self.total - self.completed,
+                "cache_hits": self.cache_hits,
+                "cache_misses": self.cache_misses,
+                "elapsed": self.elapsed(),
+                "samples_per_second": self.samples_per_second(),
+                "eta": self.eta(),
+                "latency_percentiles": self.latency_percentiles()}
+
+    def interactive_widget(self):
+        '''Return a progress widget for jupyter notebook that updates while the sweep runs.
+        Requires ipywidgets.
+        '''
+        if self._interactive_widget is None:
+            self._interactive_widget = widgets.VBox([widgets.IntProgress(min = 0, description = 'Sweep'),
+                                                     widgets.Label()])
+            self._update_widget(True)
+        return self._interactive_widget
+
+    def _update_widget(self, force = False):
+        if self._interactive_widget is None:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_widget_update < 0.25:
+            return
+        self._last_widget_update = now
+        bar, label = self._interactive_widget.children
+        bar.max = max(self.total, 1)
+        bar.value = self.completed
+        eta = self.eta()
+        label.value = f"{self.completed}/{self.total} hits: {self.cache_hits} " \
+            f"{self.samples_per_second():.1f} samples/s" + (f" ETA {eta:.0f} s" if eta is not None else "")
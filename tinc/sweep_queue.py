@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+Work queue on a shared filesystem to distribute sweeps across machines.
+"""
+
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+
+class SweepWorkQueue(object):
+    '''Distributes the samples of a sweep across workers that share a directory.
+
+    The flat sample index space (see
+    :meth:`tinc.parameter_space.ParameterSpace.sample_at`) is split into
+    leases of lease_size samples. Each lease is a file that moves between the
+    'pending', 'claimed' and 'done' subdirectories of the queue directory.
+    Moves use os.rename(), which is atomic on POSIX filesystems including NFS,
+    so only one worker can claim a lease.
+
+    Workers must renew the leases they hold. A claimed lease that has not
+    been renewed for lease_timeout seconds is considered abandoned and is
+    returned to 'pending' by reclaim_expired(). Lease age is measured against
+    the modification time of a file written by this worker, so clock
+    differences between machines don't matter.
+
+    :param directory: Queue directory, shared by all workers
+    :param worker_id: Name for this worker. If None, one is generated from the host name
+    :param lease_timeout: Time in seconds after which a lease that has not been renewed can be reclaimed
+    '''
+    def __init__(self, directory, worker_id = None, lease_timeout = 60.0):
+        if len(directory) > 0 and not directory[-1] == "/":
+            directory += '/'
+        self.directory = directory
+        if worker_id is None:
+            worker_id = socket.gethostname() + '_' + str(os.getpid()) + '_' + uuid.uuid4().hex[:8]
+        self.worker_id = worker_id
+        self.lease_timeout = lease_timeout
+        self._info = None
+
+    def _info_file(self):
+        return self.directory + "queue.json"
+
+    def _lease_name(self, lease_id):
+        return f"lease_{lease_id:08d}"
+
+    def _path(self, state, lease_id):
+        return self.directory + state + '/' + self._lease_name(lease_id)
+
+    def exists(self):
+        return os.path.exists(self._info_file())
+
+    def create(self, sample_count, lease_size = 1000, signature = ''):
+        '''Create the queue with all leases pending.
+
+        If a queue with the same signature already exists in the directory it
+        is reused, so a coordinator can be restarted.
+
+        :param sample_count: Number of samples in the sweep
+        :param lease_size: Number of samples per lease
+        :param signature: String identifying the sweep
+        '''
+        if self.exists():
+            info = self.info()
+            if info["signature"] != signature or info["sampleCount"] != sample_count:
+                raise ValueError(f"A different sweep queue already exists in {self.directory}")
+            return
+        for state in ('pending', 'claimed', 'done'):
+            os.makedirs(self.directory + state, exist_ok = True)
+        lease_count = (sample_count + lease_size - 1) // lease_size
+        for lease_id in range(lease_count):
+            with open(self._path('pending', lease_id), 'w') as f:
+                pass
+        info = {"sampleCount": sample_count,
+                "leaseSize": lease_size,
+                "leaseCount": lease_count,
+                "signature": signature}
+        # Written last, so workers only see complete queues
+        tmp_filename = self._info_file() + '.' + self.worker_id + '.tmp'
+        with open(tmp_filename, 'w') as f:
+            json.dump(info, f)
+        os.replace(tmp_filename, self._info_file())
+
+    def wait_for_queue(self, timeout = None, poll_interval = 1.0):
+        '''Wait until a coordinator has created the queue. Returns False on timeout'''
+        start = time.monotonic()
+        while not self.exists():
+            if timeout is not None and time.monotonic() - start > timeout:
+                return False
+            time.sleep(poll_interval)
+        return True
+
+    def info(self):
+        if self._info is None:
+            with open(self._info_file()) as f:
+                self._info = json.load(f)
+        return self._info
+
+    def lease_range(self, lease_id):
+        '''Returns the (start, stop) flat indeces for a lease'''
+        info = self.info()
+        start = lease_id * info["leaseSize"]
+        return start, min(start + info["leaseSize"], info["sampleCount"])
+
+    def _leases(self, state):
+        try:
+            names = os.listdir(self.directory + state)
+        except FileNotFoundError:
+            return []
+        return sorted(int(name[6:]) for name in names if name.startswith('lease_'))
+
+    def claim(self):
+        '''Claim a pending lease.
+
+        :returns: The lease id or None if there are no pending leases
+        '''
+        for lease_id in self._leases('pending'):
+            try:
+                # rename() keeps the modification time, which is touched first
+                # so that the lease doesn't look expired before it is renewed
+                os.utime(self._path('pending', lease_id))
+                os.rename(self._path('pending', lease_id), self._path('claimed', lease_id))
+            except FileNotFoundError:
+                # Claimed by someone else
+                continue
+            try:
+                # 'r+' fails if the lease was reclaimed in the meantime
+                with open(self._path('claimed', lease_id), 'r+') as f:
+                    f.write(self.worker_id)
+                    f.truncate()
+            except FileNotFoundError:
+                continue
+            return lease_id
+        return None
+
+    def owner(self, lease_id):
+        try:
+            with open(self._path('claimed', lease_id)) as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def renew(self, lease_id):
+        '''Renew the heartbeat of a claimed lease. Returns False if the lease is no longer owned by this worker.'''
+        if self.owner(lease_id) != self.worker_id:
+            return False
+        try:
+            os.utime(self._path('claimed', lease_id))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def complete(self, lease_id):
+        '''Mark a claimed lease as done. Returns False if the lease is no longer owned by this worker.'''
+        if self.owner(lease_id) != self.worker_id:
+            return False
+        try:
+            os.rename(self._path('claimed', lease_id), self._path('done', lease_id))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def release(self, lease_id):
+        '''Return a claimed lease to the pending state without completing it.'''
+        if self.owner(lease_id) != self.worker_id:
+            return False
+        try:
+            os.rename(self._path('claimed', lease_id), self._path('pending', lease_id))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def _now(self):
+        # Current time according to the shared filesystem
+        clock_file = self.directory + 'clock_' + self.worker_id
+        with open(clock_file, 'w') as f:
+            pass
+        now = os.stat(clock_file).st_mtime
+        os.remove(clock_file)
+        return now
+
+    def reclaim_expired(self):
+        '''Return abandoned leases to the pending state.
+
+        :returns: The number of leases reclaimed
+        '''
+        now = self._now()
+        count = 0
+        for lease_id in self._leases('claimed'):
+            path = self._path('claimed', lease_id)
+            try:
+                if now - os.stat(path).st_mtime > self.lease_timeout:
+                    os.rename(path, self._path('pending', lease_id))
+                    count += 1
+            except FileNotFoundError:
+                continue
+        return count
+
+    def progress(self):
+        '''Returns a dict with the number of pending, claimed and done leases'''
+        return {state: len(self._leases(state)) for state in ('pending', 'claimed', 'done')}
+
+    def is_finished(self):
+        return len(self._leases('done')) == self.info()["leaseCount"]
+
+class _LeaseHeartbeat(object):
+    # Renews a lease periodically from a background thread
+    def __init__(self, queue, lease_id):
+        self.queue = queue
+        self.lease_id = lease_id
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target = self._run, daemon = True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.queue.lease_timeout/3.0):
+            if not self.queue.renew(self.lease_id):
+                self.lost = True
+                break
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
@@ -7,9 +7,14 @@ Created on Mon Nov 23 11:13:52 2020
 
 # Not needed if tinc-python is installed
 import sys
+import os
+import json
+import zlib
+import multiprocessing
 from tinc import *
 
 import unittest
+import numpy as np
 
 class CacheTest(unittest.TestCase):
     
@@ -112,6 +117,80 @@ class CacheTest(unittest.TestCase):
         self.assertEqual(len(files), 1)
         self.assertEqual(files[0], "out1.txt")
         
+    def test_find_entries(self):
+        cache = CacheManager()
+        cache.clear_cache()
+
+        def make_src_info(value, reverse = False):
+            args = [SourceArgument(id = 'arg_id', value = VariantValue(nctype = VariantType.VARIANT_DOUBLE, 
+                                                                       value = value)),
+                    SourceArgument(id = 'arg_id2', value = VariantValue(nctype = VariantType.VARIANT_INT64, 
+                                                                        value = 3))]
+            if reverse:
+                args.reverse()
+            return SourceInfo(type = "PythonScript", tinc_id = 'id', arguments = args)
+
+        for i in range(10):
+            cache.append_entry(CacheEntry(files = [FileDependency(DistributedPath(filename = f"out{i}.txt"))],
+                                          source_info = make_src_info(i * 0.5)))
+
+        found = cache.find_entries([make_src_info(1.5), make_src_info(20.0), make_src_info(4.0, True)])
+        self.assertEqual(found[0].files[0].file.filename, "out3.txt")
+        self.assertIsNone(found[1])
+        self.assertEqual(found[2].files[0].file.filename, "out8.txt")
+        self.assertEqual(cache.find_cache(make_src_info(4.0, True)), ["out8.txt"])
+
+    def test_index_key_collisions(self):
+        import tinc.cachemanager, tinc.sqlite_cachemanager
+        def make_src_info(value):
+            return SourceInfo(type = "PythonScript", tinc_id = 'id',
+                              arguments = [SourceArgument(id = 'arg_id', value = VariantValue(nctype = VariantType.VARIANT_DOUBLE,
+                                                                                              value = value))])
+        index_key = tinc.cachemanager._index_key
+        db_key = tinc.sqlite_cachemanager._db_key
+        # All keys collide, entries are told apart by their full key
+        tinc.cachemanager._index_key = lambda key: 0
+        tinc.sqlite_cachemanager._db_key = lambda source_info: "key"
+        try:
+            for cache in [CacheManager("collision_cache_json"), SqliteCacheManager("collision_cache_sqlite")]:
+                cache.clear_cache()
+                for i in range(3):
+                    cache.append_entry(CacheEntry(files = [FileDependency(DistributedPath(filename = f"out{i}.txt"))],
+                                                  source_info = make_src_info(float(i))))
+                self.assertEqual(cache.find_cache(make_src_info(1.0)), ["out1.txt"])
+                self.assertEqual(cache.find_cache(make_src_info(5.0)), [])
+                found = cache.find_entries([make_src_info(2.0), make_src_info(5.0)])
+                self.assertEqual(found[0].files[0].file.filename, "out2.txt")
+                self.assertIsNone(found[1])
+                self.assertTrue(cache.has_entry(make_src_info(0.0)))
+                self.assertFalse(cache.has_entry(make_src_info(5.0)))
+                cache.clear_cache()
+                cache.close()
+        finally:
+            tinc.cachemanager._index_key = index_key
+            tinc.sqlite_cachemanager._db_key = db_key
+
+    def test_find_cache_variant_types(self):
+        cache = CacheManager()
+        cache.clear_cache()
+
+        def make_src_info(nctype, value):
+            return SourceInfo(type = "PythonScript", tinc_id = 'id',
+                              arguments = [SourceArgument(id = 'arg_id', value = VariantValue(nctype = nctype,
+                                                                                              value = value))])
+
+        cache.append_entry(CacheEntry(files = [FileDependency(DistributedPath(filename = "int.txt"))],
+                                      source_info = make_src_info(VariantType.VARIANT_INT32, 2)))
+        cache.append_entry(CacheEntry(files = [FileDependency(DistributedPath(filename = "double.txt"))],
+                                      source_info = make_src_info(VariantType.VARIANT_DOUBLE, 0.5)))
+        cache.write_to_disk()
+        cache.update_from_disk()
+
+        self.assertEqual(cache.find_cache(make_src_info(VariantType.VARIANT_INT64, np.int64(2))), ["int.txt"])
+        self.assertEqual(cache.find_cache(make_src_info(VariantType.VARIANT_FLOAT, np.float32(0.5))), ["double.txt"])
+        self.assertEqual(cache.find_cache(make_src_info(VariantType.VARIANT_DOUBLE, 2.0)), [])
+        self.assertEqual(cache.find_cache(make_src_info(VariantType.VARIANT_STRING, "2")), [])
+
     def test_cache_param_dependencies(self):
         # Cache with parameter space
         p1 = Parameter("param1")
@@ -221,6 +300,552 @@ class CacheTest(unittest.TestCase):
         p2.value = 4
         ps.run_process(func)
 
+    def test_sqlite_cache(self):
+        json_cache = CacheManager("sqlite_cache_test")
+        json_cache.clear_cache()
+        for i in range(10):
+            src_info = SourceInfo(type = "PythonScript", tinc_id = 'id',
+                                  arguments = [SourceArgument(id = 'arg_id', value = VariantValue(nctype = VariantType.VARIANT_DOUBLE,
+                                                                                                  value = i * 0.5))])
+            json_cache.append_entry(CacheEntry(files = [FileDependency(DistributedPath(filename = f"out{i}.txt"))],
+                                               source_info = src_info))
+        json_cache.write_to_disk()
+
+        cache = SqliteCacheManager("sqlite_cache_test")
+        cache.clear_cache()
+        self.assertEqual(cache.import_json(), 10)
+        self.assertEqual(cache.entries(), json_cache.entries())
+        self.assertEqual(cache.entries(2), json_cache.entries(2))
+
+        found = cache.find_entries([e.source_info for e in json_cache.entries()] + [SourceInfo(tinc_id = 'other')])
+        self.assertEqual(found[:10], json_cache.entries())
+        self.assertIsNone(found[10])
+        self.assertEqual(cache.find_cache(json_cache.entries()[3].source_info), ["out3.txt"])
+        self.assertEqual(cache.entries()[3].cache_hits, 1)
+
+        # Entries persist across instances and export back to json
+        cache.close()
+        cache = SqliteCacheManager("sqlite_cache_test")
+        self.assertEqual(len(cache.entries()), 10)
+        cache.export_json("sqlite_cache_test/exported.json")
+        exported = CacheManager("sqlite_cache_test", "exported.json")
+        self.assertEqual([e.source_info for e in exported.entries()], [e.source_info for e in json_cache.entries()])
+        self.assertEqual(exported.entries()[3].cache_hits, 1)
+        cache.close()
+
+        ps = ParameterSpace("sqlite_cache_test")
+        p1 = Parameter("param1")
+        p1.values = [0.0, 1.0, 2.0]
+        ps.register_parameters([p1])
+        ps.enable_cache("sqlite_ps_cache", metadata_backend = 'sqlite')
+        ps.clear_cache()
+        calls = []
+        def func(param1):
+            calls.append(param1)
+            return param1 * 2
+        ps.sweep(func)
+        ps.sweep(func)
+        self.assertEqual(len(calls), 3)
+        ps._cache_manager.close()
+
+
+    def test_cache_eviction(self):
+        for backend in [CacheManager, SqliteCacheManager]:
+            cache = backend("eviction_test")
+            cache.clear_cache()
+
+            def make_src_info(i):
+                return SourceInfo(type = "PythonScript", tinc_id = 'id',
+                                  arguments = [SourceArgument(id = 'arg_id', value = VariantValue(nctype = VariantType.VARIANT_INT64,
+                                                                                                  value = i))])
+            def add_entry(i):
+                with open(f"eviction_test/out{i}.bin", "wb") as f:
+                    f.write(bytes(100))
+                cache.append_entry(CacheEntry(files = [FileDependency(DistributedPath(filename = f"out{i}.bin"), size = 100)],
+                                              source_info = make_src_info(i)))
+
+            for i in range(4):
+                add_entry(i)
+            cache.set_cache_budget(max_bytes = 450, policy = 'lru')
+            self.assertEqual(cache.cache_size(), 400)
+
+            # Least recently used is evicted first
+            self.assertEqual(cache.find_cache(make_src_info(0)), ["out0.bin"])
+            add_entry(4)
+            self.assertEqual(cache.find_cache(make_src_info(1)), [])
+            self.assertFalse(os.path.exists("eviction_test/out1.bin"))
+            self.assertEqual(len(cache.entries()), 4)
+            self.assertEqual(cache.cache_size(), 400)
+
+            # Least frequently used is evicted first
+            cache.set_cache_budget(max_entries = 3, policy = 'lfu')
+            self.assertEqual(len(cache.entries()), 3)
+            self.assertEqual(cache.find_cache(make_src_info(2)), [])
+            self.assertEqual(cache.find_cache(make_src_info(4)), ["out4.bin"])
+            self.assertEqual(cache.find_cache(make_src_info(4)), ["out4.bin"])
+            self.assertEqual(cache.find_cache(make_src_info(3)), ["out3.bin"])
+            add_entry(5)
+            found = cache.find_entries([make_src_info(i) for i in range(6)])
+            self.assertEqual([f is not None for f in found], [False, False, False, True, True, True])
+            hits = {e.source_info.arguments[0].value.value: e.cache_hits for e in cache.entries()}
+            self.assertEqual(hits, {3: 1, 4: 2, 5: 0})
+            cache.write_to_disk()
+            cache.clear_cache()
+
+    def test_shared_sqlite_eviction(self):
+        cache = SqliteCacheManager("shared_eviction_test")
+        cache.clear_cache()
+        cache.set_cache_budget(max_entries = 3)
+        other = SqliteCacheManager("shared_eviction_test")
+        for i in range(2):
+            cache.append_entry(_make_entry(i))
+            other.append_entry(_make_entry(10 + i))
+        self.assertEqual(cache.entry_count(), 4)
+        # Entries appended by other processes count towards the budget
+        cache.append_entry(_make_entry(2))
+        self.assertEqual(cache.entry_count(), 3)
+        self.assertEqual(other.entry_count(), 3)
+        other.close()
+        cache.clear_cache()
+
+    def test_sqlite_generation(self):
+        cache = SqliteCacheManager("sqlite_generation_test")
+        cache.clear_cache()
+        other = SqliteCacheManager("sqlite_generation_test")
+        generation = cache.generation()
+        self.assertEqual(cache.generation(), generation)
+        cache.append_entry(_make_entry(0))
+        self.assertNotEqual(cache.generation(), generation)
+        # Changes committed by other connections
+        generation = cache.generation()
+        other.append_entry(_make_entry(1))
+        self.assertNotEqual(cache.generation(), generation)
+        generation = cache.generation()
+        other.clear_cache()
+        self.assertNotEqual(cache.generation(), generation)
+        other.close()
+        cache.close()
+
+    def test_file_dependencies(self):
+        for backend in ['json', 'sqlite']:
+            p1 = Parameter("param1")
+            p1.values = [0.0, 1.0]
+            ps = ParameterSpace("file_dep_test")
+            ps.register_parameters([p1])
+            ps.enable_cache("file_dep_cache_" + backend, metadata_backend = backend)
+            ps.clear_cache()
+
+            with open("file_dep_input.txt", "w") as f:
+                f.write("1234")
+            calls = []
+            def func(param1):
+                calls.append(param1)
+                with open("file_dep_input.txt") as f:
+                    return param1 + len(f.read())
+
+            self.assertEqual(ps.run_process(func, dependencies = ["file_dep_input.txt"]), 4.0)
+            fdep = ps._cache_manager.entries()[0].source_info.file_dependencies[-1]
+            self.assertEqual(fdep.file.filename, "file_dep_input.txt")
+            self.assertEqual(fdep.size, 4)
+            # Files are hashed when the result is stored
+            self.assertEqual(fdep.hash, str(zlib.crc32(b"1234")))
+            self.assertEqual(ps.run_process(func, dependencies = ["file_dep_input.txt"]), 4.0)
+            self.assertEqual(len(calls), 1)
+
+            # Touched but not modified, the recorded content hash still matches
+            stat = os.stat("file_dep_input.txt")
+            os.utime("file_dep_input.txt", ns = (stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+            self.assertEqual(ps.run_process(func, dependencies = ["file_dep_input.txt"]), 4.0)
+            self.assertEqual(len(calls), 1)
+
+            # Without a recorded hash, e.g. in entries written by other tools,
+            # a touched file is considered changed
+            self.assertFalse(default_fingerprinter.is_unchanged(fdep._replace(hash = "")))
+            self.assertTrue(default_fingerprinter.is_unchanged(fdep))
+
+            p1.value = 1.0
+            self.assertEqual(ps.run_process(func, dependencies = ["file_dep_input.txt"]), 5.0)
+            self.assertEqual(len(calls), 2)
+
+            # Modified
+            with open("file_dep_input.txt", "w") as f:
+                f.write("123456")
+            self.assertEqual(ps.run_process(func, dependencies = ["file_dep_input.txt"]), 7.0)
+            self.assertEqual(len(calls), 3)
+            self.assertEqual(ps._cache_manager.entry_count(), 2)
+            self.assertEqual(ps.run_process(func, dependencies = ["file_dep_input.txt"]), 7.0)
+            self.assertEqual(len(calls), 3)
+
+            # A different file is a different result
+            with open("file_dep_input2.txt", "w") as f:
+                f.write("123456")
+            self.assertEqual(ps.run_process(func, dependencies = ["file_dep_input2.txt"]), 7.0)
+            self.assertEqual(len(calls), 4)
+            os.remove("file_dep_input2.txt")
+
+            os.remove("file_dep_input.txt")
+            self.assertEqual(ps._cache_manager.find_cache(ps._cache_manager.entries()[-2].source_info), [])
+            ps.clear_cache()
+
+    def test_concurrent_writers(self):
+        cache1 = CacheManager("concurrent_test")
+        cache1.clear_cache()
+        cache2 = CacheManager("concurrent_test")
+        cache1.append_entry(_make_entry(0))
+        cache2.append_entry(_make_entry(1))
+        cache1.write_to_disk()
+        cache2.write_to_disk()
+        # Hits and removals are merged too
+        self.assertEqual(cache2.find_cache(_make_entry(0).source_info), ["out0.bin"])
+        cache2.write_to_disk()
+        cache1.update_from_disk()
+        self.assertEqual(sorted(e.source_info.arguments[0].value.value for e in cache1.entries()), [0, 1])
+        self.assertEqual({e.source_info.arguments[0].value.value: e.cache_hits for e in cache1.entries()},
+                         {0: 1, 1: 0})
+
+        # Entries written by other processes are not lost
+        ctx = multiprocessing.get_context("spawn")
+        processes = [ctx.Process(target = _append_entries, args = ("concurrent_test", 10 * (i + 1), 10))
+                     for i in range(3)]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+        cache1.update_from_disk()
+        self.assertEqual(len(cache1.entries()), 32)
+        cache1.clear_cache()
+
+    def test_cache_stats(self):
+        for backend in ['json', 'sqlite']:
+            p1 = Parameter("param1")
+            p1.values = [0.0, 1.0, 2.0]
+            ps = ParameterSpace("ps")
+            ps.register_parameters([p1])
+            ps.enable_cache("stats_test_" + backend, metadata_backend = backend)
+            ps.clear_cache()
+            ps._cache_manager.reset_stats()
+
+            def func(param1):
+                return np.ones(1000) * param1
+            ps.run_process(func)
+            # Samples already in the cache are skipped without a lookup
+            ps.sweep(func)
+            for i in range(2):
+                ps.run_process(func)
+            stats = ps._cache_manager.stats()
+            self.assertEqual(stats["lookups"], 3)
+            self.assertEqual(stats["misses"], 1)
+            self.assertEqual(stats["hits"], 2)
+            self.assertEqual(stats["hit_rate"], 2 / 3)
+            self.assertEqual(stats["entries"], 3)
+            self.assertEqual(stats["store_latency"]["count"], 3)
+            self.assertEqual(stats["load_latency"]["count"], 2)
+            self.assertEqual(sum(count for bound, count in stats["load_latency"]["buckets"]), 2)
+            self.assertEqual(stats["bytes_written"], stats["disk_bytes"])
+            self.assertEqual(stats["bytes_read"], 2 * stats["disk_bytes"] // 3)
+
+            # Hit counts are stored with the entries when the cache is closed,
+            # also by sessions that only read from the cache
+            def open_cache():
+                if backend == 'json':
+                    return CacheManager("stats_test_json")
+                return SqliteCacheManager("stats_test_sqlite")
+            ps.disable_cache()
+            cache = open_cache()
+            hits = sorted(e.cache_hits for e in cache.entries())
+            self.assertEqual(hits, [0, 0, 2])
+            self.assertTrue(all(e.last_access != '' for e in cache.entries() if e.cache_hits > 0))
+            ps.enable_cache("stats_test_" + backend, metadata_backend = backend)
+            ps.run_process(func)
+            ps.disable_cache()
+            self.assertEqual(sorted(e.cache_hits for e in open_cache().entries()), [0, 0, 3])
+
+            # And periodically while the cache is open
+            ps.enable_cache("stats_test_" + backend, metadata_backend = backend)
+            ps._cache_manager.access_write_interval = 0.0
+            ps.run_process(func)
+            self.assertEqual(sorted(e.cache_hits for e in open_cache().entries()), [0, 0, 4])
+            ps.clear_cache()
+
+    def test_cache_entry_store(self):
+        from tinc.cachemanager import _entry_to_json
+        entries = [_make_entry(i) for i in range(3)]
+        entries.append(CacheEntry(timestamp_start = "2021-01-01T00:00:00", timestamp_end = "2021-01-01T00:00:01",
+                                  files = [FileDependency(DistributedPath(filename = "a.nc", relative_path = "ab/")),
+                                           FileDependency(DistributedPath(filename = "b.nc"), size = 10, hash = "123")],
+                                  source_info = SourceInfo(type = "PythonScript", tinc_id = 'id', command_line_arguments = "-v",
+                                                           arguments = [SourceArgument(id = 'x', value = VariantValue(nctype = VariantType.VARIANT_DOUBLE, value = 0.25)),
+                                                                        SourceArgument(id = 'name', value = VariantValue(nctype = VariantType.VARIANT_STRING, value = "abc")),
+                                                                        SourceArgument(id = 'list', value = VariantValue(nctype = VariantType.VARIANT_DOUBLE, value = [1.0, 2.0]))],
+                                                           dependencies = [SourceArgument(id = 'dep', value = VariantValue(nctype = VariantType.VARIANT_INT32, value = 3))],
+                                                           file_dependencies = [FileDependency(DistributedPath(filename = "in.txt"), modified = "now")]),
+                                  cache_hits = 4, stale = True))
+        store = CacheEntryStore(first_id = 10)
+        ids = [store.add(e) for e in entries] + [store.add_json(_entry_to_json(e)) for e in entries]
+        self.assertEqual(ids, list(range(10, 18)))
+        self.assertEqual(len(store), 8)
+        for entry_id, entry in zip(ids, entries + entries):
+            self.assertEqual(store[entry_id].to_entry(), entry)
+            self.assertEqual(store[entry_id], entry)
+            self.assertEqual(store[entry_id].source_info, entry.source_info)
+
+        store.update(13, cache_hits = 5, last_access = "later", stale = False)
+        self.assertEqual(store[13].to_entry(), entries[3]._replace(cache_hits = 5, last_access = "later", stale = False))
+        self.assertEqual(list(store.column("cache_hits")), [0, 0, 0, 5, 0, 0, 0, 4])
+        self.assertEqual(store.string(store.column("last_access")[3]), "later")
+
+        self.assertEqual(store.file_references("", "out1.bin"), 2)
+        self.assertEqual(store.file_references("ab/", "a.nc"), 2)
+        self.assertEqual(store.file_references("", "a.nc"), 0)
+        removed = store.pop(11)
+        self.assertEqual(removed, entries[1])
+        self.assertEqual(store.file_references("", "out1.bin"), 1)
+        store.pop(15)
+        self.assertEqual(store.file_references("", "out1.bin"), 0)
+        self.assertNotIn(11, store)
+        self.assertIn(12, store)
+        self.assertEqual(store.keys(), [10, 12, 13, 14, 16, 17])
+        self.assertEqual(len(store), 6)
+        self.assertGreater(store.nbytes(), 0)
+        store.shrink()
+        self.assertEqual(store[17], entries[3])
+        self.assertEqual(store.to_json(), [_entry_to_json(store[entry_id]) for entry_id in store.keys()])
+        self.assertEqual(store.removed_count(), 2)
+
+        # numpy scalars are stored in the numeric columns
+        value_count = len(store._values)
+        for value in [np.float64(0.5), np.float32(0.25), np.int32(3), np.int64(-2)]:
+            entry_id = store.add(_make_entry(0)._replace(source_info = SourceInfo(
+                type = "PythonScript", tinc_id = 'id',
+                arguments = [SourceArgument(id = 'x', value = VariantValue(nctype = VariantType.VARIANT_DOUBLE, value = value))])))
+            decoded = store[entry_id].source_info.arguments[0].value.value
+            self.assertEqual(decoded, value)
+            self.assertIn(type(decoded), [int, float])
+        self.assertEqual(len(store._values), value_count)
+
+    def test_entry_store_compaction(self):
+        import tinc.cachemanager
+        compact_min_removed = tinc.cachemanager._COMPACT_MIN_REMOVED
+        tinc.cachemanager._COMPACT_MIN_REMOVED = 16
+        try:
+            cache = CacheManager("compaction_test")
+            cache.clear_cache()
+            cache.set_cache_budget(max_entries = 10)
+            for i in range(500):
+                cache.append_entry(_make_entry(i))
+                if i == 490:
+                    self.assertEqual(cache.find_cache(_make_entry(485).source_info), ["out485.bin"])
+            # Removed entries are released
+            self.assertLessEqual(cache._entries.removed_count(), 16)
+            self.assertLess(len(cache._entries._strings.values), 40)
+            self.assertEqual(len(cache.entries()), 10)
+            self.assertEqual(cache.find_cache(_make_entry(495).source_info), ["out495.bin"])
+            self.assertEqual(cache.find_cache(_make_entry(486).source_info), [])
+            # Eviction order is kept across compactions
+            self.assertEqual(cache.find_cache(_make_entry(485).source_info), ["out485.bin"])
+            for i in range(500, 520):
+                cache.append_entry(_make_entry(i))
+                self.assertEqual(cache.find_cache(_make_entry(485).source_info), ["out485.bin"])
+            cache.write_to_disk()
+            self.assertEqual(sorted(e.source_info.arguments[0].value.value for e in CacheManager("compaction_test").entries()),
+                             [485] + list(range(511, 520)))
+            cache.clear_cache()
+        finally:
+            tinc.cachemanager._COMPACT_MIN_REMOVED = compact_min_removed
+
+    def test_metadata_validation(self):
+        cache = CacheManager("validation_test")
+        cache.clear_cache()
+        for i in range(3):
+            cache.append_entry(_make_entry(i))
+        cache.write_to_disk()
+        path = cache.cache_directory() + "tinc_cache.json"
+        self.assertTrue(os.path.exists(path + ".sha1"))
+
+        # Metadata written by a CacheManager is not validated again
+        validations = []
+        class CountingValidator(object):
+            def __init__(self, validator):
+                self._validator = validator
+            def validate(self, j):
+                validations.append(j)
+                self._validator.validate(j)
+        other = CacheManager("validation_test")
+        other._validator = CountingValidator(other._validator)
+        other._disk_signature = None
+        other.update_from_disk()
+        self.assertEqual(len(validations), 0)
+        self.assertEqual(other.entry_count(), 3)
+
+        # Metadata changed by other writers is
+        with open(path) as f:
+            j = json.load(f)
+        j["entries"][0]["cacheHits"] = "not a number"
+        with open(path, 'w') as f:
+            json.dump(j, f)
+        other.update_from_disk()
+        self.assertEqual(len(validations), 1)
+        # Not valid, so ignored
+        self.assertEqual(other.entry_count(), 3)
+        os.remove(path)
+        cache.clear_cache()
+
+    def test_metadata_version(self):
+        from tinc.cachemanager import _metadata_entries, _metadata_json, _schema_validator, _entry_to_json
+        validator = _schema_validator()
+        j_entries = [_entry_to_json(_make_entry(i)) for i in range(3)]
+        # Without the fields added in 1.1, metadata is written as 1.0
+        j = _metadata_json(j_entries)
+        self.assertEqual((j["tincMetaVersionMajor"], j["tincMetaVersionMinor"]), (1, 0))
+        validator.validate(j)
+        self.assertEqual(len(_metadata_entries(j, validator)), 3)
+
+        j_entries[1]["lastAccess"] = "2024-01-01T00:00:00+00:00"
+        j = _metadata_json(j_entries)
+        self.assertEqual(j["tincMetaVersionMinor"], 1)
+        validator.validate(j)
+        self.assertEqual(len(_metadata_entries(j, validator)), 3)
+
+        # 1.0 metadata can't have the new fields
+        j["tincMetaVersionMinor"] = 0
+        self.assertIsNone(_metadata_entries(j, validator))
+        # Newer versions are not read
+        j["tincMetaVersionMinor"] = 2
+        self.assertIsNone(_metadata_entries(j, validator))
+
+    def test_cache_writer(self):
+        import threading
+        written = []
+        idle = []
+        release = threading.Event()
+        def write(value):
+            release.wait()
+            written.append(value)
+        writer = CacheWriter(lambda: idle.append(len(written)), max_bytes = 100)
+        writer.submit("a", 1, 60, lambda: write(1))
+        self.assertEqual(writer.get("a"), (True, 1))
+        self.assertEqual(writer.get("b"), (False, None))
+
+        # Submitting over the memory budget blocks until the writer catches up
+        submitter = threading.Thread(target = writer.submit, args = ("b", 2, 60, lambda: write(2)))
+        submitter.start()
+        submitter.join(0.2)
+        self.assertTrue(submitter.is_alive())
+        self.assertFalse(writer.flush(timeout = 0.1))
+        writer.call_when_written(lambda: written.append("marker"))
+        release.set()
+        submitter.join()
+        self.assertTrue(writer.flush())
+        self.assertEqual(written, [1, "marker", 2])
+        self.assertEqual(idle[-1], 3)
+        self.assertEqual(writer.get("a"), (False, None))
+        self.assertEqual(writer.pending_bytes(), 0)
+
+        # Errors are reported and don't stop the writer
+        writer.submit("c", 3, 10, lambda: 1 / 0)
+        writer.submit("d", 4, 10, lambda: written.append(4))
+        writer.close()
+        self.assertEqual(writer.errors, 1)
+        self.assertEqual(written[-1], 4)
+        self.assertEqual(result_size(np.ones(10)), 80)
+
+    def test_content_layout(self):
+        for backend in ['json', 'sqlite']:
+            p1 = Parameter("param1")
+            p1.values = [0.0, 1.0, 2.0, 3.0, 4.0, 5.0]
+            ps = ParameterSpace("ps")
+            ps.register_parameters([p1])
+            directory = "content_test_" + backend
+            ps.enable_cache(directory, metadata_backend = backend, file_layout = 'content')
+            ps.clear_cache()
+            ps._cache_manager.reset_stats()
+
+            calls = []
+            def func(param1):
+                calls.append(param1)
+                # Saturates above 2
+                return np.ones(1000) * min(param1, 2.0)
+            ps.sweep(func)
+            self.assertEqual(len(calls), 6)
+
+            def blob_files():
+                return sorted(os.path.join(root, f)[len(directory) + 1:].replace(os.sep, "/")
+                              for root, dirs, files in os.walk(directory + "/blobs") for f in files)
+            self.assertEqual(len(blob_files()), 3)
+            entries = ps._cache_manager.entries()
+            self.assertEqual(len(entries), 6)
+            self.assertEqual(len(set(cache_file_name(e.files[0]) for e in entries)), 3)
+            for e in entries:
+                self.assertEqual(cache_file_name(e.files[0]),
+                                 blob_directory(e.files[0].hash) + e.files[0].hash + ".npy")
+            stats = ps._cache_manager.stats()
+            self.assertEqual(stats["disk_bytes"], 3 * entries[0].files[0].size)
+            self.assertEqual(stats["bytes_written"], stats["disk_bytes"])
+
+            p1.value = 4.0
+            self.assertTrue(np.array_equal(ps.run_process(func), np.ones(1000) * 2.0))
+            self.assertEqual(len(calls), 6)
+
+            # Shared files are removed with the last entry that references them
+            ps._cache_manager.set_cache_budget(max_entries = 1)
+            self.assertEqual(ps._cache_manager.entry_count(), 1)
+            self.assertEqual(len(blob_files()), 1)
+            self.assertTrue(np.array_equal(ps.run_process(func), np.ones(1000) * 2.0))
+            self.assertEqual(len(calls), 6)
+            ps._cache_manager.set_cache_budget()
+            ps.clear_cache()
+            self.assertEqual(blob_files(), [])
+
+    def test_sharded_layout(self):
+        for backend in ['json', 'sqlite']:
+            p1 = Parameter("param1")
+            p1.values = [0.0, 1.0, 2.0]
+            ps = ParameterSpace("ps")
+            ps.register_parameters([p1])
+            directory = "sharded_test_" + backend
+            ps.enable_cache(directory, metadata_backend = backend, file_layout = 'flat')
+            ps.clear_cache()
+
+            calls = []
+            def func(param1):
+                calls.append(param1)
+                return [param1]
+            ps.sweep(func)
+            flat_files = [cache_file_name(e.files[0]) for e in ps._cache_manager.entries()]
+            self.assertTrue(all(f.startswith("ps_func_") for f in flat_files))
+
+            self.assertEqual(ps._cache_manager.migrate_to_sharded(), 3)
+            self.assertEqual(ps._cache_manager.migrate_to_sharded(), 0)
+            for entry, flat_file in zip(ps._cache_manager.entries(), flat_files):
+                file_hash = source_info_hash(entry.source_info)
+                self.assertEqual(cache_file_name(entry.files[0]), file_hash[:2] + "/" + file_hash[2:4] + "/" + file_hash + ".pkl")
+                self.assertTrue(os.path.exists(directory + "/" + cache_file_name(entry.files[0])))
+                self.assertFalse(os.path.exists(directory + "/" + flat_file))
+
+            # Migrated entries are found, and new entries are sharded
+            ps.enable_cache(directory, metadata_backend = backend)
+            p1.value = 2.0
+            self.assertEqual(ps.run_process(func), [2.0])
+            p1.values = [0.0, 1.0, 2.0, 3.0]
+            ps.sweep(func)
+            self.assertEqual(calls, [0.0, 1.0, 2.0, 3.0])
+            self.assertEqual(len(set(cache_file_name(e.files[0]) for e in ps._cache_manager.entries())), 4)
+            self.assertTrue(all(e.files[0].file.relative_path != '' for e in ps._cache_manager.entries()))
+            ps.clear_cache()
+            self.assertEqual(ps._cache_manager.entries(), [])
+
+def _make_entry(i):
+    return CacheEntry(files = [FileDependency(DistributedPath(filename = f"out{i}.bin"))],
+                      source_info = SourceInfo(type = "PythonScript", tinc_id = 'id',
+                                               arguments = [SourceArgument(id = 'arg_id',
+                                                                           value = VariantValue(nctype = VariantType.VARIANT_INT64, value = i))]))
+
+def _append_entries(directory, first, count):
+    cache = CacheManager(directory)
+    for i in range(first, first + count):
+        cache.append_entry(_make_entry(i))
+        cache.write_to_disk()
+
 
 if __name__ == '__main__': 
     unittest.main()
@@ -7,6 +7,12 @@ Created on Fri Sep 11 16:30:13 2020
 
 import sys
 import time
+import os
+import json
+import shutil
+import tempfile
+
+import numpy as np
 
 from tinc import *
 
@@ -109,5 +115,65 @@ class DataPoolTest(unittest.TestCase):
         internalDim.value = 0.0
         externalDim.value = 10.0
 
+        slice = dp.get_slice('field1', ['external', 'internal'])
+        self.assertEqual(slice.shape, (3, 8))
+        self.assertListEqual(list(slice[0]), [0,1,2,3,4,5,6,7])
+        self.assertListEqual(list(slice[2]), [5,7,8,9,0,1,6,4])
+        self.assertListEqual(list(slice[:, 0]), [0,1,5])
+        self.assertListEqual(list(slice[:, 4]), [4,5,0])
+        self.assertEqual(slice.dimensions, ['external', 'internal'])
+        self.assertTrue(np.allclose(slice.coordinates['external'], [10.0, 10.1, 10.2]))
+        self.assertTrue(np.allclose(slice.coordinates['internal'], internalDim.values))
+
+        # Axes follow the order of the slice dimensions
+        slice = dp.get_slice('field3', ['internal', 'external'])
+        self.assertEqual(slice.shape, (8, 3))
+        self.assertListEqual(list(slice[:, 2]), [1,3,5,7,9,0,2,4])
+
+        # Values of other dimensions can be overriden
+        slice = dp.get_slice('field1', 'external', {'internal': 0.4})
+        self.assertListEqual(list(slice), [4,5,0])
+
+    def test_nd_slices(self):
+        directory = tempfile.mkdtemp()
+        for a in range(2):
+            for b in range(3):
+                os.makedirs(f"{directory}/a{a}/b{b}")
+                with open(f"{directory}/a{a}/b{b}/results.json", 'w') as f:
+                    json.dump({"field": [100 * a + 10 * b + i for i in range(4)]}, f)
+        ps = ParameterSpace("ps_nd")
+        ps.set_root_path(directory)
+        a = ParameterInt("a")
+        a.values = [0, 1]
+        b = ParameterInt("b")
+        b.values = [0, 1, 2]
+        c = Parameter("c")
+        c.values = [0.0, 0.5, 1.0, 1.5]
+        ps.register_parameters([a, b, c])
+        ps.set_current_path_template("a%%a%%/b%%b%%")
+
+        class CountingDataPool(DataPoolJson):
+            reads = 0
+            def _get_field_from_file(self, field, full_path):
+                CountingDataPool.reads += 1
+                return super()._get_field_from_file(field, full_path)
+        dp = CountingDataPool("dp_nd", ps, directory + "/slices/")
+        dp.register_data_file("results.json", "c")
+
+        slice = dp.get_slice('field', ['b', 'c', 'a'])
+        self.assertEqual(slice.shape, (3, 4, 2))
+        self.assertEqual(CountingDataPool.reads, 6)
+        for i in range(3):
+            for j in range(4):
+                for k in range(2):
+                    self.assertEqual(slice[i, j, k], 100 * k + 10 * i + j)
+        self.assertListEqual(list(slice.coordinates['b']), [0, 1, 2])
+
+        c.value = 1.0
+        b.value = 2
+        slice = dp.get_slice('field', ['a'])
+        self.assertListEqual(list(slice), [22, 122])
+        shutil.rmtree(directory)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
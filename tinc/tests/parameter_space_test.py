@@ -5,11 +5,16 @@ Created on Mon Jun 14 11:49:43 2021
 @author: Andres
 """
 
-import sys,time
+import sys,time,os
+import asyncio
+import numpy as np
 import unittest
 
 from tinc import *
 
+def sweep_func(param1, param2):
+    return param1 * param2
+
 
 class ParameterSpaceTest(unittest.TestCase):
 
@@ -61,6 +66,886 @@ class ParameterSpaceTest(unittest.TestCase):
         
         ps.sweep(func)
 
+    def test_sweep_parallel(self):
+        p1 = Parameter("param1")
+        p1.values = [0, 1,2,3,4]
+        p2 = Parameter("param2")
+        p2.values = [-0.3,-0.2, -0.1, 0]
+
+        ps = ParameterSpace("ps_parallel")
+        ps.register_parameters([p1, p2])
+        
+        for backend in ['thread', 'process']:
+            results = {}
+            def cb(values, result):
+                results[(values['param1'], values['param2'])] = result
+            ps.sweep_parallel(sweep_func, num_workers = 3, backend = backend, chunk_size = 4, callback = cb)
+            self.assertEqual(len(results), 20)
+            for (v1, v2), result in results.items():
+                self.assertAlmostEqual(result, v1 * v2)
+        self.assertFalse(ps.sweep_running)
+
+    def test_sweep_parallel_chunk_size(self):
+        import tinc.parameter_space
+        p1 = Parameter("param1")
+        p1.values = np.linspace(0, 1, 2000)
+
+        ps = ParameterSpace("ps_parallel")
+        ps.register_parameter(p1)
+
+        chunk_sizes = []
+        run_sweep_chunk = tinc.parameter_space._run_sweep_chunk
+        def record_chunk(function, chunk):
+            chunk_sizes.append(len(chunk))
+            return run_sweep_chunk(function, chunk)
+        tinc.parameter_space._run_sweep_chunk = record_chunk
+        try:
+            ps.sweep_parallel(lambda param1: param1, num_workers = 2, backend = 'thread')
+        finally:
+            tinc.parameter_space._run_sweep_chunk = run_sweep_chunk
+        # The default chunk size is capped for large sweeps
+        self.assertEqual(max(chunk_sizes), 64)
+        self.assertEqual(sum(chunk_sizes), 2000)
+
+    def test_sweep_parallel_cache(self):
+        p1 = Parameter("param1")
+        p1.values = [0.0, 1.0, 2.0, 3.0, 4.0]
+        p2 = Parameter("param2")
+        p2.values = [-0.3,-0.2, -0.1, 0]
+
+        ps = ParameterSpace("ps_parallel")
+        ps.register_parameters([p1, p2])
+        ps.enable_cache("ps_parallel_test")
+        ps.clear_cache()
+
+        calls = []
+        def func(param1, param2):
+            calls.append((param1, param2))
+            return param1 * param2
+        
+        ps.sweep_parallel(func, num_workers = 4, backend = 'thread')
+        self.assertEqual(len(calls), 20)
+        self.assertEqual(len(ps._cache_manager.entries()), 20)
+
+        # Everything cached, nothing is recomputed
+        ps.sweep_parallel(func, num_workers = 4, backend = 'thread')
+        self.assertEqual(len(calls), 20)
+
+        p1.value = 3
+        p2.value = -0.1
+        self.assertAlmostEqual(ps.run_process(func), 3 * -0.1)
+        self.assertEqual(len(calls), 20)
+
+    def test_sweep_progress(self):
+        p1 = Parameter("param1")
+        p1.values = [0.0, 1.0, 2.0, 3.0, 4.0]
+        p2 = Parameter("param2")
+        p2.values = [-0.3,-0.2, -0.1, 0.0]
+
+        ps = ParameterSpace("ps_progress")
+        ps.register_parameters([p1, p2])
+        ps.enable_cache("ps_progress_test")
+        ps.clear_cache()
+
+        def func(param1, param2):
+            return param1 * param2
+
+        ps.sweep(func, params = [p1])
+        report = ps.sweep_progress.report()
+        self.assertFalse(report["running"])
+        self.assertEqual(report["total"], 5)
+        self.assertEqual(report["completed"], 5)
+        self.assertEqual(report["remaining"], 0)
+        self.assertEqual(report["cache_misses"], 5)
+        self.assertEqual(set(report["latency_percentiles"].keys()), {50, 90, 99})
+        self.assertEqual(len(ps.sweep_progress.slowest_samples()), 5)
+
+        ps.sweep_parallel(func, num_workers = 2, backend = 'thread')
+        report = ps.sweep_progress.report()
+        self.assertEqual(report["completed"], 20)
+        self.assertEqual(report["cache_hits"], 5)
+        self.assertEqual(report["cache_misses"], 15)
+
+    def test_sweep_vectorized(self):
+        p1 = Parameter("param1")
+        p1.values = [0.0, 1.0, 2.0, 3.0, 4.0]
+        p2 = Parameter("param2")
+        p2.values = [-0.3,-0.2, -0.1, 0.0]
+
+        ps = ParameterSpace("ps_vectorized")
+        ps.register_parameters([p1, p2])
+
+        calls = []
+        def func(param1, param2):
+            calls.append(len(param1))
+            return param1 * param2
+
+        result = ps.sweep_vectorized(func, chunk_size = 6, output = 'array')
+        self.assertEqual(result.shape, (5, 4))
+        self.assertEqual(calls, [6, 6, 6, 2])
+        for i, v1 in enumerate(p1.values):
+            for j, v2 in enumerate(p2.values):
+                self.assertAlmostEqual(result[i, j], v1 * v2)
+
+        ps.enable_cache("ps_vectorized_test")
+        ps.clear_cache()
+        ps.sweep_vectorized(func, chunk_size = 6)
+        self.assertEqual(len(ps._cache_manager.entries()), 20)
+
+        calls.clear()
+        p1.value = 3.0
+        p2.value = -0.1
+        self.assertAlmostEqual(ps.run_process(func), 3.0 * -0.1)
+        self.assertEqual(calls, [])
+
+    def test_sweep_vectorized_concurrent_write(self):
+        p1 = Parameter("param1")
+        p1.values = [0.0, 1.0, 2.0, 3.0, 4.0]
+        p2 = Parameter("param2")
+        p2.values = [-0.3,-0.2, -0.1, 0.0]
+
+        ps = ParameterSpace("ps_vectorized")
+        ps.register_parameters([p1, p2])
+        ps.enable_cache("ps_vectorized_concurrent")
+        ps.clear_cache()
+
+        def func(param1, param2):
+            if np.ndim(param1) > 0 and len(ps._cache_manager.entries()) == 0:
+                # Another writer stores a sample of the chunk while it is computed
+                ps.run_process(func, {'param1': 1.0, 'param2': -0.3})
+            return param1 * param2
+
+        ps.sweep_vectorized(func, chunk_size = 20)
+        self.assertEqual(len(ps._cache_manager.entries()), 20)
+
+    def test_sweep_checkpoint(self):
+        p1 = Parameter("param1")
+        p1.values = [0.0, 1.0, 2.0, 3.0, 4.0]
+        p2 = Parameter("param2")
+        p2.values = [-0.3,-0.2, -0.1, 0.0]
+
+        ps = ParameterSpace("ps_checkpoint")
+        ps.register_parameters([p1, p2])
+        if os.path.exists("sweep_checkpoint.bin"):
+            os.remove("sweep_checkpoint.bin")
+
+        calls = []
+        def func(param1, param2):
+            calls.append((param1, param2))
+            if len(calls) == 7:
+                ps.sweep_running = False
+            return param1 * param2
+
+        # Interrupted sweep
+        ps.sweep(func, checkpoint = "sweep_checkpoint.bin")
+        self.assertEqual(len(calls), 7)
+        checkpoint = SweepCheckpoint("sweep_checkpoint.bin", 20, ps._sweep_checkpoint(
+            "sweep_checkpoint.bin", func, [p1, p2], [], 30).signature)
+        self.assertEqual(checkpoint.completed_count(), 7)
+        self.assertEqual(list(checkpoint.pending()), list(range(7, 20)))
+
+        # Resume
+        ps.sweep(func, checkpoint = "sweep_checkpoint.bin")
+        self.assertEqual(len(calls), 20)
+        self.assertEqual(len(set(calls)), 20)
+
+        # Nothing left to do
+        ps.sweep(func, checkpoint = "sweep_checkpoint.bin")
+        self.assertEqual(len(calls), 20)
+
+        # Different space invalidates checkpoint
+        p2.values = [-0.3,-0.2, -0.1]
+        ps.sweep(func, checkpoint = "sweep_checkpoint.bin")
+        self.assertEqual(len(calls), 35)
+        os.remove("sweep_checkpoint.bin")
+
+        # Samples that raised are retried on resume
+        failed = []
+        def failing_func(param1, param2):
+            if param1 == 2.0 and param2 == -0.2 and len(failed) == 0:
+                failed.append((param1, param2))
+                raise ValueError("Failed once")
+            calls.append((param1, param2))
+            return param1 * param2
+        ps.sweep(failing_func, checkpoint = "sweep_checkpoint.bin")
+        self.assertEqual(len(calls), 49)
+        ps.sweep(failing_func, checkpoint = "sweep_checkpoint.bin")
+        self.assertEqual(calls[-1], (2.0, -0.2))
+        self.assertEqual(len(calls), 50)
+
+        # Asyncio sweeps also retry failed samples
+        async def failing_coro(param1, param2):
+            return failing_func(param1, param2)
+        del failed[:]
+        os.remove("sweep_checkpoint.bin")
+        asyncio.run(ps.sweep_async_io(failing_coro, checkpoint = "sweep_checkpoint.bin"))
+        self.assertEqual(len(calls), 64)
+        del failed[:]
+        failed.append(None)
+        asyncio.run(ps.sweep_async_io(failing_coro, checkpoint = "sweep_checkpoint.bin"))
+        self.assertEqual(calls[-1], (2.0, -0.2))
+        self.assertEqual(len(calls), 65)
+        os.remove("sweep_checkpoint.bin")
+
+    def test_sweep_checkpoint_plan(self):
+        p1 = Parameter("param1")
+        p1.values = [0.0, 1.0, 2.0, 3.0, 4.0]
+        p2 = Parameter("param2")
+        p2.values = [-0.3,-0.2, -0.1, 0.0]
+
+        ps = ParameterSpace("ps_checkpoint_plan")
+        ps.register_parameters([p1, p2])
+        ps.enable_cache("ps_checkpoint_plan_test")
+        ps.clear_cache()
+        if os.path.exists("sweep_checkpoint_plan.bin"):
+            os.remove("sweep_checkpoint_plan.bin")
+
+        calls = []
+        def func(param1, param2):
+            calls.append((param1, param2))
+            if len(calls) == 7:
+                ps.sweep_running = False
+            return param1 * param2
+        ps.sweep(func, checkpoint = "sweep_checkpoint_plan.bin")
+        self.assertEqual(len(calls), 7)
+
+        # Only the samples not completed are looked up in the cache
+        looked_up = []
+        find_entries = ps._cache_manager.find_entries
+        def counting_find_entries(source_infos, verify_hash = True):
+            source_infos = list(source_infos)
+            looked_up.extend(source_infos)
+            return find_entries(source_infos, verify_hash)
+        ps._cache_manager.find_entries = counting_find_entries
+        ps.sweep(func, checkpoint = "sweep_checkpoint_plan.bin")
+        self.assertEqual(len(looked_up), 13)
+        self.assertEqual(len(calls), 20)
+        self.assertEqual(len(set(calls)), 20)
+        os.remove("sweep_checkpoint_plan.bin")
+        ps.clear_cache()
+
+    def test_checkpoint_concurrent_flush(self):
+        import threading
+        if os.path.exists("concurrent_checkpoint.bin"):
+            os.remove("concurrent_checkpoint.bin")
+        checkpoint = SweepCheckpoint("concurrent_checkpoint.bin", 4000, "sig", flush_interval = 0.0)
+        errors = []
+        def mark(start):
+            try:
+                for i in range(start, 4000, 4):
+                    checkpoint.mark_done(i)
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target = mark, args = (i,)) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        checkpoint.flush()
+        self.assertEqual(errors, [])
+        self.assertFalse(os.path.exists("concurrent_checkpoint.bin.tmp"))
+        self.assertEqual(SweepCheckpoint("concurrent_checkpoint.bin", 4000, "sig").completed_count(), 4000)
+        os.remove("concurrent_checkpoint.bin")
+
+    def test_sweep_async_io(self):
+        p1 = Parameter("param1")
+        p1.values = [0.0, 1.0, 2.0, 3.0, 4.0]
+        p2 = Parameter("param2")
+        p2.values = [-0.3,-0.2, -0.1, 0.0]
+
+        ps = ParameterSpace("ps_asyncio")
+        ps.register_parameters([p1, p2])
+        ps.enable_cache("ps_asyncio_test")
+        ps.clear_cache()
+
+        running = [0]
+        max_running = [0]
+        calls = []
+        async def func(param1, param2):
+            running[0] += 1
+            max_running[0] = max(max_running[0], running[0])
+            await asyncio.sleep(0.001)
+            running[0] -= 1
+            calls.append((param1, param2))
+            return param1 * param2
+
+        results = {}
+        def cb(values, result):
+            results[(values['param1'], values['param2'])] = result
+        asyncio.run(ps.sweep_async_io(func, max_concurrency = 3, callback = cb))
+        self.assertEqual(len(calls), 20)
+        self.assertEqual(len(results), 20)
+        self.assertEqual(max_running[0], 3)
+        for (v1, v2), result in results.items():
+            self.assertAlmostEqual(result, v1 * v2)
+
+        # Cached
+        p1.value = 3.0
+        p2.value = -0.1
+        self.assertAlmostEqual(asyncio.run(ps.run_process_async(func)), 3.0 * -0.1)
+        self.assertEqual(len(calls), 20)
+
+        # Plain functions run in the executor
+        def sync_func(param1, param2):
+            return param1 + param2
+        self.assertAlmostEqual(asyncio.run(ps.run_process_async(sync_func)), 3.0 - 0.1)
+
+    def test_plan_sweep(self):
+        p1 = Parameter("param1")
+        p1.values = [0.0, 1.0, 2.0, 3.0, 4.0]
+        p2 = Parameter("param2")
+        p2.values = [-0.3,-0.2, -0.1, 0.0]
+
+        ps = ParameterSpace("ps_plan")
+        ps.register_parameters([p1, p2])
+        ps.enable_cache("ps_plan_test")
+        ps.clear_cache()
+
+        calls = []
+        def func(param1, param2):
+            calls.append((param1, param2))
+            return param1 * param2
+
+        plan = ps.plan_sweep(func)
+        self.assertEqual(plan.hit_count(), 0)
+        self.assertEqual(plan.miss_count(), 20)
+        self.assertIsNone(plan.estimated_remaining_time())
+
+        ps.sweep(func, params = [p1])
+        self.assertEqual(len(calls), 5)
+
+        plan = ps.plan_sweep(func)
+        self.assertEqual(plan.hit_count(), 5)
+        self.assertAlmostEqual(plan.hit_ratio(), 0.25)
+        self.assertIsNotNone(plan.estimated_remaining_time())
+        index = ps.index_of({"param1": 2.0, "param2": p2.value})
+        self.assertTrue(plan.is_cached(index))
+        self.assertAlmostEqual(plan.load(index), 2.0 * p2.value)
+        self.assertIsNone(plan.load(plan.misses[0]))
+
+        # Only missing samples are computed
+        ps.sweep(func, plan = plan)
+        self.assertEqual(len(calls), 20)
+        self.assertEqual(len(set(calls)), 20)
+
+        results = {}
+        def cb(values, result):
+            results[(values['param1'], values['param2'])] = result
+        ps.sweep_parallel(func, backend = 'thread', callback = cb)
+        self.assertEqual(len(calls), 20)
+        self.assertEqual(len(results), 20)
+
+    def test_cache_serializers(self):
+        p1 = Parameter("param1")
+        p1.values = [0.0, 1.0]
+
+        ps = ParameterSpace("ps_serializers")
+        ps.register_parameters([p1])
+        ps.enable_cache("ps_serializers_test")
+        ps.clear_cache()
+
+        outputs = {"array": lambda v: np.arange(10) * v,
+                   "dict": lambda v: {"a": np.ones((2, 3), dtype = np.float32) * v, "b": np.full((), int(v), dtype = np.int64),
+                                      "c": np.zeros(0)},
+                   "list": lambda v: [v, "text"],
+                   "masked": lambda v: np.ma.masked_array(np.arange(4) * v, mask = [0, 1, 0, 0]),
+                   "matrix": lambda v: np.matrix([[v, 2.0]])}
+        extensions = {"array": ".npy", "dict": ".npd", "list": ".pkl", "masked": ".pkl", "matrix": ".pkl"}
+        for name, make_output in outputs.items():
+            ps.clear_cache()
+            def func(param1):
+                return make_output(param1)
+            ps.sweep(func)
+            filenames = [e.files[0].file.filename for e in ps._cache_manager.entries()]
+            self.assertTrue(all(f.endswith(extensions[name]) for f in filenames))
+
+            p1.value = 1.0
+            calls = []
+            def func(param1):
+                calls.append(param1)
+                return make_output(param1)
+            out = ps.run_process(func)
+            self.assertEqual(calls, [])
+            expected = make_output(1.0)
+            if name == "array":
+                self.assertIsInstance(out, np.memmap)
+                self.assertTrue(np.array_equal(out, expected))
+            elif name == "dict":
+                self.assertEqual(set(out.keys()), set(expected.keys()))
+                for key in expected:
+                    self.assertEqual(out[key].dtype, expected[key].dtype)
+                    self.assertTrue(np.array_equal(out[key], expected[key]))
+                self.assertIsInstance(out["a"], np.memmap)
+            elif name == "masked":
+                # Subclasses are pickled and keep their type
+                self.assertIsInstance(out, np.ma.MaskedArray)
+                self.assertEqual(list(out.mask), [False, True, False, False])
+                self.assertTrue(np.array_equal(out.data, expected.data))
+            elif name == "matrix":
+                self.assertIsInstance(out, np.matrix)
+                self.assertTrue(np.array_equal(out, expected))
+            else:
+                self.assertEqual(out, expected)
+
+    def test_cache_compression(self):
+        p1 = Parameter("param1")
+        p1.values = [0.0, 1.0]
+
+        ps = ParameterSpace("ps_compression")
+        ps.register_parameters([p1])
+        ps.enable_cache("ps_compression_test")
+
+        outputs = {"array": lambda v: np.full(100000, v),
+                   "dict": lambda v: {"a": np.full((300, 300), v, dtype = np.float32), "b": np.full((), int(v), dtype = np.int64)},
+                   "list": lambda v: [v] * 100000 + ["text\n"]}
+        for codec, extension in [("zlib", ".zz"), ("bz2", ".bz2"), ("lzma", ".xz")]:
+            ps.enable_cache_compression(codec, level = 1, min_size = 1000)
+            for name, make_output in outputs.items():
+                ps.clear_cache()
+                def func(param1):
+                    return make_output(param1)
+                ps.sweep(func)
+                entries = ps._cache_manager.entries()
+                self.assertTrue(all(e.compression == codec for e in entries))
+                self.assertTrue(all(e.files[0].file.filename.endswith(extension) for e in entries))
+                self.assertTrue(all(e.files[0].size < 10000 for e in entries))
+
+                p1.value = 1.0
+                calls = []
+                def func(param1):
+                    calls.append(param1)
+                    return make_output(param1)
+                out = ps.run_process(func)
+                self.assertEqual(calls, [])
+                expected = make_output(1.0)
+                if name == "array":
+                    self.assertTrue(np.array_equal(out, expected))
+                elif name == "dict":
+                    self.assertEqual(list(out.keys()), list(expected.keys()))
+                    for key in expected:
+                        self.assertEqual(out[key].dtype, expected[key].dtype)
+                        self.assertTrue(np.array_equal(out[key], expected[key]))
+                else:
+                    self.assertEqual(out, expected)
+
+        # Small results are not compressed
+        ps.enable_cache_compression('zlib', min_size = 10**9)
+        ps.clear_cache()
+        ps.sweep(outputs["array"])
+        self.assertTrue(all(e.compression == '' for e in ps._cache_manager.entries()))
+        ps.disable_cache_compression()
+        ps.clear_cache()
+
+    def test_memory_cache(self):
+        p1 = Parameter("param1")
+        p1.values = [0.0, 1.0, 2.0, 3.0, 4.0]
+
+        ps = ParameterSpace("ps_memory_cache")
+        ps.register_parameters([p1])
+        ps.enable_cache("ps_memory_cache_test")
+        ps.clear_cache()
+        ps.enable_memory_cache()
+
+        calls = []
+        def func(param1):
+            calls.append(param1)
+            return [param1] * 10
+
+        ps.sweep(func)
+        self.assertEqual(len(calls), 5)
+        self.assertEqual(ps.cache_stats()["memory"]["entries"], 5)
+
+        p1.value = 2.0
+        self.assertEqual(ps.run_process(func), [2.0] * 10)
+        self.assertEqual(ps.run_process(func), [2.0] * 10)
+        stats = ps.cache_stats()
+        self.assertEqual(stats["memory"]["hits"], 2)
+        self.assertEqual(stats["disk"]["hits"], 0)
+        self.assertEqual(len(calls), 5)
+
+        # Results are read from disk when they don't fit in memory
+        ps.enable_memory_cache(max_bytes = 0)
+        self.assertEqual(ps.run_process(func), [2.0] * 10)
+        stats = ps.cache_stats()
+        self.assertEqual(stats["memory"]["misses"], 1)
+        self.assertEqual(stats["memory"]["entries"], 0)
+        self.assertEqual(stats["disk"]["hits"], 1)
+
+        ps.clear_cache()
+        self.assertEqual(ps.cache_stats()["memory"]["entries"], 0)
+
+    def test_memory_cache_invalidation(self):
+        for backend in ['json', 'sqlite']:
+            p1 = Parameter("param1")
+            p1.values = [0.0, 1.0, 2.0, 3.0, 4.0]
+
+            ps = ParameterSpace("ps_memory_cache_invalidation")
+            ps.register_parameters([p1])
+            ps.enable_cache("ps_memory_cache_invalidation_" + backend, metadata_backend = backend)
+            ps.clear_cache()
+            ps.enable_cache("ps_memory_cache_invalidation_" + backend, metadata_backend = backend,
+                            max_entries = 2)
+            ps.enable_memory_cache()
+
+            calls = []
+            def func(param1):
+                calls.append(param1)
+                return [param1] * 10
+
+            # Evicted entries are dropped from memory
+            ps.sweep(func)
+            self.assertEqual(len(calls), 5)
+            self.assertEqual(ps.cache_stats()["memory"]["entries"], 2)
+            p1.value = 0.0
+            self.assertEqual(ps.run_process(func), [0.0] * 10)
+            self.assertEqual(len(calls), 6)
+
+            # Memory hits don't read the metadata written by other processes
+            p1.value = 4.0
+            self.assertEqual(ps.run_process(func), [4.0] * 10)
+            self.assertEqual(len(calls), 6)
+            if backend == 'json':
+                other = CacheManager("ps_memory_cache_invalidation_" + backend)
+            else:
+                other = SqliteCacheManager("ps_memory_cache_invalidation_" + backend)
+            other.append_entry(other.entries()[0]._replace(cache_hits = 0))
+            other.write_to_disk()
+            reloads = []
+            reload = ps._cache_manager._reload
+            def counting_reload():
+                reloads.append(None)
+                reload()
+            ps._cache_manager._reload = counting_reload
+            self.assertEqual(ps.run_process(func), [4.0] * 10)
+            self.assertEqual(reloads, [])
+            self.assertEqual(len(calls), 6)
+            del ps._cache_manager._reload
+
+            # Entries removed by another process are not returned from memory
+            # once the metadata is reloaded
+            other.clear_cache()
+            other.close()
+            ps._cache_manager.update_from_disk()
+            self.assertEqual(ps.run_process(func), [4.0] * 10)
+            self.assertEqual(len(calls), 7)
+            ps.disable_cache()
+
+    def test_write_behind(self):
+        p1 = Parameter("param1")
+        p1.values = [0.0, 1.0, 2.0, 3.0, 4.0]
+
+        ps = ParameterSpace("ps_write_behind")
+        ps.register_parameters([p1])
+        ps.enable_cache("ps_write_behind_test")
+        ps.clear_cache()
+        ps.enable_write_behind()
+
+        calls = []
+        def func(param1):
+            calls.append(param1)
+            return np.ones(100) * param1
+
+        if os.path.exists("write_behind_checkpoint"):
+            os.remove("write_behind_checkpoint")
+        ps.sweep(func, checkpoint = "write_behind_checkpoint")
+        self.assertEqual(len(calls), 5)
+        # Results are in the cache when the sweep returns with a checkpoint
+        checkpoint = SweepCheckpoint("write_behind_checkpoint", 5, ps._sweep_signature(func, [p1], []))
+        self.assertEqual(checkpoint.completed_count(), 5)
+        self.assertEqual(len(CacheManager("ps_write_behind_test").entries()), 5)
+        os.remove("write_behind_checkpoint")
+
+        # Results are found while they are being written, and after
+        p1.value = 4.0
+        self.assertTrue(np.array_equal(ps.run_process(func, force_recompute = True), np.ones(100) * 4.0))
+        self.assertTrue(np.array_equal(ps.run_process(func), np.ones(100) * 4.0))
+        ps.flush_cache()
+        self.assertEqual(ps._cache_writer.pending_count(), 0)
+        self.assertEqual(len(calls), 6)
+        ps.disable_write_behind()
+        self.assertTrue(np.array_equal(ps.run_process(func), np.ones(100) * 4.0))
+        self.assertEqual(len(calls), 6)
+        ps.clear_cache()
+
+    def test_approximate_lookup(self):
+        p1 = Parameter("param1")
+        p1.values = np.linspace(0.0, 10.0, 11)
+        p2 = ParameterInt("param2")
+        p2.values = [1, 2]
+        ps = ParameterSpace("ps_approximate")
+        ps.register_parameters([p1, p2])
+        ps.enable_cache("ps_approximate_test")
+        ps.clear_cache()
+
+        calls = []
+        def func(param1, param2):
+            calls.append(param1)
+            return param1 * 2 * param2
+        for value in [2.0, 4.0]:
+            self.assertEqual(ps.run_process(func, {"param1": value, "param2": 1}), value * 2)
+
+        # Exact hits, and the nearest sample within tolerance
+        self.assertEqual(ps.run_process(func, {"param1": 2.0, "param2": 1}, approximate = True), ProcessResult(4.0, True))
+        result = ps.run_process(func, {"param1": 2.2, "param2": 1}, approximate = True)
+        self.assertEqual(result.result, 4.0)
+        self.assertFalse(result.exact)
+        self.assertAlmostEqual(result.distance, 0.02)
+        self.assertEqual(result.neighbours[0].values, {"param1": 2.0})
+        self.assertEqual(len(calls), 2)
+
+        # Interpolation of the k nearest samples
+        lookup = ApproximateLookup(k = 2, tolerance = 0.15, interpolate = inverse_distance_weighting)
+        result = ps.run_process(func, {"param1": 3.0, "param2": 1}, approximate = lookup)
+        self.assertAlmostEqual(result.result, 6.0)
+        self.assertEqual(sorted(n.values["param1"] for n in result.neighbours), [2.0, 4.0])
+        self.assertEqual(len(calls), 2)
+        # Without interpolation only the nearest sample is loaded
+        result = ps.run_process(func, {"param1": 3.2, "param2": 1},
+                                approximate = ApproximateLookup(k = 2, tolerance = 0.15))
+        self.assertEqual(result.result, 8.0)
+        self.assertEqual([n.values["param1"] for n in result.neighbours], [4.0])
+        self.assertEqual(len(calls), 2)
+
+        # Samples out of tolerance, or with other discrete values, are not used
+        result = ps.run_process(func, {"param1": 8.0, "param2": 1}, approximate = lookup)
+        self.assertEqual(result, ProcessResult(16.0, True))
+        result = ps.run_process(func, {"param1": 2.2, "param2": 2}, approximate = True)
+        self.assertEqual(result, ProcessResult(8.8, True))
+        self.assertEqual(len(calls), 4)
+        # New entries are found
+        result = ps.run_process(func, {"param1": 8.1, "param2": 1}, approximate = True)
+        self.assertEqual((result.result, result.exact), (16.0, False))
+        ps.clear_cache()
+
+    def test_approximate_index_updates(self):
+        p1 = Parameter("param1")
+        p1.values = np.linspace(0.0, 10.0, 11)
+        ps = ParameterSpace("ps_approximate_updates")
+        ps.register_parameters([p1])
+        ps.enable_cache("ps_approximate_updates_test")
+        ps.clear_cache()
+        ps.enable_cache("ps_approximate_updates_test", max_entries = 3)
+
+        def func(param1):
+            return param1 * 2
+        ps.run_process(func, {"param1": 1.0})
+        ps.run_process(func, {"param1": 5.0})
+        self.assertEqual(ps.run_process(func, {"param1": 1.1}, approximate = True).result, 2.0)
+        self.assertEqual(len(ps._approximate_indeces), 1)
+        index = list(ps._approximate_indeces.values())[0][2]
+
+        # Appended and evicted entries update the index instead of rebuilding it
+        ps.run_process(func, {"param1": 9.0})
+        ps.run_process(func, {"param1": 7.0})
+        self.assertEqual(ps.run_process(func, {"param1": 8.9}, approximate = True).result, 18.0)
+        self.assertIs(list(ps._approximate_indeces.values())[0][2], index)
+        self.assertEqual(len(index), 3)
+        result = ps.run_process(func, {"param1": 1.2}, approximate = True)
+        self.assertEqual(result, ProcessResult(2.4, True))
+
+        # Other changes rebuild it
+        ps._cache_manager.clear_cache()
+        result = ps.run_process(func, {"param1": 8.9}, approximate = True)
+        self.assertEqual(result, ProcessResult(17.8, True))
+        ps.clear_cache()
+
+    def test_approximate_sample_index(self):
+        from tinc.approximate_cache import SampleIndex
+        coordinates = [[i / 100.0] for i in range(100)]
+        index = SampleIndex(coordinates, list(range(100)), ["s" + str(i) for i in range(100)])
+        result = index.query([0.101], 2)
+        self.assertEqual([s for d, s in result], [10, 11])
+        self.assertAlmostEqual(result[0][0], 0.001)
+        self.assertEqual(index.remove("s10"), 1)
+        self.assertEqual(index.remove("s10"), 0)
+        self.assertEqual([s for d, s in index.query([0.101], 2)], [11, 9])
+        index.add([0.1005], 100, "s100")
+        self.assertEqual([s for d, s in index.query([0.101], 2)], [100, 11])
+        self.assertEqual(index.query([0.5], 3, 0.001), [(0.0, 50)])
+        self.assertEqual(len(index), 100)
+        # The tree is rebuilt after a batch of changes
+        for i in range(100):
+            index.add([1.0 + i / 100.0], 101 + i, "t" + str(i))
+        self.assertEqual(len(index), 200)
+        self.assertEqual(len(index.coordinates) + len(index._added), 200)
+        self.assertGreater(len(index.coordinates), 100)
+        self.assertEqual(len(index._removed), 0)
+        self.assertEqual([s for d, s in index.query([1.001], 3)], [101, 102, 99])
+
+    def test_call_plan(self):
+        p1 = Parameter("param1")
+        p1.values = [0.0, 1.0, 2.0]
+        p2 = ParameterInt("param2")
+        p2.values = [1, 2]
+
+        ps = ParameterSpace("ps_plan")
+        ps.register_parameters([p1, p2])
+
+        def func(param1):
+            return param1 * 2
+
+        plan = ps._call_plan(func)
+        self.assertIs(ps._call_plan(func), plan)
+        self.assertEqual(plan.named_args, frozenset(["param1"]))
+        self.assertEqual(ps._get_calling_args(func, {"param1": 1.0, "param2": 2}), {"param1": 1.0})
+        self.assertEqual(ps._get_calling_args(func, [p1, p2]), {"param1": p1.value})
+
+        src_info = ps._make_source_info(func, {"param1": np.int32(3)}, [p2])
+        self.assertEqual(src_info.tinc_id, "ps_plan_func")
+        self.assertEqual(src_info.arguments[0].value, VariantValue(VariantType.VARIANT_INT32, 3))
+        self.assertEqual(type(src_info.arguments[0].value.value), int)
+        self.assertEqual(src_info.dependencies[0].value.nctype, VariantType.VARIANT_INT32)
+
+        self.assertEqual(len(ps._call_plans), 1)
+        del func, plan
+        import gc
+        gc.collect()
+        self.assertEqual(len(ps._call_plans), 0)
+
+    def test_sweep_distributed(self):
+        import shutil, threading
+        shutil.rmtree("ps_queue", ignore_errors = True)
+        shutil.rmtree("ps_queue_cache", ignore_errors = True)
+
+        calls = []
+        def func(param1, param2):
+            calls.append((param1, param2))
+            return param1 * param2
+
+        def make_space():
+            p1 = Parameter("param1")
+            p1.values = [0.0, 1.0, 2.0, 3.0, 4.0]
+            p2 = Parameter("param2")
+            p2.values = [-0.3,-0.2, -0.1, 0.0]
+            ps = ParameterSpace("ps_distributed")
+            ps.register_parameters([p1, p2])
+            ps.enable_cache("ps_queue_cache")
+            return ps
+
+        # A worker that claims a lease and dies
+        queue = SweepWorkQueue("ps_queue", "dead_worker", lease_timeout = 0.5)
+        spaces = [make_space() for i in range(3)]
+        queue.create(20, 3, spaces[0]._sweep_signature(func, spaces[0].get_parameters(), []))
+        self.assertEqual(queue.claim(), 0)
+        self.assertEqual(queue.progress(), {"pending": 6, "claimed": 1, "done": 0})
+
+        threads = [threading.Thread(target = ps.sweep_distributed,
+                                    args = (func, "ps_queue"),
+                                    kwargs = {"coordinator": i == 0, "lease_size": 3, 
+                                              "lease_timeout": 0.5, "poll_interval": 0.1}) 
+                   for i, ps in enumerate(spaces)]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+
+        self.assertTrue(queue.is_finished())
+        self.assertFalse(queue.complete(0))
+        self.assertEqual(len(calls), 20)
+        self.assertEqual(len(set(calls)), 20)
+        cache = CacheManager("ps_queue_cache")
+        self.assertEqual(len(cache.entries()), 20)
+
+    def test_queue_claim_not_expired(self):
+        import shutil
+        import tinc.sweep_queue
+        shutil.rmtree("ps_queue_claim", ignore_errors = True)
+        queue = SweepWorkQueue("ps_queue_claim", "worker", lease_timeout = 60)
+        queue.create(10, 5)
+        # Leases created long ago
+        for lease_id in range(2):
+            path = queue._path('pending', lease_id)
+            os.utime(path, (os.stat(path).st_atime - 1000, os.stat(path).st_mtime - 1000))
+
+        # Another worker reclaiming expired leases right after the lease is moved
+        other = SweepWorkQueue("ps_queue_claim", "other", lease_timeout = 60)
+        reclaimed = []
+        rename = os.rename
+        def rename_then_reclaim(src, dst):
+            rename(src, dst)
+            if '/claimed/' in dst:
+                reclaimed.append(other.reclaim_expired())
+        tinc.sweep_queue.os.rename = rename_then_reclaim
+        try:
+            self.assertEqual(queue.claim(), 0)
+        finally:
+            tinc.sweep_queue.os.rename = rename
+        self.assertEqual(reclaimed, [0])
+        self.assertEqual(queue.owner(0), "worker")
+        self.assertEqual(queue.progress(), {"pending": 1, "claimed": 1, "done": 0})
+        shutil.rmtree("ps_queue_claim", ignore_errors = True)
+
+    def test_progressive_sweep(self):
+        p1 = Parameter("param1")
+        p1.values = [float(i) for i in range(9)]
+        p2 = Parameter("param2")
+        p2.values = [float(i) for i in range(5)]
+
+        ps = ParameterSpace("ps_progressive")
+        ps.register_parameters([p1, p2])
+
+        indeces = list(ps.iter_progressive_indeces())
+        self.assertEqual(sorted(indeces), list(range(45)))
+        samples = [ps.sample_at(i) for i in indeces]
+        pairs = [(s["param1"], s["param2"]) for s in samples]
+        # Coarsest passes first: step 16, 8 then 4
+        self.assertEqual(pairs[:6], [(0.0, 0.0), (8.0, 0.0), (4.0, 0.0), (0.0, 4.0), (4.0, 4.0), (8.0, 4.0)])
+        # Then step 2, skipping samples already generated
+        for pair in pairs[6:15]:
+            self.assertEqual(pair[0] % 2, 0)
+            self.assertEqual(pair[1] % 2, 0)
+            self.assertNotIn(pair, pairs[:6])
+
+        calls = []
+        def func(param1, param2):
+            calls.append((param1, param2))
+            return param1 * param2
+        ps.sweep(func, order = 'progressive')
+        self.assertEqual(calls, pairs)
+
+    def test_sample_index(self):
+        p1 = Parameter("param1")
+        p1.values = [0.0, 1.0, 2.0, 3.0, 4.0]
+        p2 = Parameter("param2")
+        p2.values = [-0.3,-0.2, -0.1, 0.0]
+        p3 = ParameterInt("param3")
+        p3.values = [10, 20]
+
+        ps = ParameterSpace("ps_index")
+        ps.register_parameters([p1, p2, p3])
+        self.assertEqual(ps.sample_count(), 40)
+        self.assertEqual(ps.sample_count([p2, p3]), 8)
+
+        samples = list(ps.iter_samples())
+        self.assertEqual(len(samples), 40)
+        self.assertEqual(samples[0], {"param1": 0.0, "param2": -0.3, "param3": 10})
+        self.assertEqual(samples[1], {"param1": 1.0, "param2": -0.3, "param3": 10})
+        self.assertEqual(samples[5], {"param1": 0.0, "param2": -0.2, "param3": 10})
+        for i, sample in enumerate(samples):
+            self.assertEqual(ps.sample_at(i), sample)
+            self.assertEqual(ps.index_of(sample), i)
+
+        self.assertEqual(list(ps.iter_samples(7, 30, 5)), samples[7:30:5])
+        self.assertEqual(ps.sample_at(5, [p2, p3]), {"param2": -0.2, "param3": 20})
+        with self.assertRaises(IndexError):
+            ps.sample_at(40)
+        with self.assertRaises(ValueError):
+            ps.index_of({"param1": 0.5, "param2": -0.3, "param3": 10})
+
+    def test_running_paths(self):
+        dim1 = Parameter("dim1")
+        dim1.values = [0.1, 0.2, 0.3]
+        dim2 = Parameter("dim2")
+        dim2.values = [1.0, 2.0]
+
+        ps = ParameterSpace("ps")
+        ps.register_parameters([dim1, dim2])
+        ps.set_current_path_template("file_%%dim1%%_%%dim2:INDEX%%")
+        self.assertEqual(ps.running_paths(), 
+                         ['file_0.1_0', 'file_0.2_0', 'file_0.3_0', 'file_0.1_1', 'file_0.2_1', 'file_0.3_1'])
+        dim2.value = 2.0
+        self.assertEqual(ps.running_paths(['dim2']), ['file_0.1_1', 'file_0.2_1', 'file_0.3_1'])
+
     def test_data_directories(self):
         dim1 = Parameter("dim1")
         dim1.values = [0.1,0.2,0.3,0.4, 0.5]